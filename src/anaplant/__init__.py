@@ -8,6 +8,7 @@ import numpy as np
 from datetime import datetime
 import io
 import pandas as pd
+import anaplant.codec as codec
 
 CUTOFF_DATE = datetime(2021, 6, 1)
 NutrientInfo: TypeAlias = tuple[str, str, str]
@@ -118,6 +119,11 @@ def add_nearest_station_column(rohdaten_df: pl.DataFrame, station_df: pl.DataFra
 def read_file(file_name: str, index_col: int = None) -> pd.DataFrame:
     """Read csv or excel file as pandas dataframe"""
     if file_name.endswith('.csv'):
-        return pd.read_csv(file_name, decimal=",", index_col=index_col)
+        data = codec.read_csv(file_name).to_pandas()
     elif file_name.endswith('.xlsx'):
-        return pl.read_excel(file_name).to_pandas()
+        data = pl.read_excel(file_name).to_pandas()
+    else:
+        raise ValueError(f'{file_name} is neither a csv nor an xlsx file.')
+    if index_col is not None:
+        data = data.set_index(data.columns[index_col])
+    return data
@@ -1,34 +1,35 @@
 import polars as pl
+from anaplant.codec import parse_decimal
 
-def types(d: pl.DataFrame):
-    numeric = [ c for c in d.columns if
+DATE_COLUMNS = ['probenahme', 'dat_saat', 'dat_ernte', 'dat_düng']
+
+def numeric_columns(columns: list[str]) -> list[str]:
+    numeric = [ c for c in columns if
                 c.startswith('p_') or
                 c.startswith('b_') or
                 c.endswith('_lon') or
                 c.endswith('_lat') ]
-    
+
     numeric.extend(['ertrag (dt/ha)',
                     'ph_wert',
                     'rohprotein (% TS)',
                     'stärke (%)',
                     'zucker (% TS)',
                     'öl (%)'])
-    
-    d = d.with_columns(pl.col(numeric)
-                       .str.replace_all('.','',literal=True)
-                       .str.replace_all(',','.',literal=True)
-                       .cast(pl.Float64,strict=False))
-    
-    datum = ['probenahme', 'dat_saat', 'dat_ernte', 'dat_düng']
-    
-    d = d.with_columns(pl.col(datum).str.to_date())
-
-    booleans = [ c for c in d.columns if c.startswith('d_') ]
+    return numeric
+
+def types(d: pl.DataFrame | pl.LazyFrame, decimal_comma: bool | None = True):
+    columns = d.collect_schema().names()
+    numeric = numeric_columns(columns)
+
+    d = d.with_columns(parse_decimal(pl.col(numeric), decimal_comma))
+
+    d = d.with_columns(pl.col(DATE_COLUMNS).str.to_date())
+
+    booleans = [ c for c in columns if c.startswith('d_') ]
     booleans.extend(['versuchsfläche', 'öko/konv', 'bewässerung'])
-    
-    d = d.with_columns(pl.col(booleans)
-                       .str.replace_all('.','',literal=True)
-                       .str.replace_all(',','.',literal=True)
-                       .str.to_integer().cast(pl.Boolean))
+
+    # fertilization columns hold amounts such as "1.189", any amount counts as true
+    d = d.with_columns(parse_decimal(pl.col(booleans), decimal_comma).cast(pl.Boolean))
 
     return d
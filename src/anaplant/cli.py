@@ -5,11 +5,27 @@ from matplotlib import pyplot as plt
 import numpy as np
 from anaplant import NUTRIENT_INFO, read_file, resave_german_weather_station_list, read_weather_station_csv, add_nearest_station_column, CUTOFF_DATE
 import polars as pl
-import pandas as pd
 import anaplant.curves as curves
 import anaplant.top_percentile as top_percentile
 import anaplant.years as years
-import anaplant.apply_types as apply_types
+import anaplant.climate as climate
+import anaplant.codec as codec
+import anaplant.correlation as correlation
+import anaplant.dataset as dataset
+import anaplant.dris as dris
+import anaplant.equivalence as equivalence
+import anaplant.evaluate as evaluate
+import anaplant.fertilization as fertilization
+import anaplant.maps as maps
+import anaplant.ingest as ingest
+import anaplant.phenology as phenology
+import anaplant.pipeline as pipeline
+import anaplant.records as records
+import anaplant.results as results
+import anaplant.regions as regions
+import anaplant.sites as sites
+import anaplant.stages as stages
+import anaplant.validation as validation
 from anaplant.util import decimal_comma_str_to_float
 
 @click.group
@@ -39,8 +55,8 @@ def localize_yields_cli(yield_data: str, weather_station_list: str, dest_path: s
     result.select(
     pl.col('station_id'), 
     pl.col('station_name'),
-    pl.col('station_lat').cast(pl.String).map_elements(lambda v: v.replace('.', ',')),
-    pl.col('station_lon').cast(pl.String).map_elements(lambda v: v.replace('.', ',')),
+    codec.format_decimal(pl.col('station_lat')),
+    codec.format_decimal(pl.col('station_lon')),
     ).write_csv(
         dest_path,
         separator=',',
@@ -52,106 +68,109 @@ def localize_yields_cli(yield_data: str, weather_station_list: str, dest_path: s
 @click.option('--crop', type=click.STRING, default=None, required=False)
 @click.option('--plots-path', type=click.STRING, required=True)
 @click.option('--nutrient', type=click.STRING, required=False)
+@click.option('--method', type=click.Choice(curves.METHODS), default='multi-start')
+@click.option('--site-radius', type=click.FLOAT, default=None, required=False)
+@click.option('--results-db', type=click.STRING, default=None, required=False)
+@click.option('--density-threshold', type=click.INT, default=curves.DENSITY_THRESHOLD)
+@click.option('--fertilization-data', type=click.STRING, default=None, required=False)
+@click.option('--merge-equal-stages/--no-merge-equal-stages', default=True)
 
 def curves_cli(
     yield_data: str,
     nutrient_range_data: str, 
     crop: str | None,
     nutrient: str | None,
-    plots_path: str) -> None:
+    plots_path: str,
+    method: str,
+    site_radius: float | None,
+    results_db: str | None,
+    density_threshold: int,
+    fertilization_data: str | None,
+    merge_equal_stages: bool) -> None:
     min_samples = 8
 
-    yield_data_df = pl.read_csv(yield_data,
-                                encoding='ISO8859-1',
-                                separator=';',
-                                infer_schema=False)
-    yield_data_df = apply_types.types(yield_data_df)
+    # combine entwicklungsstadiums, with the stages of equal literature ranges if requested
+    nutrient_range_data_df = stages.read_literature(nutrient_range_data)
+    stage_table = stages.stage_table(nutrient_range_data_df if merge_equal_stages else None)
+    nutrient_range_data_df = stages.read_literature(nutrient_range_data, stage_table)
+
+    yield_data_lf = stages.harmonize(dataset.scan_yield_data(yield_data), stage_table)
+    if site_radius:
+        yield_data_lf = sites.aggregate_sites(sites.join_sites(yield_data_lf, site_radius))
     
-    # combine entwicklungsstadiums
-    yield_data_df = yield_data_df.with_columns(
-        pl.col('entwicklungsstadium').replace('EC 64-65', 'EC 64')
-    )
-    range_schema = {'Kultur': pl.String, 'nutrient': pl.String, 'min': pl.Float64, 'max': pl.Float64}
+    # samples fertilized after the sampling, once per dataset
+    yield_data_lf = fertilization.join_fertilization(yield_data_lf, fertilization_data)
+    range_schema = {
+        'kultur': pl.String, 'element': pl.String, 'stadium': pl.String, 'variante': pl.String,
+        'low': pl.Float64, 'high': pl.Float64, 'anzahl': pl.Int64}
+    statistic_schema = {
+        'kultur': pl.String, 'element': pl.String, 'stadium': pl.String, 'variante': pl.String,
+        'name': pl.String, 'value': pl.Float64}
     range_rows_out = []
-    # combine Körnererbse and Erbse
-    yield_data_df = yield_data_df.with_columns(pl.col('kultur').replace({'Körnererbse': 'Erbse'}))
-
-    nutrient_range_data_df = pl.read_csv(nutrient_range_data)
-        # duplicate Mais in Körnermais and Silomais
-    mais = nutrient_range_data_df.filter(pl.col('Kultur') == 'Mais')
-    kornermais = mais.with_columns(pl.col('Kultur').replace('Mais', 'Körnermais'))
-    silomais = mais.with_columns(pl.col('Kultur').replace('Mais', 'Silomais'))
-    nutrient_range_data_df = pl.concat([nutrient_range_data_df, kornermais, silomais])
-    
+    statistic_rows_out = []
+
     if crop is None:
-        crops = tuple(yield_data_df['kultur'].unique().to_list())
+        # combine Körnererbse and Erbse
+        crops = tuple(dataset.collect(yield_data_lf.select(
+            pl.col('kultur').replace({'Körnererbse': 'Erbse'}).unique()))['kultur'].to_list())
     else:
         crops = (crop,)
 
     for _crop in crops:  
 
         if nutrient is None:
-            nutrients = tuple(nutrient_range_data_df.filter(pl.col('Kultur') == _crop)['id_element'].to_list())
+            nutrients = tuple(nutrient_range_data_df.filter(pl.col('Kultur') == _crop)['id_element'].unique(maintain_order=True).to_list())
         else:
             nutrients = (nutrient,)
 
+        # only the samples and columns of this crop are materialized
+        sample_columns = ['entwicklungsstadium', 'ertrag (dt/ha)', 'versuchsfläche', 'öko/konv']
+        yield_by_crop = dataset.collect(
+            dataset.select_crops(yield_data_lf, [_crop])
+            .with_columns(pl.col('kultur').replace({'Körnererbse': 'Erbse'}))
+            .filter(pl.col('kultur') == _crop)
+            .select(*sample_columns, *nutrients, *(fertilization.late(n).alias(f'_spaet_{n}') for n in nutrients)))
+
         for _nutrient in nutrients:
             nutrient_info =  NUTRIENT_INFO[_nutrient]
-            nutrient_range_crop_element = nutrient_range_data_df.filter(
-                (pl.col('Kultur') == _crop) & 
-                (pl.col('id_element') == _nutrient)
-            )
-            
-            # define equivalent classes of development stages
-#            stage_map = {}
-#            for row in nutrient_range_crop_element.iter_rows(named=True):
-#                target_range = row['min_labor'], row['max_labor']
-#                stage_name = row['Entwicklungsstadium']
-#                if target_range not in stage_map:
-#                    stage_map[target_range] = (stage_name, )
-#                else:
-#                    stage_map[target_range] = stage_map[target_range] + (stage_name, )
-#
-#            # fuse rows with equivalent min_labor and max_labor
-            yield_by_crop = yield_data_df.filter(pl.col('kultur') == _crop)
-
-#            def remap_stage(v):
-#                for value in stage_map.values():
-#                    if v in value:
-#                        return value
-#                return None
-#            yield_by_crop = yield_by_crop.filter(pl.col('entwicklungsstadium').is_in(nutrient_range_crop_element['Entwicklungsstadium']))
-#            yield_by_crop = yield_by_crop.with_columns(
-#                pl.col('entwicklungsstadium').map_elements(
-#                    remap_stage, return_dtype=pl.List(pl.String))).drop_nulls('entwicklungsstadium')
-
-            for stages, data in yield_by_crop.group_by(pl.col('entwicklungsstadium')):
+            for stage_key, data in yield_by_crop.group_by(pl.col('entwicklungsstadium')):
                 nutrient_range = nutrient_range_data_df.filter(
-                    (pl.col('Entwicklungsstadium') == stages[0]) & 
+                    (pl.col('Entwicklungsstadium') == stage_key[0]) & 
                     ((pl.col('id_element') == _nutrient)) & 
                     (pl.col('Kultur') == _crop)
                     )['min_labor', 'max_labor'].to_numpy().squeeze()
 
-                mikro = _nutrient in ['p_b', 'p_mn', 'p_cu', 'p_zn', 'p_fe']
-                
+                # a second curve without the samples fertilized after the sampling, if there are any
+                late = data[f'_spaet_{_nutrient}']
+                fertilized_late = late.any()
+
                 crop_yield=data["ertrag (dt/ha)"].to_numpy()
 
                 if len(crop_yield) >= min_samples:
                     try:
-                        fig, new_range = curves.plot_curves(
+                        fig, new_range, diagnostics = curves.plot_curves(
                             crop_name=_crop, 
                             nutrient_info=nutrient_info, 
                             versuch=data['versuchsfläche'].to_numpy(),
                             oeko=data['öko/konv'].to_numpy(),
                             crop_yield=crop_yield,
                             nutrient_conc=data[_nutrient].to_numpy(),
-                            stages=stages[0], 
-                            nutrient_range=nutrient_range)
-                        fname = Path(plots_path) / f'kurven_{_crop}_{nutrient_info[0]}_{stages[0]}'.lower()
-                        if mikro:
+                            stages=stage_key[0], 
+                            nutrient_range=nutrient_range,
+                            method=method,
+                            density_threshold=density_threshold)
+                        fname = Path(plots_path) / f'kurven_{_crop}_{nutrient_info[0]}_{stage_key[0]}'.lower()
+                        if fertilized_late:
                             fname = f'{fname}_gesamt'
                         fname = f'{fname}.png'
-                        range_rows_out.append([_crop,_nutrient,stages[0], *new_range])
+                        variants = ['gesamt']
+                        if fertilization.fertilizer_column(_nutrient) and not fertilized_late:
+                            variants.append('ohne_duengung')
+                        for variant in variants:
+                            range_rows_out.append([_crop, _nutrient, stage_key[0], variant, *new_range, len(crop_yield)])
+                            statistic_rows_out.extend(
+                                [_crop, _nutrient, stage_key[0], variant, name, float(value)]
+                                for name, value in diagnostics._asdict().items())
                         print(f'Saving {fname}\n')
                         fig.savefig(fname)
                         plt.close(fig)
@@ -159,34 +178,37 @@ def curves_cli(
                         print(e.args)
                 else:
                     msg = (
-                        f'Not enough samples for crop {_crop}, nutrient {_nutrient}, stages {stages}.'
+                        f'Not enough samples for crop {_crop}, nutrient {_nutrient}, stages {stage_key}.'
                         f'Got {len(crop_yield)} samples, needed {min_samples} or more.'
                         )
                     print(msg)
 
-                if not mikro:
+                if not fertilized_late:
                     continue
 
-                duengung_spalte = _nutrient.replace('p_', 'd_')
-
-                data = data.remove(pl.col(duengung_spalte) & (pl.col('dat_düng') > pl.col('probenahme')))
+                data = data.filter(~late)
 
                 crop_yield=data["ertrag (dt/ha)"].to_numpy()
 
                 if len(crop_yield) >= min_samples:
                     try:
-                        fig, new_range = curves.plot_curves(
+                        fig, new_range, diagnostics = curves.plot_curves(
                             crop_name=_crop,
                             nutrient_info=nutrient_info,
                             versuch=data['versuchsfläche'].to_numpy(),
                             oeko=data['öko/konv'].to_numpy(),
                             crop_yield=crop_yield,
                             nutrient_conc=data[_nutrient].to_numpy(),
-                            stages=stages[0],
-                            nutrient_range=nutrient_range)
-                        fname = Path(plots_path) / f'kurven_{_crop}_{nutrient_info[0]}_{stages[0]}'.lower()
+                            stages=stage_key[0],
+                            nutrient_range=nutrient_range,
+                            method=method,
+                            density_threshold=density_threshold)
+                        fname = Path(plots_path) / f'kurven_{_crop}_{nutrient_info[0]}_{stage_key[0]}'.lower()
                         fname = f'{fname}.png'
-                        range_rows_out.append([_crop,_nutrient,stages[0], *new_range])
+                        range_rows_out.append([_crop, _nutrient, stage_key[0], 'ohne_duengung', *new_range, len(crop_yield)])
+                        statistic_rows_out.extend(
+                            [_crop, _nutrient, stage_key[0], 'ohne_duengung', name, float(value)]
+                            for name, value in diagnostics._asdict().items())
                         print(f'Saving {fname}\n')
                         fig.savefig(fname)
                         plt.close(fig)
@@ -194,50 +216,501 @@ def curves_cli(
                         print(e.args)
                 else:
                     msg = (
-                        f'Not enough samples for crop {_crop}, nutrient {_nutrient}, stages {stages}.'
+                        f'Not enough samples for crop {_crop}, nutrient {_nutrient}, stages {stage_key}.'
                         f'Got {len(crop_yield)} samples, needed {min_samples} or more.'
                         )
                     print(msg)
 
+    if results_db:
+        run_id = results.record_run(
+            results_db,
+            method=f'kurve/{method}',
+            parameters={
+                'method': method, 'site_radius': site_radius, 'min_samples': min_samples,
+                'merge_equal_stages': merge_equal_stages},
+            version=results.dataset_version(yield_data),
+            ranges=pl.DataFrame(range_rows_out, schema=range_schema, orient='row'),
+            statistics=pl.DataFrame(statistic_rows_out, schema=statistic_schema, orient='row'))
+        print(f'Recorded {len(range_rows_out)} ranges with their fit diagnostics as run {run_id} in {results_db}.')
+
 @click.command
 @click.option('--yield-data', type=click.STRING, required=True)
 @click.option('--nutrient-range-data', type=click.STRING, required=True)
 @click.option('--plots-path', type=click.STRING, required=True)
+@click.option('--crop', type=click.STRING, multiple=True)
+@click.option('--stage-column', type=click.STRING, default='entwicklungsstadium')
+@click.option('--region-column', type=click.STRING, default=None)
+@click.option('--site-radius', type=click.FLOAT, default=None, required=False)
+@click.option('--table-path', type=click.STRING, default=None, required=False)
+@click.option('--results-db', type=click.STRING, default=None, required=False)
+@click.option('--fertilization-data', type=click.STRING, default=None, required=False)
+@click.option('--exclude-late-fertilization', is_flag=True, default=False)
+@click.option('--merge-equal-stages/--no-merge-equal-stages', default=True)
 
-def plot_top_percentile_cli(yield_data: str, plots_path: str, nutrient_range_data: str) -> None:
-    data = read_file(yield_data)
-    data.replace('EC 64-65', 'EC 64', inplace=True)
-    top_percentile.aufbereiten(data)
+def plot_top_percentile_cli(
+    yield_data: str,
+    plots_path: str,
+    nutrient_range_data: str,
+    crop: tuple[str, ...],
+    stage_column: str,
+    region_column: str | None,
+    site_radius: float | None,
+    table_path: str | None,
+    results_db: str | None,
+    fertilization_data: str | None,
+    exclude_late_fertilization: bool,
+    merge_equal_stages: bool) -> None:
+    stage_table = stages.stage_table(
+        stages.read_literature(nutrient_range_data) if merge_equal_stages else None)
+    data = stages.harmonize(dataset.select_crops(dataset.scan_yield_data(yield_data), crop), stage_table)
+    if exclude_late_fertilization:
+        data = fertilization.mask_late_fertilization(fertilization.join_fertilization(data, fertilization_data))
+    if site_radius:
+        data = sites.aggregate_sites(sites.join_sites(data, site_radius))
+    data = top_percentile.aufbereiten_lazy(data)
     label = read_file("external/label.csv", index_col=0)
-    zielwerte_labor = read_file(nutrient_range_data)
-    # duplicate Mais in Körnermais and Silomais
-    mais = (zielwerte_labor[zielwerte_labor['Kultur'] == "Mais"]).copy()
-    kornermais = mais.copy().replace("Mais", "Körnermais")
-    silomais = mais.copy().replace("Mais", "Silomais") 
-    zielwerte_labor = pd.concat([zielwerte_labor,kornermais, silomais])
-    zielwerte = top_percentile.get_top20(data, label)
-    top_percentile.write_file(zielwerte, "external/top20/zielwerte_top20.csv")
-    top_percentile.plot_zielwerte(zielwerte, zielwerte_labor, plots_path)
+    zielwerte_labor = stages.read_literature(nutrient_range_data, stage_table).to_pandas()
+    group_columns = (region_column,) if region_column else ()
+    zielwerte = dataset.collect(top_percentile.get_top20_lazy(
+        data, label, stage_column=stage_column, group_columns=group_columns)).to_pandas()
+    top_percentile.write_file(zielwerte, table_path or str(Path(plots_path) / 'zielwerte_top20.csv'))
+    if results_db:
+        run_id = results.record_run(
+            results_db,
+            method='top20',
+            parameters={
+                'stage_column': stage_column, 'region_column': region_column, 'site_radius': site_radius,
+                'exclude_late_fertilization': exclude_late_fertilization,
+                'merge_equal_stages': merge_equal_stages},
+            version=results.dataset_version(yield_data),
+            **top_percentile.result_tables(zielwerte, region_column))
+        print(f'Recorded {len(zielwerte)} ranges as run {run_id} in {results_db}.')
+    if not region_column:
+        top_percentile.plot_zielwerte(zielwerte, zielwerte_labor, plots_path)
+        return
+    # one directory of plots per region
+    for region, zielwerte_region in zielwerte.dropna(subset=[region_column]).groupby(region_column):
+        # plot_stadien writes lower case file names
+        region_path = Path(plots_path) / str(region).lower()
+        region_path.mkdir(parents=True, exist_ok=True)
+        top_percentile.plot_zielwerte(
+            zielwerte_region.drop(columns=region_column), zielwerte_labor, str(region_path))
 
 @click.command
 @click.option('--yield-data', type=click.STRING, required=True)
 @click.option('--plots-path', type=click.STRING, required=True)
 @click.option('--nutrient-range-data', type=click.STRING, required=True)
+@click.option('--crop', type=click.STRING, multiple=True)
+@click.option('--permutations', type=click.INT, default=years.PERMUTATIONS)
+@click.option('--workers', type=click.INT, default=None, required=False)
+@click.option('--site-radius', type=click.FLOAT, default=None, required=False)
+@click.option('--fertilization-data', type=click.STRING, default=None, required=False)
+@click.option('--exclude-late-fertilization', is_flag=True, default=False)
+@click.option('--merge-equal-stages/--no-merge-equal-stages', default=True)
 
-def plot_annual_cli(yield_data: str, nutrient_range_data: str, plots_path: str) -> None:
-    data = read_file(yield_data)
-    data.replace('EC 64-65', 'EC 64', inplace=True)
-    years.aufbereiten(data)
+def plot_annual_cli(
+    yield_data: str,
+    nutrient_range_data: str,
+    plots_path: str,
+    crop: tuple[str, ...],
+    permutations: int,
+    workers: int | None,
+    site_radius: float | None,
+    fertilization_data: str | None,
+    exclude_late_fertilization: bool,
+    merge_equal_stages: bool) -> None:
+    stage_table = stages.stage_table(
+        stages.read_literature(nutrient_range_data) if merge_equal_stages else None)
+    data = stages.harmonize(dataset.select_crops(dataset.scan_yield_data(yield_data), crop), stage_table)
+    if exclude_late_fertilization:
+        data = fertilization.mask_late_fertilization(fertilization.join_fertilization(data, fertilization_data))
+    if site_radius:
+        data = sites.aggregate_sites(sites.join_sites(data, site_radius))
+    data = years.aufbereiten_lazy(data)
     label = read_file("external/label.csv", index_col=0)
-    zielwerte_labor = read_file(nutrient_range_data)
-    zielwerte = years.get_top20(data=data, label=label, nutrient_info=NUTRIENT_INFO)
+    # aufbereiten_lazy combines Körnermais and Silomais into Mais
+    zielwerte_labor = stages.read_literature(nutrient_range_data, stage_table, split_mais=False).to_pandas()
+    zielwerte = dataset.collect(years.get_top20_lazy(data, label)).to_pandas()
     years.plot_zielwerte(zielwerte, zielwerte_labor, plots_path)
+    effects = years.year_effects(
+        dataset.collect(data.select(years.year_effect_columns(label))), label,
+        permutations=permutations, workers=workers)
+    years.write_file(effects, str(Path(plots_path) / 'jahreseffekte.csv'))
+    print(f'{effects["signifikant"].sum()} of {len(effects)} groups differ between years.')
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True, multiple=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--overwrite', is_flag=True, default=False)
+
+def partition_cli(yield_data: tuple[str, ...], dest_path: str, overwrite: bool) -> None:
+    dataset.write_partitioned(dataset.scan_yield_data(yield_data), dest_path, overwrite=overwrite)
+
+@click.command
+@click.option('--source-path', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--workers', type=click.INT, default=None, required=False)
+@click.option('--report-path', type=click.STRING, default=None, required=False)
+@click.option('--strict', is_flag=True, default=False)
+
+def ingest_cli(source_path: str, dest_path: str, workers: int | None, report_path: str | None, strict: bool) -> None:
+    result = ingest.ingest_directory(source_path, workers=workers)
+    summary = validation.summarize(result.report, result.rows)
+    print(f'{len(result.report)} violations of the validation rules.')
+    if len(summary):
+        print(summary)
+    if report_path is not None:
+        codec.write_csv(result.report, report_path)
+    if strict and len(result.report):
+        raise ValueError(f'{source_path} violates validation rules, nothing written.')
+    result.data.write_parquet(dest_path)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True, multiple=True)
+@click.option('--report-path', type=click.STRING, default=None, required=False)
+@click.option('--summary-path', type=click.STRING, default=None, required=False)
+
+def validate_cli(yield_data: tuple[str, ...], report_path: str | None, summary_path: str | None) -> None:
+    report, summary, _ = validation.validate_sources(dataset.scan_untyped_sources(yield_data))
+    with pl.Config(tbl_rows=-1):
+        print(summary.filter(pl.col('verstoesse') > 0))
+    if report_path is not None:
+        codec.write_csv(report, report_path)
+    if summary_path is not None:
+        codec.write_csv(summary, summary_path)
+
+@click.command
+@click.option('--dataset-path', type=click.STRING, required=True)
+@click.option('--batch', type=click.STRING, required=True, multiple=True)
+@click.option('--conflicts-path', type=click.STRING, default=None, required=False)
+
+def upsert_cli(dataset_path: str, batch: tuple[str, ...], conflicts_path: str | None) -> None:
+    report = records.upsert(dataset_path, dataset.collect(dataset.scan_yield_data(batch)))
+    print(
+        f'Inserted {report.inserted}, replaced {report.replaced}, '
+        f'unchanged {report.unchanged}, conflicts {len(report.conflicts)}.')
+    if conflicts_path is not None and len(report.conflicts):
+        codec.write_csv(report.conflicts, conflicts_path)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--climate-archive', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--days', type=click.INT, multiple=True, default=(14, 30))
+
+def join_climate_cli(yield_data: str, climate_archive: str, dest_path: str, days: tuple[int, ...]) -> None:
+    climate.join_climate(dataset.scan_yield_data(yield_data), climate_archive, days).sink_parquet(dest_path)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--climate-archive', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+
+def phenology_cli(yield_data: str, climate_archive: str, dest_path: str) -> None:
+    phenology.join_phenology(dataset.scan_yield_data(yield_data), climate_archive).sink_parquet(dest_path)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+
+def fertilization_cli(yield_data: str, dest_path: str) -> None:
+    fertilization.fertilization_features(dataset.scan_yield_data(yield_data)).sink_parquet(dest_path)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--boundaries', type=click.STRING, required=True)
+@click.option('--name-property', type=click.STRING, required=True)
+@click.option('--region-column', type=click.STRING, default='region')
+@click.option('--check-column', type=click.STRING, default=None)
+@click.option('--dest-path', type=click.STRING, required=True)
+
+def assign_regions_cli(
+    yield_data: str,
+    boundaries: str,
+    name_property: str,
+    region_column: str,
+    check_column: str | None,
+    dest_path: str) -> None:
+    data = regions.join_regions(dataset.scan_yield_data(yield_data), boundaries, name_property, region_column)
+    data.sink_parquet(dest_path)
+    if check_column:
+        mismatches = regions.compare_regions(pl.read_parquet(dest_path), region_column, check_column)
+        print(f'{len(mismatches)} samples differ from {check_column}.')
+        if len(mismatches):
+            print(mismatches)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--crop', type=click.STRING, multiple=True)
+
+def dris_cli(yield_data: str, dest_path: str, crop: tuple[str, ...]) -> None:
+    data = stages.harmonize(
+        dataset.select_crops(dataset.scan_yield_data(yield_data), crop), stages.read_stage_table())
+    data = dataset.collect(top_percentile.aufbereiten_lazy(data))
+    norms, scores = dris.score(data)
+    Path(dest_path).mkdir(parents=True, exist_ok=True)
+    codec.write_csv(norms, str(Path(dest_path) / 'dris_normen.csv'))
+    codec.write_csv(scores, str(Path(dest_path) / 'dris_indizes.csv'))
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--plot-path', type=click.STRING, default=None, required=False)
+@click.option('--crop', type=click.STRING, multiple=True)
+@click.option('--method', type=click.Choice(correlation.METHODS), multiple=True)
+@click.option('--min-samples', type=click.INT, default=correlation.MIN_SAMPLES)
+@click.option('--fertilization-data', type=click.STRING, default=None, required=False)
+@click.option('--exclude-late-fertilization', is_flag=True, default=False)
+
+def correlate_cli(
+    yield_data: str,
+    dest_path: str,
+    plot_path: str | None,
+    crop: tuple[str, ...],
+    method: tuple[str, ...],
+    min_samples: int,
+    fertilization_data: str | None,
+    exclude_late_fertilization: bool) -> None:
+    data = stages.harmonize(
+        dataset.select_crops(dataset.scan_yield_data(yield_data), crop), stages.read_stage_table())
+    if exclude_late_fertilization:
+        data = fertilization.mask_late_fertilization(fertilization.join_fertilization(data, fertilization_data))
+    data = dataset.collect(data)
+    soil, plant = correlation.soil_columns(data.columns), correlation.plant_columns(data.columns)
+    correlations = correlation.correlate(data, soil, plant, method or correlation.METHODS, min_samples)
+    codec.write_csv(correlations, dest_path)
+    if plot_path:
+        correlation.plot_heatmaps(correlations, soil, plant, plot_path)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--radius', type=click.FLOAT, default=sites.SITE_RADIUS)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--aggregate', is_flag=True, default=False)
+
+def sites_cli(yield_data: str, radius: float, dest_path: str, aggregate: bool) -> None:
+    data = sites.join_sites(dataset.scan_yield_data(yield_data), radius)
+    if aggregate:
+        data = sites.aggregate_sites(data)
+    data.sink_parquet(dest_path)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--nutrient-range-data', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--crop', type=click.STRING, multiple=True)
+@click.option('--folds', type=click.INT, default=evaluate.FOLDS)
+@click.option('--leave-one-site-out', is_flag=True, default=False)
+@click.option('--site-radius', type=click.FLOAT, default=sites.SITE_RADIUS)
+@click.option('--curve-method', type=click.Choice(curves.METHODS), default='multi-start')
+@click.option('--workers', type=click.INT, default=None, required=False)
+@click.option('--results-db', type=click.STRING, default=None, required=False)
+@click.option('--merge-equal-stages/--no-merge-equal-stages', default=True)
+
+def evaluate_cli(
+    yield_data: str,
+    nutrient_range_data: str,
+    dest_path: str,
+    crop: tuple[str, ...],
+    folds: int,
+    leave_one_site_out: bool,
+    site_radius: float,
+    curve_method: str,
+    workers: int | None,
+    results_db: str | None,
+    merge_equal_stages: bool) -> None:
+    literature = stages.read_literature(nutrient_range_data)
+    stage_table = stages.stage_table(literature if merge_equal_stages else None)
+    literature = stages.read_literature(nutrient_range_data, stage_table)
+    data = stages.harmonize(dataset.select_crops(dataset.scan_yield_data(yield_data), crop), stage_table).with_columns(
+        pl.col('kultur').replace({'Körnererbse': 'Erbse'}))
+    # folds keep the samples of a site together
+    data = dataset.collect(sites.join_sites(data, site_radius))
+    nutrients = [n for n in NUTRIENT_INFO if n.startswith('p_') and n in data.columns]
+    groups = evaluate.group_data(data, nutrients, literature)
+    evaluation = evaluate.cross_validate(
+        groups, k=folds, leave_one_site_out=leave_one_site_out, curve_method=curve_method, workers=workers)
+    codec.write_csv(pl.from_pandas(evaluation), dest_path)
+    print(f'Evaluated {len(groups)} groups.')
+    print(evaluate.summary(evaluation).to_string())
+    if results_db:
+        run_id = results.record_run(
+            results_db,
+            method='evaluate',
+            parameters={
+                'folds': folds, 'leave_one_site_out': leave_one_site_out,
+                'site_radius': site_radius, 'curve_method': curve_method,
+                'merge_equal_stages': merge_equal_stages},
+            version=results.dataset_version(yield_data),
+            statistics=evaluate.result_statistics(evaluation))
+        print(f'Recorded run {run_id} in {results_db}.')
+
+@click.command
+@click.option('--results-db', type=click.STRING, required=True)
+@click.option('--crop', type=click.STRING, default=None, required=False)
+@click.option('--stage', type=click.STRING, default=None, required=False)
+@click.option('--nutrient', type=click.STRING, default=None, required=False)
+@click.option('--method', type=click.STRING, default=None, required=False)
+@click.option('--history', is_flag=True, default=False)
+@click.option('--statistics', is_flag=True, default=False)
+@click.option('--dest-path', type=click.STRING, default=None, required=False)
+
+def query_results_cli(
+    results_db: str,
+    crop: str | None,
+    stage: str | None,
+    nutrient: str | None,
+    method: str | None,
+    history: bool,
+    statistics: bool,
+    dest_path: str | None) -> None:
+    if statistics:
+        query = results.statistics
+    elif history:
+        query = results.range_history
+    else:
+        query = results.latest_ranges
+    found = query(results_db, kultur=crop, stadium=stage, element=nutrient, method=method)
+    if dest_path:
+        codec.write_csv(found, dest_path)
+    else:
+        with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+            print(found)
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--nutrient-range-data', type=click.STRING, required=True)
+@click.option('--out-path', type=click.STRING, required=True)
+@click.option('--cache-path', type=click.STRING, default='.anaplant-cache')
+@click.option('--weather-station-source', type=click.STRING, default=None, required=False)
+@click.option('--localize-data', type=click.STRING, default=None, required=False)
+@click.option('--workers', type=click.INT, default=None, required=False)
+
+def run_all_cli(
+    yield_data: str,
+    nutrient_range_data: str,
+    out_path: str,
+    cache_path: str,
+    weather_station_source: str | None,
+    localize_data: str | None,
+    workers: int | None) -> None:
+    analysis = pipeline.analysis_stages(
+        yield_data=yield_data,
+        nutrient_range_data=nutrient_range_data,
+        out_path=out_path,
+        weather_station_source=weather_station_source,
+        localize_data=localize_data)
+    results = pipeline.run_pipeline(analysis, cache_path, workers)
+    ran = sum(status == 'ran' for status in results.values())
+    print(f'Ran {ran} of {len(results)} stages.')
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--legacy-path', type=click.STRING, default='external')
+@click.option('--dest-path', type=click.STRING, default=None, required=False)
+@click.option('--comparison', type=click.Choice(equivalence.LEGACY_SCRIPTS), multiple=True)
+@click.option('--repeat', type=click.INT, default=1)
+@click.option('--atol', type=click.FLOAT, default=equivalence.ATOL)
+@click.option('--rtol', type=click.FLOAT, default=equivalence.RTOL)
+
+def compare_legacy_cli(
+    yield_data: str,
+    legacy_path: str,
+    dest_path: str | None,
+    comparison: tuple[str, ...],
+    repeat: int,
+    atol: float,
+    rtol: float) -> None:
+    label = read_file("external/label.csv", index_col=0)
+    data = dataset.collect(dataset.scan_yield_data(yield_data))
+    summary, differences = equivalence.run(
+        data, legacy_path, label, repeat=repeat, atol=atol, rtol=rtol, only=comparison)
+    if dest_path:
+        codec.write_csv(pl.from_pandas(differences), dest_path)
+    differing = differences[differences['abweichend'] > 0]
+    if not differing.empty:
+        print(differing.to_string(index=False))
+    print(summary.to_string(index=False))
+
+@click.command
+@click.option('--yield-data', type=click.STRING, required=True)
+@click.option('--nutrient', type=click.STRING, required=True)
+@click.option('--dest-path', type=click.STRING, required=True)
+@click.option('--crop', type=click.STRING, multiple=True)
+@click.option('--stage', type=click.STRING, default=None, required=False)
+@click.option('--nutrient-range-data', type=click.STRING, default=None, required=False)
+@click.option('--value', type=click.Choice(maps.VALUES), default='abweichung')
+@click.option('--method', type=click.Choice(maps.METHODS), default='idw')
+@click.option('--resolution', type=click.FLOAT, default=maps.RESOLUTION)
+@click.option('--neighbours', type=click.INT, default=maps.NEIGHBOURS)
+@click.option('--max-distance', type=click.FLOAT, default=maps.MAX_DISTANCE)
+@click.option('--power', type=click.FLOAT, default=maps.IDW_POWER)
+@click.option('--kriging-range', type=click.FLOAT, default=maps.KRIGING_RANGE)
+@click.option('--chunk-cells', type=click.INT, default=maps.CHUNK_CELLS)
+@click.option('--workers', type=click.INT, default=None, required=False)
+
+def map_cli(
+    yield_data: str,
+    nutrient: str,
+    dest_path: str,
+    crop: tuple[str, ...],
+    stage: str | None,
+    nutrient_range_data: str | None,
+    value: str,
+    method: str,
+    resolution: float,
+    neighbours: int,
+    max_distance: float,
+    power: float,
+    kriging_range: float,
+    chunk_cells: int,
+    workers: int | None) -> None:
+    stage_table = stages.read_stage_table()
+    data = stages.harmonize(dataset.select_crops(dataset.scan_yield_data(yield_data), crop), stage_table).with_columns(
+        pl.col('kultur').replace({'Körnererbse': 'Erbse'}))
+    if stage:
+        data = data.filter(pl.col('entwicklungsstadium') == stage)
+    literature = stages.read_literature(nutrient_range_data, stage_table) if nutrient_range_data else None
+    samples = maps.sample_values(dataset.collect(data), nutrient, value, literature)
+    lat, lon = samples['gps_lat'].to_numpy(), samples['gps_lon'].to_numpy()
+    grid = maps.make_grid(resolution, *maps.sample_extent(lat, lon, max_distance)) if lat.size else maps.make_grid(resolution)
+    raster = maps.interpolate(
+        lat,
+        lon,
+        samples['wert'].to_numpy(),
+        grid,
+        maps.Interpolation(method, neighbours, max_distance, power, kriging_range),
+        chunk_cells=chunk_cells,
+        workers=workers)
+    maps.write_raster(
+        dest_path, raster, grid,
+        nutrient=nutrient, value=value, method=method, resolution=resolution, samples=len(samples))
+    title = ' '.join(filter(None, [', '.join(crop) or 'Alle Kulturen', stage])) + f': {NUTRIENT_INFO[nutrient][0]}'
+    maps.plot_map(Path(dest_path).with_suffix('.png'), raster, grid, samples, nutrient, value, title)
+    print(f'Interpolated {len(samples)} samples onto {grid.shape[0]} x {grid.shape[1]} cells.')
 
 cli.add_command(resave_weather_station_list_cli, name='resave-weather-station-list')
 cli.add_command(localize_yields_cli, name='localize-yields')
 cli.add_command(curves_cli, 'plot-curves')
 cli.add_command(plot_top_percentile_cli, 'plot-top-percentile')
 cli.add_command(plot_annual_cli, 'plot-annual')
+cli.add_command(partition_cli, 'partition')
+cli.add_command(ingest_cli, 'ingest')
+cli.add_command(validate_cli, 'validate')
+cli.add_command(upsert_cli, 'upsert')
+cli.add_command(join_climate_cli, 'join-climate')
+cli.add_command(phenology_cli, 'phenology')
+cli.add_command(fertilization_cli, 'fertilization')
+cli.add_command(assign_regions_cli, 'assign-regions')
+cli.add_command(dris_cli, 'dris')
+cli.add_command(correlate_cli, 'correlate')
+cli.add_command(sites_cli, 'sites')
+cli.add_command(evaluate_cli, 'evaluate')
+cli.add_command(run_all_cli, 'run-all')
+cli.add_command(query_results_cli, 'query-results')
+cli.add_command(compare_legacy_cli, 'compare-legacy')
+cli.add_command(map_cli, 'map')
 
 if __name__ == '__main__':
     cli()
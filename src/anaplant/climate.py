@@ -0,0 +1,199 @@
+"""
+Verknüpfe Tageswerte des Deutschen Wetterdienstes mit den Proben.
+
+Reads the local DWD daily climate archive (one zip per station, as downloaded from
+the CDC portal, e.g. tageswerte_KL_03126_19480101_20231231_hist.zip), but only the
+stations and date windows the samples refer to. Every station series is turned
+into prefix sums over a dense daily calendar, so the sum or mean over any window
+is the difference of two array entries.
+"""
+
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import numpy as np
+import polars as pl
+
+ARCHIVE_PATTERN = re.compile(r'_KL_(\d{5})_')
+MISSING_VALUE = -999
+# DWD column names of the daily climate product
+CLIMATE_COLUMNS = {
+    'RSK': 'niederschlag',
+    'TMK': 'temperatur',
+    'TXK': 'temperatur_max',
+    'TNK': 'temperatur_min',
+}
+# windows with fewer valid days than this fraction are reported as missing
+MIN_COVERAGE = 0.8
+
+
+class StationIndex(NamedTuple):
+    """Prefix sums of one station, entry i covers the days before origin + i."""
+    origin: date
+    # variable -> (prefix sum of the values, prefix count of valid days)
+    prefix: dict[str, tuple[np.ndarray, np.ndarray]]
+
+
+def find_station_archives(archive_path: str | Path, station_ids: set[int]) -> dict[int, list[Path]]:
+    """Map every referenced station to its zip files, e.g. a historical and a recent one."""
+    archives: dict[int, list[Path]] = {}
+    for path in sorted(Path(archive_path).rglob('*.zip')):
+        match = ARCHIVE_PATTERN.search(path.name)
+        if match and int(match.group(1)) in station_ids:
+            archives.setdefault(int(match.group(1)), []).append(path)
+    return archives
+
+
+def read_station_archive(path: Path, start: date, end: date) -> pl.DataFrame:
+    """Read the daily values of one zip file between start and end (inclusive)."""
+    with zipfile.ZipFile(path) as archive:
+        member = next(n for n in archive.namelist() if n.startswith('produkt_klima_tag'))
+        raw = archive.read(member)
+    d = pl.read_csv(raw, separator=';', infer_schema=False)
+    d = d.rename({c: c.strip() for c in d.columns})
+    return (
+        d.select(
+            pl.col('MESS_DATUM').str.strip_chars().str.to_date('%Y%m%d').alias('datum'),
+            *(pl.col(c).str.strip_chars().cast(pl.Float64).alias(name)
+              for c, name in CLIMATE_COLUMNS.items()))
+        .filter(pl.col('datum').is_between(start, end))
+        .with_columns(pl.col(CLIMATE_COLUMNS.values()).replace(MISSING_VALUE, None)))
+
+
+def station_series(paths: list[Path], start: date, end: date) -> pl.DataFrame:
+    """Daily values of one station between start and end from all of its zip files."""
+    return (
+        pl.concat([read_station_archive(p, start, end) for p in paths])
+        # recent archives overlap with historical ones and hold the newer values
+        .unique('datum', keep='last', maintain_order=True))
+
+
+def build_station_index(series: pl.DataFrame, start: date, end: date) -> StationIndex:
+    """
+    Lay every variable of the series onto a dense calendar from start to end
+    and build the prefix sums.
+    """
+    n_days = (end - start).days + 1
+    positions = (series['datum'] - start).dt.total_days().to_numpy()
+    prefix = {}
+    for name in series.columns:
+        if name == 'datum':
+            continue
+        values = np.zeros(n_days)
+        valid = np.zeros(n_days)
+        column = series[name].to_numpy()
+        has_value = ~np.isnan(column)
+        values[positions[has_value]] = column[has_value]
+        valid[positions[has_value]] = 1
+        prefix[name] = (
+            np.concatenate([[0.0], np.cumsum(values)]),
+            np.concatenate([[0.0], np.cumsum(valid)]))
+    return StationIndex(origin=start, prefix=prefix)
+
+
+def window_aggregates(
+        index: StationIndex,
+        variable: str,
+        start: np.ndarray,
+        end: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sum and mean of a variable over the days [start, end) of every sample, given as
+    day offsets to the origin of the index. Windows with too few valid days are nan.
+    """
+    values, valid = index.prefix[variable]
+    last = len(values) - 1
+    start = np.clip(start, 0, last)
+    end = np.clip(end, 0, last)
+    total = values[end] - values[start]
+    days = valid[end] - valid[start]
+    length = end - start
+    with np.errstate(invalid='ignore', divide='ignore'):
+        enough = (length > 0) & (days >= MIN_COVERAGE * length)
+        mean = np.where(enough, total / days, np.nan)
+        total = np.where(enough, total, np.nan)
+    return total, mean
+
+
+def sample_window(samples: pl.DataFrame, days: tuple[int, ...]) -> tuple[date, date]:
+    first = min(
+        samples['probenahme'].min() - timedelta(days=max(days, default=0)),
+        samples['dat_saat'].min() or samples['probenahme'].min())
+    return first, samples['probenahme'].max()
+
+
+def station_features(
+        paths: list[Path],
+        samples: pl.DataFrame,
+        days: tuple[int, ...]) -> pl.DataFrame:
+    """Climate features of the samples of one station."""
+    start, end = sample_window(samples, days)
+    index = build_station_index(station_series(paths, start, end), start, end)
+
+    probenahme = (samples['probenahme'] - start).dt.total_days().to_numpy()
+    saat = (samples['dat_saat'] - start).dt.total_days().fill_null(-1).to_numpy()
+    features = {'_row': samples['_row']}
+    for n in days:
+        precipitation, _ = window_aggregates(index, 'niederschlag', probenahme - n, probenahme)
+        _, temperature = window_aggregates(index, 'temperatur', probenahme - n, probenahme)
+        features[f'niederschlag_{n}d'] = precipitation
+        features[f'temperatur_{n}d'] = temperature
+    has_saat = saat >= 0
+    precipitation, _ = window_aggregates(index, 'niederschlag', saat, probenahme)
+    _, temperature = window_aggregates(index, 'temperatur', saat, probenahme)
+    features['niederschlag_saat'] = np.where(has_saat, precipitation, np.nan)
+    features['temperatur_saat'] = np.where(has_saat, temperature, np.nan)
+    return pl.DataFrame(features).fill_nan(None)
+
+
+def climate_features(
+        samples: pl.DataFrame,
+        archive_path: str | Path,
+        days: tuple[int, ...] = (14, 30),
+        workers: int | None = None) -> pl.DataFrame:
+    """
+    Compute precipitation sums and mean temperatures for every sample: over the
+    n days before probenahme and between dat_saat and probenahme. samples needs the
+    columns _row, station_id, dat_saat and probenahme. The day of sampling itself
+    is not part of any window.
+    """
+    return map_stations(samples, archive_path, lambda paths, group: station_features(paths, group, days), workers)
+
+
+def map_stations(
+        samples: pl.DataFrame,
+        archive_path: str | Path,
+        function: Callable[[list[Path], pl.DataFrame], pl.DataFrame],
+        workers: int | None = None) -> pl.DataFrame:
+    """Apply a function to the archives and samples of every station in parallel."""
+    samples = samples.filter(
+        pl.col('station_id').is_not_null() & pl.col('probenahme').is_not_null())
+    station_ids = set(samples['station_id'].unique().to_list())
+    archives = find_station_archives(archive_path, station_ids)
+    missing = station_ids - set(archives)
+    if missing:
+        print(f'No climate archive for stations {sorted(missing)}.')
+    groups = samples.filter(pl.col('station_id').is_in(list(archives))).partition_by(
+        'station_id', as_dict=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(
+            lambda item: function(archives[item[0][0]], item[1]),
+            groups.items()))
+    if not frames:
+        raise ValueError(f'No climate archive found in {archive_path} for the samples.')
+    return pl.concat(frames)
+
+
+def join_climate(lf: pl.LazyFrame, archive_path: str | Path, days: tuple[int, ...] = (14, 30)) -> pl.LazyFrame:
+    """Add the climate features to a dataset; only the sample dates are materialized."""
+    lf = lf.with_row_index('_row')
+    samples = lf.select(
+        '_row',
+        pl.col('station_id').cast(pl.Int64, strict=False),
+        'dat_saat',
+        'probenahme').collect(engine='streaming')
+    features = climate_features(samples, archive_path, days)
+    return lf.join(features.lazy(), on='_row', how='left', maintain_order='left').drop('_row')
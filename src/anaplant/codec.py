@@ -0,0 +1,121 @@
+"""
+Deutsche Zahlen- und Textformate.
+
+Parses and writes whole columns of numbers in German notation (decimal comma,
+dot as thousands separator) with polars string expressions instead of per-element
+Python callbacks, and decodes the text encodings labs deliver files in.
+"""
+
+import re
+
+import polars as pl
+
+ENCODINGS = ('utf-8-sig', 'windows-1252', 'ISO8859-1')
+SEPARATORS = (';', ',', '\t')
+
+# numbers in one notation, the thousands separator only between groups of exactly three digits
+_GERMAN_NUMBER = r'^[-+]?(\d{1,3}(\.\d{3})+|\d+)(,\d+)?$'
+_ENGLISH_NUMBER = r'^[-+]?(\d{1,3}(,\d{3})+|\d+)(\.\d+)?$'
+_STRING_TO_FLOAT = str.maketrans({',': '.', '.': ''})
+
+
+def _from_german(s: pl.Expr) -> pl.Expr:
+    return s.str.replace_all('.', '', literal=True).str.replace(',', '.', literal=True)
+
+
+def _from_english(s: pl.Expr) -> pl.Expr:
+    return s.str.replace_all(',', '', literal=True)
+
+
+def parse_decimal(expr: pl.Expr, decimal_comma: bool | None = None) -> pl.Expr:
+    """
+    Parse strings such as "1.234,5", "1234,5", "1,234.5" or "0.42" into Float64.
+
+    A value with both separators uses the last one as decimal separator, a value
+    with the same separator more than once uses it for thousands. A single
+    separator is a decimal separator, unless it groups exactly three digits and
+    the file convention is known: with decimal_comma=True "1.234" is 1234, with
+    decimal_comma=False "1,234" is 1234. Values which are no numbers become null.
+
+    With a known convention the values written in it are parsed by two plain
+    replaces, all others are read in the other notation, e.g. "0.42" in a file
+    with decimal commas.
+    """
+    s = expr.str.strip_chars()
+    if decimal_comma is True:
+        normalized = pl.when(s.str.contains(_GERMAN_NUMBER)).then(_from_german(s)).otherwise(_from_english(s))
+        return normalized.cast(pl.Float64, strict=False)
+    if decimal_comma is False:
+        normalized = pl.when(s.str.contains(_ENGLISH_NUMBER)).then(_from_english(s)).otherwise(_from_german(s))
+        return normalized.cast(pl.Float64, strict=False)
+    has_comma = s.str.contains(',', literal=True)
+    has_point = s.str.contains('.', literal=True)
+    comma_is_decimal = (
+        pl.when(has_comma & has_point)
+        .then(s.str.find(',', literal=True) > s.str.find('.', literal=True))
+        .when(has_comma)
+        .then(s.str.count_matches(',', literal=True) == 1)
+        .when(has_point)
+        .then(s.str.count_matches('.', literal=True) > 1)
+        .otherwise(False))
+    normalized = pl.when(comma_is_decimal).then(_from_german(s)).otherwise(_from_english(s))
+    return normalized.cast(pl.Float64, strict=False)
+
+
+def format_decimal(expr: pl.Expr, decimals: int | None = None) -> pl.Expr:
+    """Write numbers with a decimal comma and without thousands separators."""
+    if decimals is not None:
+        expr = expr.round(decimals)
+    return expr.cast(pl.String).str.replace('.', ',', literal=True)
+
+
+def parse_decimal_str(data: str) -> float:
+    """Parse a single number in German notation such as "1.234,5", by the rule of `parse_decimal`."""
+    data = data.strip()
+    if re.match(_GERMAN_NUMBER, data):
+        return float(data.translate(_STRING_TO_FLOAT))
+    return float(data.replace(',', ''))
+
+
+def detect_encoding(raw: bytes) -> str:
+    """Return the first encoding of ENCODINGS which decodes the data."""
+    for encoding in ENCODINGS:
+        try:
+            raw.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            pass
+    raise ValueError('Unknown encoding.')
+
+
+def decode(raw: bytes) -> str:
+    return raw.decode(detect_encoding(raw))
+
+
+def detect_separator(header: str) -> str:
+    """Return the separator which occurs most often in the header line."""
+    return max(SEPARATORS, key=header.count)
+
+
+def read_csv(file_name: str) -> pl.DataFrame:
+    """
+    Read a csv file of any of ENCODINGS and SEPARATORS. Columns holding only numbers,
+    in German or English notation, are parsed as Float64, all others stay strings.
+    """
+    with open(file_name, mode='rb') as fh:
+        text = decode(fh.read())
+    d = pl.read_csv(
+        text.encode('UTF-8'),
+        separator=detect_separator(text.split('\n', 1)[0]),
+        infer_schema=False)
+    parsed = d.select(parse_decimal(pl.all()))
+    numbers = [c for c in d.columns
+               if d[c].null_count() < len(d) and parsed[c].null_count() == d[c].null_count()]
+    return d.with_columns(parsed[c] for c in numbers)
+
+
+def write_csv(d: pl.DataFrame, file_name: str, encoding: str = 'windows-1252') -> None:
+    """Write a semicolon separated csv file with decimal commas."""
+    text = d.with_columns(format_decimal(pl.col(pl.Float32, pl.Float64))).write_csv(separator=';')
+    with open(file_name, mode='w', encoding=encoding, newline='') as fh:
+        fh.write(text)
@@ -0,0 +1,191 @@
+"""
+Korreliere Boden- und Pflanzenwerte.
+
+All correlations between the soil columns and the plant columns of a group are
+computed at once with masked matrix products: with the indicator matrices of
+the known values, the pairwise counts, sums and cross products of every pair
+of columns are products of (samples, soil) and (samples, plant) matrices, so
+missing values are skipped pairwise without a loop over the pairs.
+
+Spearman correlations need the ranks within the samples of a pair. Columns
+with the same missing values share these samples, so the columns are grouped
+by their pattern of missing values and ranked once per pair of patterns; the
+lab data has only a few patterns.
+"""
+
+from pathlib import Path
+from typing import Sequence
+
+import matplotlib.pyplot as plt
+import numpy as np
+import polars as pl
+from scipy.stats import rankdata, t as student
+
+from anaplant import NUTRIENT_INFO
+
+METHODS = ('pearson', 'spearman')
+MIN_SAMPLES = 10
+SIGNIFICANCE_LEVEL = 0.05
+SOIL_PREFIX = 'b_'
+PLANT_PREFIX = 'p_'
+CORRELATION_SCHEMA = {
+    'Kultur': pl.String,
+    'Entwicklungsstadium': pl.String,
+    'methode': pl.String,
+    'boden': pl.String,
+    'pflanze': pl.String,
+    'anzahl': pl.Int64,
+    'r': pl.Float64,
+    'p': pl.Float64,
+}
+
+
+def soil_columns(columns: Sequence[str]) -> list[str]:
+    return [c for c in columns if c.startswith(SOIL_PREFIX) or c == 'ph_wert']
+
+
+def plant_columns(columns: Sequence[str]) -> list[str]:
+    return [c for c in columns if c.startswith(PLANT_PREFIX)]
+
+
+def pearson(x: np.ndarray, y: np.ndarray, min_samples: int = MIN_SAMPLES) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pearson correlation of every column of x with every column of y on the
+    samples where both are known. Returns r and the counts, of shape
+    (x columns, y columns); r is nan for fewer than min_samples samples or a
+    constant column.
+    """
+    known_x, known_y = ~np.isnan(x), ~np.isnan(y)
+    fx, fy = known_x.astype(float), known_y.astype(float)
+    # centre by the column means to limit cancellation in the sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x0 = np.where(known_x, x - np.where(known_x, x, 0).sum(axis=0) / fx.sum(axis=0), 0)
+        y0 = np.where(known_y, y - np.where(known_y, y, 0).sum(axis=0) / fy.sum(axis=0), 0)
+    n = fx.T @ fy
+    sx, sy = x0.T @ fy, fx.T @ y0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = x0.T @ y0 - sx * sy / n
+        var_x = (x0 ** 2).T @ fy - sx ** 2 / n
+        var_y = fx.T @ y0 ** 2 - sy ** 2 / n
+        r = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+    usable = (n >= min_samples) & (var_x > 0) & (var_y > 0)
+    return np.where(usable, r, np.nan), n.astype(np.int64)
+
+
+def _pattern_groups(known: np.ndarray) -> list[tuple[np.ndarray, np.ndarray]]:
+    """The distinct patterns of known values of the columns and the columns with each."""
+    patterns, inverse = np.unique(known.T, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    return [(pattern, np.flatnonzero(inverse == i)) for i, pattern in enumerate(patterns)]
+
+
+def spearman(x: np.ndarray, y: np.ndarray, min_samples: int = MIN_SAMPLES) -> tuple[np.ndarray, np.ndarray]:
+    """Spearman correlation with the ranks among the samples of every pair, ties get the mean rank."""
+    r = np.full((x.shape[1], y.shape[1]), np.nan)
+    for rows_x, cols_x in _pattern_groups(~np.isnan(x)):
+        for rows_y, cols_y in _pattern_groups(~np.isnan(y)):
+            rows = rows_x & rows_y
+            if rows.sum() < min_samples:
+                continue
+            ranks_x = rankdata(x[np.ix_(rows, cols_x)], axis=0)
+            ranks_y = rankdata(y[np.ix_(rows, cols_y)], axis=0)
+            r[np.ix_(cols_x, cols_y)] = pearson(ranks_x, ranks_y, min_samples)[0]
+    n = (~np.isnan(x)).astype(float).T @ (~np.isnan(y)).astype(float)
+    return r, n.astype(np.int64)
+
+
+def p_values(r: np.ndarray, n: np.ndarray) -> np.ndarray:
+    """Two-sided p-values of r from the t distribution with n - 2 degrees of freedom."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = r * np.sqrt((n - 2) / (1 - r ** 2))
+        return 2 * student.sf(np.abs(t), n - 2)
+
+
+def correlate(
+        data: pl.DataFrame,
+        soil: Sequence[str] | None = None,
+        plant: Sequence[str] | None = None,
+        methods: Sequence[str] = METHODS,
+        min_samples: int = MIN_SAMPLES) -> pl.DataFrame:
+    """
+    Correlations of every soil with every plant column for every crop, over all
+    stages ("gesamt") and per stage, as one row per pair with r, p and count.
+    """
+    soil = soil_columns(data.columns) if soil is None else list(soil)
+    plant = plant_columns(data.columns) if plant is None else list(plant)
+    functions = {'pearson': pearson, 'spearman': spearman}
+    pairs = {
+        'boden': np.repeat(soil, len(plant)),
+        'pflanze': np.tile(plant, len(soil)),
+    }
+    frames = []
+    data = data.filter(pl.col('kultur').is_not_null())
+    for (kultur,), crop in data.partition_by('kultur', as_dict=True, maintain_order=True).items():
+        groups = [('gesamt', crop)] + [
+            (stadium, d) for (stadium,), d in
+            crop.filter(pl.col('entwicklungsstadium').is_not_null())
+            .partition_by('entwicklungsstadium', as_dict=True, maintain_order=True).items()]
+        for stadium, d in groups:
+            x = d.select(pl.col(soil).cast(pl.Float64)).fill_null(np.nan).to_numpy()
+            y = d.select(pl.col(plant).cast(pl.Float64)).fill_null(np.nan).to_numpy()
+            for method in methods:
+                r, n = functions[method](x, y, min_samples)
+                frames.append(pl.DataFrame({
+                    'Kultur': kultur,
+                    'Entwicklungsstadium': stadium,
+                    'methode': method,
+                    **pairs,
+                    'anzahl': n.ravel(),
+                    'r': r.ravel(),
+                    'p': p_values(r, n).ravel(),
+                }, schema=CORRELATION_SCHEMA))
+    if not frames:
+        return pl.DataFrame(schema=CORRELATION_SCHEMA)
+    return pl.concat(frames).fill_nan(None).filter(pl.col('r').is_not_null())
+
+
+def _axis_label(column: str) -> str:
+    if column == 'ph_wert':
+        return 'pH'
+    _, symbol, unit = NUTRIENT_INFO.get(column, (column, column, ''))
+    return f'{symbol} ({unit})' if unit else symbol
+
+
+def plot_heatmap(group: pl.DataFrame, soil: Sequence[str], plant: Sequence[str], path: str):
+    """Heatmap of the correlations of one crop, stage and method; significant r are marked with *."""
+    kultur, stadium, method = group.select('Kultur', 'Entwicklungsstadium', 'methode').row(0)
+    r = np.full((len(soil), len(plant)), np.nan)
+    p = np.full((len(soil), len(plant)), np.nan)
+    rows = {c: i for i, c in enumerate(soil)}
+    cols = {c: i for i, c in enumerate(plant)}
+    for boden, pflanze, value, p_value in group.select('boden', 'pflanze', 'r', 'p').iter_rows():
+        r[rows[boden], cols[pflanze]] = value
+        p[rows[boden], cols[pflanze]] = p_value
+
+    fig, ax = plt.subplots(figsize=(0.45 * len(plant) + 3, 0.4 * len(soil) + 2))
+    image = ax.imshow(r, cmap='RdBu_r', vmin=-1, vmax=1, aspect='auto')
+    for i, j in zip(*np.nonzero(~np.isnan(r))):
+        mark = '*' if p[i, j] < SIGNIFICANCE_LEVEL else ''
+        ax.text(j, i, f'{r[i, j]:.2f}{mark}', ha='center', va='center', fontsize=5,
+                color='white' if abs(r[i, j]) > 0.6 else 'black')
+    ax.set_xticks(range(len(plant)), [_axis_label(c) for c in plant], rotation=90)
+    ax.set_yticks(range(len(soil)), [_axis_label(c) for c in soil])
+    ax.set(
+        title=f'{kultur} {stadium}: {method.capitalize()}-Korrelation',
+        xlabel='Pflanze',
+        ylabel='Boden')
+    fig.colorbar(image, ax=ax, label='r')
+    fig.savefig(
+        f'{path}/Korrelation_{kultur}_{stadium}_{method}.png'.lower().replace(' ', '_'),
+        transparent=False,
+        dpi=150,
+        bbox_inches='tight',
+    )
+    plt.close(fig)
+
+
+def plot_heatmaps(correlations: pl.DataFrame, soil: Sequence[str], plant: Sequence[str], path: str):
+    """One heatmap per crop, stage and method."""
+    Path(path).mkdir(parents=True, exist_ok=True)
+    for group in correlations.partition_by('Kultur', 'Entwicklungsstadium', 'methode', maintain_order=True):
+        plot_heatmap(group, soil, plant, path)
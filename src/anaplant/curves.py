@@ -4,11 +4,55 @@ Originally written by Wulf Haberkern, with modifications by Davis Bennett
 """
 
 from textwrap import fill
+from typing import NamedTuple
 
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.colors import LogNorm
 import pandas as pd
-from scipy.optimize import least_squares      
+from scipy import sparse
+from scipy.optimize import least_squares, linprog, lsq_linear
+
+METHODS = ('multi-start', 'least-squares', 'quantile', 'binned')
+# random starting points of method 'multi-start' and how many of the best are refined
+MULTI_STARTS = 256
+REFINED_STARTS = 2
+# best starting points compared with the fit, and the distance of their vertex
+# from the fitted one, as share of the concentration range, counted as agreeing
+AGREEMENT_STARTS = 16
+VERTEX_TOLERANCE = 0.1
+# quantile of the yield the boundary line follows with method 'quantile'
+QUANTILE = 0.95
+# number of x bins whose maxima the boundary line follows with method 'binned',
+# fewer for small groups so that every bin holds BIN_SAMPLES samples
+BINS = 12
+BIN_SAMPLES = 5
+# candidate positions of the vertex per refinement step
+X_MAX_CANDIDATES = 15
+# above this number of samples plot_curves draws sample densities instead of markers
+DENSITY_THRESHOLD = 2000
+# cells of the density raster in x and y, and how many of them form a cell of the category outlines
+DENSITY_BINS = (80, 50)
+OUTLINE_COARSENING = 4
+# categories of the samples as label, marker and line style of their outline in density plots
+SAMPLE_CATEGORIES = (
+    ('on-farm konv.', 'o', '-'),
+    ('on-farm öko', '*', '--'),
+    ('Versuchsfläche', '^', ':'),
+)
+
+
+class FitDiagnostics(NamedTuple):
+    """Quality of a boundary line fit."""
+    # value of error_spline, comparable between methods
+    loss: float
+    # share of the samples above the boundary line
+    share_above: float
+    # the vertex lies on the smallest or largest concentration
+    vertex_at_edge: bool
+    starts: int
+    # best starting points whose vertex lies near the fitted one, few indicate competing minima
+    agreeing_starts: int
 
 def get_boundary_curve(
         *, 
@@ -68,16 +112,175 @@ def calc_curves(data: pd.DataFrame, label: pd.DataFrame):
     return curves
 
 
+def _fit_bounds(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Starting point and bounds of y_max, x_max, a_l and a_r."""
+    a_max = _steepest(x, y)
+    par_start = np.array([np.max(y), np.median(x), a_max, a_max])
+    b_low = np.array([0.6 * np.max(y), np.min(x), a_max, a_max])
+    b_up = np.array([1.2 * np.max(y), np.max(x), 0, 0])
+    return par_start, b_low, b_up
+
+
 def fit_curve(x: np.ndarray, y: np.ndarray):
     """Berechne Parameter eines Parabelsplines."""
-    a_max = -np.max(y) / (np.max(x) - np.min(x)) ** 2
-    par_start = [np.max(y), np.median(x), a_max, a_max]
-    b_low = [0.6 * np.max(y), np.min(x), a_max, a_max]
-    b_up = [1.2 * np.max(y), np.max(x), 0, 0]
+    par_start, b_low, b_up = _fit_bounds(x, y)
     result = least_squares(error_spline, par_start, args=(x, y), bounds=(b_low, b_up))
     return list(np.round(result.x, decimals=8))
 
 
+def fit_curve_multistart(
+        x: np.ndarray,
+        y: np.ndarray,
+        starts: int = MULTI_STARTS,
+        refine: int = REFINED_STARTS,
+        seed: int = 0) -> tuple[list[float], FitDiagnostics]:
+    """
+    Berechne Parameter eines Parabelsplines von vielen Startpunkten.
+    The loss of all starting points is one broadcast evaluation. Only the
+    starting point of fit_curve and the best of the others are refined with
+    least_squares, so the result is never worse than fit_curve and costs about
+    `refine` single fits. The curvatures are drawn denser near zero, where flat
+    and sparse groups have their minima. The agreement of the starts is read
+    from the same losses: the vertices of the best starts lie near the fitted
+    vertex unless there are competing minima.
+    """
+    par_start, b_low, b_up = _fit_bounds(x, y)
+    u = np.random.default_rng(seed).random((starts - 1, 4))
+    candidates = b_low + u * (b_up - b_low)
+    candidates[:, 2:] = b_low[2:] * u[:, 2:] ** 2
+    candidates = np.vstack([par_start, candidates])
+    order = np.argsort(error_splines(candidates, x, y), kind='stable')
+    refined = [0, *(i for i in order[:refine] if i != 0)][:refine]
+    results = [
+        least_squares(error_spline, start, args=(x, y), bounds=(b_low, b_up)).x
+        for start in candidates[refined]]
+    losses = np.array([error_spline(r, x, y) for r in results])
+    parameters = list(np.round(results[np.argmin(losses)], decimals=8))
+    tolerance = VERTEX_TOLERANCE * (np.max(x) - np.min(x))
+    agreeing = int(np.sum(np.abs(candidates[order[:AGREEMENT_STARTS], 1] - parameters[1]) <= tolerance))
+    return parameters, fit_diagnostics(x, y, parameters, starts=starts, agreeing_starts=agreeing)
+
+
+def fit_diagnostics(
+        x: np.ndarray,
+        y: np.ndarray,
+        parameters,
+        starts: int = 1,
+        agreeing_starts: int = 1) -> FitDiagnostics:
+    return FitDiagnostics(
+        loss=float(error_spline(parameters, x, y)),
+        share_above=float(np.mean(y > spline(x, *parameters))),
+        vertex_at_edge=bool(parameters[1] <= np.min(x) or parameters[1] >= np.max(x)),
+        starts=starts,
+        agreeing_starts=agreeing_starts)
+
+
+def fit_boundary(
+        x: np.ndarray,
+        y: np.ndarray,
+        method: str = 'multi-start') -> tuple[list[float], FitDiagnostics]:
+    """Berechne Parameter eines Parabelsplines mit dem gewählten Verfahren."""
+    if method == 'multi-start':
+        return fit_curve_multistart(x, y)
+    if method == 'least-squares':
+        parameters = fit_curve(x, y)
+    elif method == 'quantile':
+        parameters = fit_quantile_curve(x, y)
+    elif method == 'binned':
+        parameters = fit_binned_curve(x, y)
+    else:
+        raise ValueError(f'Unknown method {method}, expected one of {METHODS}.')
+    return parameters, fit_diagnostics(x, y, parameters)
+
+
+def _parabola_basis(x: np.ndarray, x_max: float) -> np.ndarray:
+    """Columns of y_max, a_l and a_r; for a fixed vertex the spline is linear in them."""
+    square = (x - x_max) ** 2
+    left = x < x_max
+    return np.column_stack([np.ones_like(x), np.where(left, square, 0), np.where(left, 0, square)])
+
+
+def _search_vertex(x: np.ndarray, solve) -> list[float]:
+    """
+    Minimize over the vertex position, on a grid of quantiles of x refined once
+    around the best candidate. solve(candidates) returns the loss and the
+    [y_max, a_l, a_r] of every candidate.
+    """
+    candidates = np.unique(np.quantile(x, np.linspace(0, 1, X_MAX_CANDIDATES)))
+    for _ in range(2):
+        losses, parameters = solve(candidates)
+        best = int(np.argmin(losses))
+        x_max = candidates[best]
+        y_max, a_l, a_r = parameters[best]
+        lower = candidates[max(best - 1, 0)]
+        upper = candidates[min(best + 1, len(candidates) - 1)]
+        candidates = np.linspace(lower, upper, X_MAX_CANDIDATES)
+    return list(np.round([y_max, x_max, a_l, a_r], decimals=8))
+
+
+def _steepest(x: np.ndarray, y: np.ndarray) -> float:
+    if np.ptp(x) == 0:
+        raise ValueError('All nutrient concentrations are equal.')
+    return -np.max(y) / (np.max(x) - np.min(x)) ** 2
+
+
+def fit_quantile_curve(x: np.ndarray, y: np.ndarray, quantile: float = QUANTILE):
+    """
+    Berechne Parameter eines Parabelsplines als Quantilsregression.
+    For every vertex position the check loss is minimized as a linear program,
+    which has no local minima and needs no starting point. The programs of all
+    candidate positions are independent blocks of one program solved at once.
+    """
+    a_min = _steepest(x, y)
+    n = len(x)
+    cost = np.concatenate([np.zeros(3), np.full(n, quantile), np.full(n, 1 - quantile)])
+    slack = sparse.hstack([sparse.eye(n), -sparse.eye(n)])
+    bounds = [(0, None), (a_min, 0), (a_min, 0)] + [(0, None)] * (2 * n)
+
+    def solve(candidates):
+        blocks = sparse.block_diag([
+            sparse.hstack([sparse.csr_matrix(_parabola_basis(x, x_max)), slack])
+            for x_max in candidates], format='csr')
+        result = linprog(
+            np.tile(cost, len(candidates)),
+            A_eq=blocks,
+            b_eq=np.tile(y, len(candidates)),
+            bounds=bounds * len(candidates),
+            method='highs')
+        if not result.success:
+            raise ValueError(f'Quantile regression failed: {result.message}')
+        solution = result.x.reshape(len(candidates), -1)
+        return solution @ cost, solution[:, :3]
+
+    return _search_vertex(x, solve)
+
+
+def fit_binned_curve(x: np.ndarray, y: np.ndarray, bins: int = BINS):
+    """
+    Berechne Parameter eines Parabelsplines durch die Maxima von Konzentrationsklassen.
+    The classes are quantiles of x, so every class holds about the same number of samples.
+    """
+    a_min = _steepest(x, y)
+    bins = min(bins, len(x) // BIN_SAMPLES)
+    edges = np.unique(np.quantile(x, np.linspace(0, 1, bins + 1)))
+    classes = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, len(edges) - 2)
+    # the sample with the highest yield of every class
+    order = np.lexsort((-y, classes))
+    first = np.unique(classes[order], return_index=True)[1]
+    x_top, y_top = x[order][first], y[order][first]
+    if len(x_top) < 3:
+        raise ValueError(
+            f'Got {len(x_top)} concentration classes of {BIN_SAMPLES} or more samples, needed 3 or more.')
+
+    def solve(candidates):
+        results = [
+            lsq_linear(_parabola_basis(x_top, x_max), y_top, bounds=([0, a_min, a_min], [np.inf, 0, 0]))
+            for x_max in candidates]
+        return [r.cost for r in results], [r.x for r in results]
+
+    return _search_vertex(x_top, solve)
+
+
 def error_spline(par, x, y):
     """Berechne Fehler eines Parabelsplines."""
     max_error = (max(y) - min(y)) / 2
@@ -88,10 +291,33 @@ def error_spline(par, x, y):
     return error_under + error_above
 
 
+def error_splines(parameters: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """error_spline of every row of parameters, evaluated as one (rows, samples) broadcast."""
+    max_error = (max(y) - min(y)) / 2
+    error = spline(x, *(p[:, None] for p in parameters.T)) - y
+    error_under = np.sum(np.minimum(np.maximum(0, error), max_error), axis=1)
+    error_above = 6 * np.sum(np.minimum(np.maximum(0, -error), max_error), axis=1)
+    return error_under + error_above
+
+
 def spline(input: np.ndarray, y_max, x_max, a_l, a_r):
     """Berechne Werte eines Parabelsplines."""
     return y_max + np.where(input < x_max, a_l, a_r) * (input - x_max) ** 2
 
+
+def target_range(parameters, x_low: float, x_high: float, level: float = .9) -> np.ndarray:
+    """Nutrient range in which the spline exceeds level, relative to its minimum and maximum on [x_low, x_high]."""
+    x_spline = np.linspace(x_low, x_high, 100)
+    y_spline = spline(x_spline, *parameters)
+    if np.ptp(y_spline) == 0:
+        raise ValueError('The boundary line is flat.')
+    # normalize to 0 and 1
+    y_spline_normed = (y_spline - y_spline.min()) / (y_spline.max() - y_spline.min())
+    above = np.flatnonzero(y_spline_normed > level)
+    if len(above) == 0:
+        raise ValueError('Catastrophic curve fit.')
+    return x_spline[above[[0, -1]]]
+
 def percentile_threshold(
         data: np.ndarray, 
         *, 
@@ -108,6 +334,13 @@ def percentile_threshold(
     return np.logical_or(data < threshold_lower,  data > threshold_upper)
 
 
+def outlier_mask(nutrient_conc: np.ndarray, crop_yield: np.ndarray) -> np.ndarray:
+    """Samples left out of the boundary line fit: the top 10% of yields and the outer 8% of concentrations."""
+    outlier_mask_y = percentile_threshold(crop_yield, lower_percentile=0, upper_percentile=90)
+    outlier_mask_x = percentile_threshold(nutrient_conc, lower_percentile=8, upper_percentile=92)
+    return np.logical_or(outlier_mask_y, outlier_mask_x)
+
+
 def get_nutrient_ranges(*, nutrient_range_data: pd.DataFrame, crop: str, nutrient: str) -> dict[str, tuple[float, float]]:
     nutrient_range = nutrient_range_data[np.logical_and(nutrient_range_data['Kultur'] == crop, nutrient_range_data['id_element'] == nutrient)]
     result = {}
@@ -115,6 +348,48 @@ def get_nutrient_ranges(*, nutrient_range_data: pd.DataFrame, crop: str, nutrien
         result[row['Entwicklungsstadium']] = (row['min_labor'], row['max_labor'])
     return result
 
+def plot_sample_density(
+        ax: plt.Axes,
+        x: np.ndarray,
+        y: np.ndarray,
+        outliers: np.ndarray,
+        categories: tuple[np.ndarray, ...]) -> None:
+    """
+    Draw the samples as counts per raster cell, the inliers in grey and the
+    outliers in red, and outline the cells holding samples of every category.
+    The histograms take one pass over the samples, the drawing does not depend
+    on their number.
+    """
+    x_edges = np.linspace(x.min(), x.max(), DENSITY_BINS[0] + 1)
+    y_edges = np.linspace(y.min(), y.max(), DENSITY_BINS[1] + 1)
+
+    def counts(mask: np.ndarray) -> np.ndarray:
+        return np.histogram2d(x[mask], y[mask], bins=(x_edges, y_edges))[0].T
+
+    inlier_counts, outlier_counts = counts(~outliers), counts(outliers)
+    norm = LogNorm(vmin=1, vmax=max(inlier_counts.max(), outlier_counts.max(), 1))
+    mesh = ax.pcolormesh(
+        x_edges, y_edges, np.ma.masked_equal(inlier_counts, 0), cmap='Greys', norm=norm, rasterized=True)
+    ax.pcolormesh(
+        x_edges, y_edges, np.ma.masked_equal(outlier_counts, 0), cmap='Reds', norm=norm, alpha=.6, rasterized=True)
+    ax.figure.colorbar(mesh, ax=ax, label='Proben je Zelle', location='left', pad=.12)
+
+    # outlines on a coarser raster, so that single empty cells leave no holes
+    x_outline = np.linspace(x.min(), x.max(), DENSITY_BINS[0] // OUTLINE_COARSENING + 1)
+    y_outline = np.linspace(y.min(), y.max(), DENSITY_BINS[1] // OUTLINE_COARSENING + 1)
+    # cell centres with an empty cell on every side, so that outlines are closed at the edges
+    x_centres = np.concatenate([[x_outline[0]], (x_outline[1:] + x_outline[:-1]) / 2, [x_outline[-1]]])
+    y_centres = np.concatenate([[y_outline[0]], (y_outline[1:] + y_outline[:-1]) / 2, [y_outline[-1]]])
+    for (category_label, _, linestyle), mask in zip(SAMPLE_CATEGORIES, categories):
+        occupied = np.histogram2d(x[mask], y[mask], bins=(x_outline, y_outline))[0].T > 0
+        if occupied.any():
+            ax.contour(
+                x_centres, y_centres, np.pad(occupied, 1).astype(float), levels=[.5], colors='k', linestyles=linestyle)
+        # empty artists carry the legend entries
+        ax.plot([], [], color='k', linestyle=linestyle, label=f'{category_label} ({mask.sum()})')
+    ax.fill([], [], color='tab:red', alpha=.6, label=f'Ausreißer ({outliers.sum()})')
+
+
 def plot_curves(
         *,
         crop_yield: np.ndarray,
@@ -124,7 +399,9 @@ def plot_curves(
         crop_name: str,
         nutrient_info: tuple[str,str, str],
         stages: tuple[str, ...],
-        nutrient_range: tuple[float, float]
+        nutrient_range: tuple[float, float],
+        method: str = 'multi-start',
+        density_threshold: int = DENSITY_THRESHOLD
         ):
     
     if len(crop_yield) < 1:
@@ -137,24 +414,25 @@ def plot_curves(
     crop_yield_valid, nutrient_conc_valid = np.stack([crop_yield, nutrient_conc])[:, ~nan_mask]
     versuch_valid = versuch[~nan_mask]
     oeko_valid = oeko[~nan_mask]
-    outlier_mask_y = percentile_threshold(crop_yield_valid, lower_percentile=0, upper_percentile=90)    
-    outlier_mask_x = percentile_threshold(nutrient_conc_valid, lower_percentile=8, upper_percentile=92)
-    outlier_masks_combined = np.logical_or(outlier_mask_y, outlier_mask_x)
+    outlier_masks_combined = outlier_mask(nutrient_conc_valid, crop_yield_valid)
     
     crop_yield_inliers, nutrient_conc_inliers = np.stack([crop_yield_valid, nutrient_conc_valid])[:, ~outlier_masks_combined]
     crop_yield_outliers, nutrient_conc_outliers = np.stack([crop_yield_valid, nutrient_conc_valid])[:, outlier_masks_combined]
-    parameters = fit_curve(nutrient_conc_inliers, crop_yield_inliers)
+    parameters, diagnostics = fit_boundary(nutrient_conc_inliers, crop_yield_inliers, method)
 
     # Diagramm erstellen
     fig, ax = plt.subplots(figsize=(9, 6))
     # todo: break down the plotted data by origin
 
     konv_valid = np.logical_and(np.logical_not(versuch_valid), np.logical_not(oeko_valid))
+    categories = (konv_valid, oeko_valid.astype(bool), versuch_valid.astype(bool))
 
-    ax.scatter(nutrient_conc_valid[konv_valid], crop_yield_valid[konv_valid], label='on-farm konv.', marker='o', color='gray')
-    ax.scatter(nutrient_conc_valid[oeko_valid], crop_yield_valid[oeko_valid], label='on-farm öko', marker='*', color='gray')
-    ax.scatter(nutrient_conc_valid[versuch_valid], crop_yield_valid[versuch_valid], label='Versuchsfläche', marker='^', color='gray')
-    ax.scatter(nutrient_conc_outliers, crop_yield_outliers, label="Ausreißer", marker='x', facecolor=None, s=100)
+    if len(crop_yield_valid) > density_threshold:
+        plot_sample_density(ax, nutrient_conc_valid, crop_yield_valid, outlier_masks_combined, categories)
+    else:
+        for (category_label, marker, _), mask in zip(SAMPLE_CATEGORIES, categories):
+            ax.scatter(nutrient_conc_valid[mask], crop_yield_valid[mask], label=category_label, marker=marker, color='gray')
+        ax.scatter(nutrient_conc_outliers, crop_yield_outliers, label="Ausreißer", marker='x', facecolor=None, s=100)
 
     x_spline = np.linspace(nutrient_conc_inliers.min(), nutrient_conc_inliers.max(), 100)
     y_spline = spline(
@@ -169,12 +447,9 @@ def plot_curves(
         linewidth=4, 
         linestyle='-',
         label=fill(label, text_width))
-    # normalize to 0 and 1
-    y_spline_normed = (y_spline - y_spline.min()) / (y_spline.max() - y_spline.min())
-
     try:
-        new_range = x_spline[np.where(y_spline_normed > .9)[0][[0, -1]]]
-    except IndexError:
+        new_range = target_range(parameters, x_spline[0], x_spline[-1])
+    except ValueError:
         raise ValueError(f'Catastrophic curve fit, aborting plotting for {crop_name}, {nutrient_info[0]}')
     label = f'ANAPLANT-Zielwertbereich für {nutrient_info[0]} in {crop_name}, abgeleitet mit Hilfe einer Hüllkurve (Heym und Schnug, 1995, verändert): {new_range[0]:0.2f} - {new_range[1]:0.2f} {nutrient_info[2]}'
     ax.plot(
@@ -193,6 +468,6 @@ def plot_curves(
         ylabel=f"Ertrag in {yield_unit}",
     )
     plt.tight_layout()
-    return fig, new_range
+    return fig, new_range, diagnostics
 
 
@@ -0,0 +1,245 @@
+"""
+Lese ANAPLANT-Datensätze als polars LazyFrames.
+
+Exports from several federal states and years are scanned instead of loaded, so
+that the statistics can run on polars' streaming engine with bounded memory.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Sequence
+
+import polars as pl
+
+import anaplant.apply_types as apply_types
+import anaplant.records as records
+
+YIELD_CSV_SEPARATOR = ';'
+YIELD_CSV_ENCODING = 'ISO8859-1'
+SUPPORTED_SUFFIXES = ('.csv', '.parquet', '.xlsx')
+PARTITION_KEYS = ('kultur', 'saison')
+PARTITION_SCHEMA = pl.Schema({'kultur': pl.String, 'saison': pl.Int32})
+# column order of the ANAPLANT export, see data/README.md
+YIELD_COLUMNS = (
+    'lab name', 'lab_nr', 'probenahme', 'versuchsfläche', 'gps_lat', 'gps_lon',
+    'bodenklimaraum', 'bodengruppe', 'kultur', 'sorte', 'öko/konv', 'ertrag (dt/ha)',
+    'rohprotein (% TS)', 'stärke (%)', 'zucker (% TS)', 'öl (%)', 'bewässerung',
+    'besonderheiten', 'dat_saat', 'dat_ernte', 'entwicklungsstadium',
+    'd_org', 'd_n', 'd_p2o5', 'd_k2o', 'd_mgo', 'd_cao', 'd_s', 'd_b', 'd_mn', 'd_cu',
+    'd_zn', 'd_fe', 'dat_düng', 'anm_dgg',
+    'p_n', 'p_ca', 'p_p', 'p_k', 'p_mg', 'p_na', 'p_s', 'p_b', 'p_mn', 'p_cu', 'p_zn',
+    'p_fe', 'p_mo', 'p_al', 'p_co', 'p_se', 'p_si', 'p_c', 'p_c_n', 'p_n_s', 'p_ts',
+    'ph_wert', 'b_n', 'b_p', 'b_k', 'b_mg', 'b_ca', 'b_b', 'b_mn', 'b_cu', 'b_zn', 'b_fe',
+    'b_c_n', 'b_c', 'b_humus', 'station_id', 'station_name', 'station_lat', 'station_lon',
+)
+# crops which some commands merge into one, e.g. Körnererbse is evaluated as Erbse
+MERGED_CROPS: dict[str, tuple[str, ...]] = {
+    'Erbse': ('Körnererbse',),
+    'Mais': ('Körnermais', 'Silomais'),
+}
+
+
+def expand_sources(source: str | Sequence[str]) -> list[Path]:
+    """Expand files, directories and glob patterns into a sorted list of files."""
+    sources = (source,) if isinstance(source, (str, Path)) else tuple(source)
+    files: list[Path] = []
+    for entry in sources:
+        path = Path(entry)
+        if path.is_dir():
+            files.extend(p for p in path.rglob('*') if p.suffix in SUPPORTED_SUFFIXES)
+        elif any(c in str(entry) for c in '*?['):
+            files.extend(Path(p) for p in sorted(Path().glob(str(entry))))
+        else:
+            files.append(path)
+    if not files:
+        raise ValueError(f'No yield data found in {source}.')
+    return sorted(files)
+
+
+def utf8_source(path: str | Path, encoding: str = YIELD_CSV_ENCODING) -> Path:
+    """
+    Return a UTF-8 copy of a text file, transcoding it chunk-wise into the temp directory.
+    The copy is keyed by path, size and modification time and reused by later calls.
+    """
+    path = Path(path)
+    if encoding.lower().replace('-', '') in ('utf8', 'ascii'):
+        return path
+    stat = path.stat()
+    key = f'{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}:{encoding}'
+    target = Path(tempfile.gettempdir()) / 'anaplant' / f'{hashlib.sha1(key.encode()).hexdigest()}.csv'
+    if not target.exists():
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # write to a private file first so concurrent jobs never see a partial copy
+        fd, tmp_name = tempfile.mkstemp(dir=target.parent, suffix='.part')
+        with open(path, mode='r', encoding=encoding, newline='') as fh_in:
+            with open(fd, mode='w', encoding='UTF-8', newline='') as fh_out:
+                shutil.copyfileobj(fh_in, fh_out, length=1 << 20)
+        os.replace(tmp_name, target)
+    return target
+
+
+def scan_csv(path: str | Path, encoding: str = YIELD_CSV_ENCODING, typed: bool = True) -> pl.LazyFrame:
+    """Scan an ANAPLANT csv export (semicolon separated, decimal comma) as typed LazyFrame, or as strings."""
+    lf = pl.scan_csv(
+        utf8_source(path, encoding),
+        separator=YIELD_CSV_SEPARATOR,
+        infer_schema=False)
+    return apply_types.types(lf) if typed else lf
+
+
+def read_excel(path: str | Path) -> pl.DataFrame:
+    """
+    Read the first sheet of a workbook with every column as string. Numeric cells
+    are written with a decimal point, date cells as "2022-06-20".
+    """
+    d = pl.read_excel(path, engine='calamine', infer_schema_length=0)
+    # date cells are returned as "2022-06-20 00:00:00"
+    return d.with_columns(pl.col(pl.String).str.strip_suffix(' 00:00:00'))
+
+
+def is_partitioned(path: str | Path) -> bool:
+    """Check whether a path is a dataset written by `write_partitioned`."""
+    path = Path(path)
+    return path.is_dir() and any(
+        child.is_dir() and child.name.startswith(f'{PARTITION_KEYS[0]}=') for child in path.iterdir())
+
+
+def scan_partitioned(path: str | Path) -> pl.LazyFrame:
+    """
+    Scan a hive partitioned dataset.
+    Filters on kultur and saison skip whole directories, filters on other columns
+    skip row groups based on the parquet statistics.
+    """
+    return pl.scan_parquet(
+        path,
+        hive_partitioning=True,
+        hive_schema=PARTITION_SCHEMA,
+        use_statistics=True)
+
+
+def scan_yield_data(source: str | Sequence[str], encoding: str = YIELD_CSV_ENCODING) -> pl.LazyFrame:
+    """
+    Scan one or many yield data files (csv, parquet or xlsx), partitioned datasets or
+    record stores as one typed LazyFrame. Columns missing in some of the sources are filled with nulls.
+    """
+    sources = (source,) if isinstance(source, (str, Path)) else tuple(source)
+    frames = []
+    for entry in sources:
+        if is_partitioned(entry):
+            frames.append(scan_partitioned(entry))
+        elif records.is_record_store(entry):
+            frames.append(records.scan_records(entry))
+        else:
+            frames.extend(_scan_files(expand_sources(entry), encoding))
+    if len(frames) == 1:
+        return frames[0]
+    return pl.concat(frames, how='diagonal_relaxed')
+
+
+def scan_untyped_sources(
+        source: str | Sequence[str],
+        encoding: str = YIELD_CSV_ENCODING) -> list[tuple[str, pl.LazyFrame, bool | None]]:
+    """
+    The sources of `scan_yield_data` one by one, csv exports and workbooks with
+    every column as string, together with their decimal convention. Parquet
+    files, partitioned datasets and record stores are typed already, their
+    convention is None.
+    """
+    sources = (source,) if isinstance(source, (str, Path)) else tuple(source)
+    scans = []
+    for entry in sources:
+        if is_partitioned(entry):
+            scans.append((str(entry), scan_partitioned(entry), None))
+        elif records.is_record_store(entry):
+            scans.append((str(entry), records.scan_records(entry), None))
+        else:
+            for path in expand_sources(entry):
+                if path.suffix == '.parquet':
+                    scans.append((str(path), pl.scan_parquet(path), None))
+                elif path.suffix == '.xlsx':
+                    scans.append((str(path), read_excel(path).lazy(), False))
+                else:
+                    scans.append((str(path), scan_csv(path, encoding, typed=False), True))
+    return scans
+
+
+def _scan_files(paths: Sequence[Path], encoding: str) -> list[pl.LazyFrame]:
+    frames = []
+    for path in paths:
+        if path.suffix == '.parquet':
+            frames.append(pl.scan_parquet(path))
+        elif path.suffix == '.xlsx':
+            # excel workbooks cannot be scanned, they are small enough to be read eagerly
+            frames.append(apply_types.types(read_excel(path).lazy(), decimal_comma=False))
+        else:
+            frames.append(scan_csv(path, encoding))
+    return frames
+
+
+def select_crops(lf: pl.LazyFrame, crops: Sequence[str] | None) -> pl.LazyFrame:
+    """
+    Keep the samples of the given crops, including the crops merged into them.
+    Applied before any renaming of kultur, so the filter prunes partitions.
+    """
+    if not crops:
+        return lf
+    names = set(crops)
+    for crop in crops:
+        names.update(MERGED_CROPS.get(crop, ()))
+    return lf.filter(pl.col('kultur').is_in(sorted(names)))
+
+
+def add_season(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Add the growing season as year of the sample collection."""
+    return lf.with_columns(saison=pl.col('probenahme').dt.year().cast(pl.Int32))
+
+
+def write_partitioned(lf: pl.LazyFrame, dest_path: str | Path, *, overwrite: bool = False) -> None:
+    """
+    Write a typed dataset as parquet, partitioned by kultur and saison.
+    The dataset is written next to its destination and moved in place at the end,
+    so jobs reading the destination never see a partially written dataset.
+    """
+    dest_path = Path(dest_path)
+    if dest_path.exists() and not overwrite:
+        raise ValueError(f'{dest_path} already exists. Pass overwrite to replace it.')
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(dir=dest_path.parent, prefix=f'.{dest_path.name}-'))
+    if 'saison' not in lf.collect_schema().names():
+        lf = add_season(lf)
+    lf.with_columns(pl.col('saison').cast(pl.Int32)).sink_parquet(
+        pl.PartitionBy(tmp_path, key=list(PARTITION_KEYS)),
+        statistics=True,
+        mkdir=True,
+        engine='streaming')
+    if dest_path.exists():
+        old_path = dest_path.with_name(f'.{dest_path.name}-old')
+        os.replace(dest_path, old_path)
+        os.replace(tmp_path, dest_path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, dest_path)
+
+
+def collect(lf: pl.LazyFrame) -> pl.DataFrame:
+    """Collect a query on the streaming engine."""
+    return lf.collect(engine='streaming')
+
+
+def add_norm_ert(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Normalisiere den Ertrag je Kultur.
+    Same formula as `top_percentile.aufbereiten`, computed as group_by + join so it streams.
+    """
+    ertrag = pl.col('ertrag (dt/ha)')
+    per_kultur = lf.group_by('kultur').agg(
+        _max_ert=ertrag.max(),
+        _count_ert=ertrag.count())
+    return (
+        lf.join(per_kultur, on='kultur', how='left', nulls_equal=True, maintain_order='left')
+        .with_columns(
+            norm_ert=ertrag / (pl.col('_max_ert') * (1 + 0.5 / pl.col('_count_ert'))))
+        .drop('_max_ert', '_count_ert'))
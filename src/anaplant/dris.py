@@ -0,0 +1,172 @@
+"""
+Berechne DRIS- und CND-Indizes.
+
+Norms are derived from the high-yield subpopulation (top 20% of norm_ert, as in
+anaplant.top_percentile) of every crop and stage. DRIS uses the logarithms of
+all nutrient ratios, which are the differences of the columns of the log
+concentration matrix, so all ratios of all samples are one broadcast of shape
+(samples, nutrients, nutrients). CND uses the centred log-ratios of the
+composition including a filler value for the rest of the dry matter.
+"""
+
+from typing import NamedTuple, Sequence
+
+import numpy as np
+import polars as pl
+
+from anaplant import NUTRIENT_INFO
+
+DRIS_NUTRIENTS = tuple(
+    k for k, (name, _, _) in NUTRIENT_INFO.items() if k.startswith('p_') and name != 'FILLER')
+# conversion of the units in NUTRIENT_INFO to percent of the dry matter
+PERCENT_PER_UNIT = {'% TS': 1.0, 'ppm': 1e-4}
+# high-yield samples required for the norms of a stage, otherwise the crop norms are used
+MIN_NORM_SAMPLES = 8
+FILLER = 'rest'
+SAMPLE_COLUMNS = ('lab name', 'lab_nr', 'probenahme', 'kultur', 'entwicklungsstadium')
+
+
+class Norms(NamedTuple):
+    """Norms of one crop and stage."""
+    # mean, standard deviation and count of ln(a/b), indexed [a, b]
+    ratio_mean: np.ndarray
+    ratio_std: np.ndarray
+    ratio_count: np.ndarray
+    # mean and standard deviation of the centred log-ratios, the filler last
+    clr_mean: np.ndarray
+    clr_std: np.ndarray
+    samples: int
+
+
+def log_concentrations(d: pl.DataFrame, nutrients: Sequence[str]) -> np.ndarray:
+    """Natural logarithm of the concentrations in % TS, nan for missing or non-positive values."""
+    percent = d.select(
+        pl.col(n).cast(pl.Float64) * PERCENT_PER_UNIT[NUTRIENT_INFO[n][2]] for n in nutrients
+    ).to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(percent > 0, np.log(percent), np.nan)
+
+
+def centred_log_ratios(log_values: np.ndarray) -> np.ndarray:
+    """Centred log-ratios of the nutrients and the filler, nan unless all nutrients are known."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        filler = np.log(100 - np.exp(log_values).sum(axis=1))
+    composition = np.column_stack([log_values, filler])
+    return composition - composition.mean(axis=1, keepdims=True)
+
+
+def _mean_std(values: np.ndarray, axis: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Mean, sample standard deviation and count ignoring nan, without warnings for empty slices."""
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, values, 0).sum(axis=axis) / count
+        squares = np.where(valid, (values - np.expand_dims(mean, axis)) ** 2, 0).sum(axis=axis)
+        std = np.sqrt(squares / (count - 1))
+    return mean, std, count
+
+
+def high_yield(norm_ert: np.ndarray, top_fraction: float) -> np.ndarray:
+    """Mask of the top_fraction of the samples by norm_ert, ties keep the first sample."""
+    known = np.flatnonzero(~np.isnan(norm_ert))
+    n = round(len(known) * top_fraction)
+    order = known[np.argsort(-norm_ert[known], kind='stable')]
+    mask = np.zeros(len(norm_ert), dtype=bool)
+    mask[order[:n]] = True
+    return mask
+
+
+def derive_norms(log_values: np.ndarray, min_samples: int = MIN_NORM_SAMPLES) -> Norms:
+    """Norms of a high-yield subpopulation; ratios known for fewer than min_samples samples are nan."""
+    ratios = log_values[:, :, None] - log_values[:, None, :]
+    mean, std, count = _mean_std(ratios, axis=0)
+    unusable = (count < min_samples) | ~(std > 0)
+    clr_mean, clr_std, clr_count = _mean_std(centred_log_ratios(log_values), axis=0)
+    clr_unusable = (clr_count < min_samples) | ~(clr_std > 0)
+    return Norms(
+        ratio_mean=np.where(unusable, np.nan, mean),
+        ratio_std=np.where(unusable, np.nan, std),
+        ratio_count=count,
+        clr_mean=np.where(clr_unusable, np.nan, clr_mean),
+        clr_std=np.where(clr_unusable, np.nan, clr_std),
+        samples=len(log_values))
+
+
+def dris_indices(log_values: np.ndarray, norms: Norms) -> tuple[np.ndarray, np.ndarray]:
+    """
+    DRIS index of every nutrient and the nutrient balance index of every sample.
+    With log ratios f(b/a) = -f(a/b), so the index of a is the mean standardized
+    deviation of ln(a/b) over all nutrients b with a norm.
+    """
+    ratios = log_values[:, :, None] - log_values[:, None, :]
+    deviation = (ratios - norms.ratio_mean) / norms.ratio_std
+    valid = ~np.isnan(deviation)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        indices = np.where(valid, deviation, 0).sum(axis=2) / valid.sum(axis=2)
+    balance = np.where(np.isnan(indices).all(axis=1), np.nan, np.nansum(np.abs(indices), axis=1))
+    return indices, balance
+
+
+def cnd_indices(log_values: np.ndarray, norms: Norms) -> tuple[np.ndarray, np.ndarray]:
+    """CND index of every nutrient and the filler, and the imbalance r² of every sample."""
+    indices = (centred_log_ratios(log_values) - norms.clr_mean) / norms.clr_std
+    r2 = (indices ** 2).sum(axis=1)
+    return indices, r2
+
+
+def norms_table(kultur: str, stadium: str, norms: Norms, nutrients: Sequence[str]) -> pl.DataFrame:
+    """Ratio norms as rows of Zähler, Nenner, mean and std, every unordered pair once."""
+    a, b = np.triu_indices(len(nutrients), k=1)
+    return pl.DataFrame({
+        'Kultur': kultur,
+        'Entwicklungsstadium': stadium,
+        'Zähler': np.array(nutrients)[a],
+        'Nenner': np.array(nutrients)[b],
+        'Anzahl': norms.ratio_count[a, b],
+        'mean': norms.ratio_mean[a, b],
+        'std': norms.ratio_std[a, b],
+    }).filter(pl.col('mean').is_not_nan())
+
+
+def score(
+        data: pl.DataFrame,
+        nutrients: Sequence[str] = DRIS_NUTRIENTS,
+        top_fraction: float = 0.2,
+        min_samples: int = MIN_NORM_SAMPLES) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Derive the norms of every crop and stage and score every sample with them.
+    Expects the output of `top_percentile.aufbereiten_lazy`. Returns the ratio
+    norms and the indices, in the order of data.
+    """
+    data = data.with_row_index('_row').filter(pl.col('kultur').is_not_null())
+    norm_rows, frames = [], []
+    for (kultur,), crop in data.partition_by('kultur', as_dict=True, maintain_order=True).items():
+        log_values = log_concentrations(crop, nutrients)
+        norm_ert = crop['norm_ert'].cast(pl.Float64).fill_null(np.nan).to_numpy()
+        stadium = crop['entwicklungsstadium'].fill_null('gesamt').to_numpy()
+        crop_norms = derive_norms(log_values[high_yield(norm_ert, top_fraction)], min_samples)
+        norm_rows.append(norms_table(kultur, 'gesamt', crop_norms, nutrients))
+        norm_used = np.full(len(crop), 'gesamt', dtype=object)
+        dris = np.full((len(crop), len(nutrients)), np.nan)
+        cnd = np.full((len(crop), len(nutrients) + 1), np.nan)
+        nbi, r2 = np.full(len(crop), np.nan), np.full(len(crop), np.nan)
+        for value in np.unique(stadium):
+            rows = np.flatnonzero(stadium == value)
+            top = high_yield(norm_ert[rows], top_fraction)
+            norms = crop_norms
+            if value != 'gesamt' and top.sum() >= min_samples:
+                norms = derive_norms(log_values[rows][top], min_samples)
+                norm_rows.append(norms_table(kultur, value, norms, nutrients))
+                norm_used[rows] = value
+            dris[rows], nbi[rows] = dris_indices(log_values[rows], norms)
+            cnd[rows], r2[rows] = cnd_indices(log_values[rows], norms)
+        frames.append(pl.concat([
+            crop.select('_row', *SAMPLE_COLUMNS),
+            pl.DataFrame({'dris_norm': norm_used.astype(str)}),
+            pl.DataFrame(dris, schema=[f'dris_{n}' for n in nutrients]),
+            pl.DataFrame({'dris_nbi': nbi}),
+            pl.DataFrame(cnd, schema=[f'cnd_{n}' for n in (*nutrients, FILLER)]),
+            pl.DataFrame({'cnd_r2': r2}),
+        ], how='horizontal'))
+    scores = pl.concat(frames).sort('_row').drop('_row').fill_nan(None)
+    return pl.concat(norm_rows), scores
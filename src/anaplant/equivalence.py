@@ -0,0 +1,244 @@
+"""
+Vergleiche das Paket mit den ursprünglichen Skripten.
+
+The scripts in external/ are the reference the package was ported from. Every
+comparison runs a legacy function and its package counterpart on copies of the
+same input and diffs the numeric columns of their tables, matched on key
+columns, within a tolerance. Keys found on one side only are counted, e.g. the
+legacy Mais rows, which the package keeps as Körnermais and Silomais.
+
+Runtime is the best of several runs. Peak memory is measured in a separate run
+with tracemalloc, which slows down Python code; it covers numpy and pandas
+allocations but not the memory polars allocates outside of Python.
+"""
+
+import importlib.util
+import time
+import tracemalloc
+from pathlib import Path
+from types import ModuleType
+from typing import Callable, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+import anaplant.curves as curves
+import anaplant.dataset as dataset
+import anaplant.top_percentile as top_percentile
+import anaplant.years as years
+import polars as pl
+
+LEGACY_SCRIPTS = ('top20', 'jahre', 'kurven', 'kurven_stadien')
+ATOL = 1e-4
+RTOL = 1e-6
+CURVE_COLUMNS = ['y_max', 'x_max', 'a_l', 'a_r']
+DIFFERENCE_COLUMNS = ['vergleich', 'spalte', 'verglichen', 'abweichend', 'max_abweichung']
+SUMMARY_COLUMNS = [
+    'vergleich',
+    'gemeinsam',
+    'nur_legacy',
+    'nur_paket',
+    'abweichend',
+    'zeit_legacy_s',
+    'zeit_paket_s',
+    'speicher_legacy_mib',
+    'speicher_paket_mib',
+]
+
+
+class Comparison(NamedTuple):
+    name: str
+    keys: list[str]
+    legacy: Callable[[pd.DataFrame], pd.DataFrame]
+    package: Callable[[pd.DataFrame], pd.DataFrame]
+
+
+class Measurement(NamedTuple):
+    result: pd.DataFrame
+    seconds: float
+    peak_bytes: int
+
+
+def load_legacy(path: str | Path, name: str) -> ModuleType:
+    """Import a legacy script by file name, without running its main."""
+    file = Path(path) / f'{name}.py'
+    spec = importlib.util.spec_from_file_location(f'anaplant_legacy_{name}', file)
+    if spec is None or spec.loader is None:
+        raise ValueError(f'Cannot import {file}.')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(function: Callable[[pd.DataFrame], pd.DataFrame], data: pd.DataFrame, repeat: int = 1) -> Measurement:
+    """Best runtime of repeat runs and the peak of traced memory of one more run, each on a fresh copy."""
+    seconds = np.inf
+    for _ in range(repeat):
+        copy = data.copy()
+        start = time.perf_counter()
+        result = function(copy)
+        seconds = min(seconds, time.perf_counter() - start)
+    copy = data.copy()
+    tracemalloc.start()
+    try:
+        function(copy)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Measurement(result, seconds, peak)
+
+
+def diff(
+        name: str,
+        legacy: pd.DataFrame,
+        package: pd.DataFrame,
+        keys: list[str],
+        atol: float = ATOL,
+        rtol: float = RTOL) -> tuple[pd.DataFrame, dict]:
+    """Differences of the shared numeric columns on the shared keys; missing values equal each other."""
+    merged = legacy.merge(package, on=keys, how='outer', suffixes=('_legacy', '_paket'), indicator=True)
+    common = merged[merged['_merge'] == 'both']
+    columns = [
+        c for c in legacy.columns
+        if c in package.columns and c not in keys
+        and pd.api.types.is_numeric_dtype(legacy[c]) and pd.api.types.is_numeric_dtype(package[c])]
+    rows = []
+    differing = np.zeros(len(common), dtype=bool)
+    for column in columns:
+        a = common[f'{column}_legacy'].to_numpy(dtype=float)
+        b = common[f'{column}_paket'].to_numpy(dtype=float)
+        both_missing = np.isnan(a) & np.isnan(b)
+        with np.errstate(invalid='ignore'):
+            deviation = np.where(both_missing, 0, np.abs(a - b))
+            outside = ~both_missing & ~(deviation <= atol + rtol * np.abs(b))
+        differing |= outside
+        rows.append([
+            name, column, len(common), int(outside.sum()),
+            float(np.nanmax(deviation, initial=0)) if len(common) else 0.0])
+    counts = {
+        'gemeinsam': len(common),
+        'nur_legacy': int((merged['_merge'] == 'left_only').sum()),
+        'nur_paket': int((merged['_merge'] == 'right_only').sum()),
+        'abweichend': int(differing.sum()),
+    }
+    return pd.DataFrame(rows, columns=DIFFERENCE_COLUMNS), counts
+
+
+def _package_top20(data: pd.DataFrame, label: pd.DataFrame) -> pd.DataFrame:
+    lf = top_percentile.aufbereiten_lazy(pl.from_pandas(data).lazy())
+    return dataset.collect(top_percentile.get_top20_lazy(lf, label)).to_pandas()
+
+
+def _package_years(data: pd.DataFrame, label: pd.DataFrame) -> pd.DataFrame:
+    lf = years.aufbereiten_lazy(pl.from_pandas(data).lazy())
+    return dataset.collect(years.get_top20_lazy(lf, label)).to_pandas()
+
+
+def _package_curves(
+        data: pd.DataFrame,
+        label: pd.DataFrame,
+        y_column: str,
+        crops: list[str],
+        by_stage: bool) -> pd.DataFrame:
+    """Boundary line parameters of the groups the legacy calc_curves fits, with `curves.fit_curve`."""
+    rows = []
+    for kultur in crops:
+        data_kultur = data[data['kultur'] == kultur]
+        stages = data_kultur['entwicklungsstadium'].unique() if by_stage else [None]
+        for stadium in stages:
+            group = data_kultur if stadium is None else data_kultur[data_kultur['entwicklungsstadium'] == stadium]
+            for col in label.index:
+                d = group[[y_column, col]].dropna()
+                if d.empty:
+                    continue
+                try:
+                    parameters = curves.fit_curve(d[col].to_numpy(dtype=float), d[y_column].to_numpy(dtype=float))
+                except ValueError:
+                    continue
+                rows.append([kultur, *([stadium] if by_stage else []), col, *parameters])
+    keys = ['Kultur', 'Stadium', 'id_element'] if by_stage else ['Kultur', 'id_element']
+    return pd.DataFrame(rows, columns=keys + CURVE_COLUMNS)
+
+
+def comparisons(legacy_path: str | Path, label: pd.DataFrame) -> list[Comparison]:
+    """The legacy scripts next to the package functions they were ported to."""
+    modules = {name: load_legacy(legacy_path, name) for name in LEGACY_SCRIPTS}
+
+    def legacy_top20(data: pd.DataFrame) -> pd.DataFrame:
+        modules['top20'].aufbereiten(data)
+        return modules['top20'].get_top20(data, label)
+
+    def legacy_years(data: pd.DataFrame) -> pd.DataFrame:
+        modules['jahre'].aufbereiten(data)
+        return modules['jahre'].get_top20(data, label)
+
+    def legacy_curves(data: pd.DataFrame) -> pd.DataFrame:
+        return modules['kurven'].calc_curves(data, label)
+
+    def legacy_stage_curves(data: pd.DataFrame) -> pd.DataFrame:
+        modules['kurven_stadien'].aufbereiten(data)
+        return modules['kurven_stadien'].calc_curves(data, label)
+
+    def package_stage_curves(data: pd.DataFrame) -> pd.DataFrame:
+        # adds norm_ert, the renamed Körnererbse is none of the fitted crops
+        top_percentile.aufbereiten(data)
+        return _package_curves(
+            data, label, 'norm_ert', ['Winterweizen', 'Winterraps', 'Körnermais', 'Silomais'], by_stage=True)
+
+    return [
+        Comparison(
+            'top20', ['Kultur', 'Entwicklungsstadium', 'id_element'],
+            legacy_top20, lambda data: _package_top20(data, label)),
+        Comparison(
+            'jahre', ['Kultur', 'Entwicklungsstadium', 'id_element'],
+            legacy_years, lambda data: _package_years(data, label)),
+        Comparison(
+            'kurven', ['Kultur', 'id_element'],
+            legacy_curves,
+            lambda data: _package_curves(
+                data, label, 'ertrag (dt/ha)', list(data['kultur'].unique()), by_stage=False)),
+        Comparison(
+            'kurven_stadien', ['Kultur', 'Stadium', 'id_element'],
+            legacy_stage_curves, package_stage_curves),
+    ]
+
+
+def prepare(data: pl.DataFrame, legacy_path: str | Path, label: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """
+    Inputs of the comparisons. The curve scripts drop concentrations above
+    mean + 4 std before fitting; this preprocessing is applied for both sides.
+    """
+    if 'jahr' not in data.columns:
+        data = data.with_columns(jahr=pl.col('probenahme').dt.year() - years.FIRST_SEASON + 1)
+    frame = data.to_pandas()
+    inputs = {'top20': frame, 'jahre': frame}
+    for name in ('kurven', 'kurven_stadien'):
+        filtered = frame.copy()
+        load_legacy(legacy_path, name).remove_high_values(filtered, label)
+        inputs[name] = filtered
+    return inputs
+
+
+def run(
+        data: pl.DataFrame,
+        legacy_path: str | Path,
+        label: pd.DataFrame,
+        repeat: int = 1,
+        atol: float = ATOL,
+        rtol: float = RTOL,
+        only: tuple[str, ...] = ()) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Run all comparisons. Returns the summary and the differences per column."""
+    inputs = prepare(data, legacy_path, label)
+    summary, differences = [], []
+    for comparison in comparisons(legacy_path, label):
+        if only and comparison.name not in only:
+            continue
+        legacy = measure(comparison.legacy, inputs[comparison.name], repeat)
+        package = measure(comparison.package, inputs[comparison.name], repeat)
+        columns, counts = diff(comparison.name, legacy.result, package.result, comparison.keys, atol, rtol)
+        differences.append(columns)
+        summary.append([
+            comparison.name, *counts.values(),
+            round(legacy.seconds, 3), round(package.seconds, 3),
+            round(legacy.peak_bytes / 2 ** 20, 1), round(package.peak_bytes / 2 ** 20, 1)])
+    return pd.DataFrame(summary, columns=SUMMARY_COLUMNS), pd.concat(differences, ignore_index=True)
@@ -0,0 +1,198 @@
+"""
+Vergleiche Verfahren zur Ableitung von Zielwertbereichen.
+
+Target ranges from the top 20% (anaplant.top_percentile) and from boundary
+lines (anaplant.curves) are derived on the training folds of every crop, stage
+and nutrient and checked on the held out samples, next to the literature
+ranges. A good range holds the high-yield samples and excludes the others.
+Every group is sorted by yield once, so a fold only selects rows of the sorted
+arrays and the top 20% of a fold are its first training rows.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+import anaplant.curves as curves
+
+METHODS = ('literatur', 'top20', 'kurve')
+FOLDS = 5
+# samples of a group required for the cross-validation
+MIN_SAMPLES = 20
+# training samples required for a boundary line, as min_samples of plot-curves
+MIN_FIT_SAMPLES = 8
+TOP_FRACTION = 0.2
+EVALUATION_COLUMNS = [
+    'Kultur',
+    'Entwicklungsstadium',
+    'id_element',
+    'methode',
+    'Anzahl',
+    'folds_ohne_bereich',
+    'anteil_im_bereich',
+    'sensitivitaet',
+    'spezifitaet',
+    'balancierte_genauigkeit',
+    'ertrag_differenz',
+]
+
+
+class GroupData(NamedTuple):
+    """Samples of one crop, stage and nutrient, sorted by decreasing yield."""
+    kultur: str
+    stadium: str
+    element: str
+    x: np.ndarray
+    ertrag: np.ndarray
+    sites: np.ndarray
+    literatur: tuple[float, float] | None
+
+
+def group_data(data: pl.DataFrame, nutrients: list[str], literature: pl.DataFrame) -> list[GroupData]:
+    """Split data into sorted groups of at least MIN_SAMPLES samples with yield and concentration."""
+    has_sites = 'site_id' in data.columns
+    ranges = {
+        (row['Kultur'], row['Entwicklungsstadium'], row['id_element']): (row['min_labor'], row['max_labor'])
+        for row in literature.iter_rows(named=True)}
+    groups = []
+    stages = data.filter(pl.col('kultur').is_not_null() & pl.col('entwicklungsstadium').is_not_null())
+    for (kultur, stadium), stage in stages.partition_by(
+            'kultur', 'entwicklungsstadium', as_dict=True, maintain_order=True).items():
+        for element in nutrients:
+            d = (
+                stage.filter(pl.col(element).is_not_null() & pl.col('ertrag (dt/ha)').is_not_null())
+                .sort('ertrag (dt/ha)', descending=True, maintain_order=True))
+            if len(d) < MIN_SAMPLES:
+                continue
+            groups.append(GroupData(
+                kultur=kultur,
+                stadium=stadium,
+                element=element,
+                x=d[element].to_numpy(),
+                ertrag=d['ertrag (dt/ha)'].to_numpy(),
+                sites=d['site_id'].to_numpy() if has_sites else np.arange(len(d)),
+                literatur=ranges.get((kultur, stadium, element))))
+    return groups
+
+
+def folds(group: GroupData, k: int = FOLDS, leave_one_site_out: bool = False, seed: int = 0) -> list[np.ndarray]:
+    """Test masks of the folds; k-fold over sites, or one fold per site. Folds without training samples are left out."""
+    sites, codes = np.unique(group.sites, return_inverse=True)
+    if leave_one_site_out:
+        fold_of_site = np.arange(len(sites))
+    else:
+        fold_of_site = np.random.default_rng(seed).permutation(len(sites)) % k
+    fold = fold_of_site[codes]
+    return [fold == f for f in np.unique(fold) if not (fold == f).all()]
+
+
+def top20_range(x: np.ndarray) -> tuple[float, float]:
+    """Mean ± standard deviation of the top 20%, x sorted by decreasing yield."""
+    top = x[:round(len(x) * TOP_FRACTION)]
+    if len(top) < 2:
+        raise ValueError('Too few samples in the top 20%.')
+    mean, std = top.mean(), top.std(ddof=1)
+    return mean - std, mean + std
+
+
+def curve_range(x: np.ndarray, ertrag: np.ndarray, method: str) -> tuple[float, float]:
+    """Target range of the boundary line, derived as in `curves.plot_curves`."""
+    if len(x) < MIN_FIT_SAMPLES:
+        raise ValueError(f'Got {len(x)} samples, needed {MIN_FIT_SAMPLES} or more.')
+    inliers = ~curves.outlier_mask(x, ertrag)
+    parameters, _ = curves.fit_boundary(x[inliers], ertrag[inliers], method)
+    low, high = curves.target_range(parameters, x[inliers].min(), x[inliers].max())
+    return low, high
+
+
+def evaluate_fold(group: GroupData, test: np.ndarray, curve_method: str) -> dict[str, np.ndarray | None]:
+    """Whether the test samples lie in the range of every method, None if a method found no range."""
+    train = ~test
+    x_train, ertrag_train = group.x[train], group.ertrag[train]
+    ranges = {'literatur': group.literatur}
+    for method, derive in (
+            ('top20', lambda: top20_range(x_train)),
+            ('kurve', lambda: curve_range(x_train, ertrag_train, curve_method))):
+        try:
+            ranges[method] = derive()
+        except ValueError:
+            ranges[method] = None
+    x_test = group.x[test]
+    return {
+        method: None if r is None else (x_test >= r[0]) & (x_test <= r[1])
+        for method, r in ranges.items()}
+
+
+def _evaluate_task(task: tuple[GroupData, np.ndarray, str]) -> dict[str, np.ndarray | None]:
+    return evaluate_fold(*task)
+
+
+def scores(group: GroupData, test_masks: list[np.ndarray], results: list[dict]) -> list[list]:
+    """Pool the held out samples of all folds and score every method."""
+    rows = []
+    for method in METHODS:
+        inside, high, ertrag = [], [], []
+        missing = 0
+        for test, result in zip(test_masks, results):
+            if result[method] is None:
+                missing += 1
+                continue
+            # high yield relative to the training samples of the fold
+            threshold = np.quantile(group.ertrag[~test], 1 - TOP_FRACTION)
+            inside.append(result[method])
+            high.append(group.ertrag[test] >= threshold)
+            ertrag.append(group.ertrag[test])
+        if not inside:
+            continue
+        inside, high, ertrag = np.concatenate(inside), np.concatenate(high), np.concatenate(ertrag)
+        sensitivity = inside[high].mean() if high.any() else np.nan
+        specificity = (~inside[~high]).mean() if (~high).any() else np.nan
+        difference = ertrag[inside].mean() - ertrag[~inside].mean() if inside.any() and (~inside).any() else np.nan
+        rows.append([
+            group.kultur, group.stadium, group.element, method, len(inside), missing,
+            round(inside.mean(), 4), round(sensitivity, 4), round(specificity, 4),
+            round((sensitivity + specificity) / 2, 4), round(difference, 4)])
+    return rows
+
+
+def cross_validate(
+        groups: list[GroupData],
+        k: int = FOLDS,
+        leave_one_site_out: bool = False,
+        curve_method: str = 'multi-start',
+        workers: int | None = None) -> pd.DataFrame:
+    """
+    Kreuzvalidierung aller Gruppen. The folds of all groups are independent tasks
+    of a process pool, as the curve fits hold the GIL.
+    """
+    test_masks = [folds(g, k, leave_one_site_out) for g in groups]
+    tasks = [(g, test, curve_method) for g, masks in zip(groups, test_masks) for test in masks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = iter(pool.map(_evaluate_task, tasks, chunksize=8))
+        rows = [
+            row for g, masks in zip(groups, test_masks)
+            for row in scores(g, masks, [next(results) for _ in masks])]
+    return pd.DataFrame(rows, columns=EVALUATION_COLUMNS)
+
+
+def summary(evaluation: pd.DataFrame) -> pd.DataFrame:
+    """Mean scores of every method over the groups all methods could be evaluated in."""
+    complete = evaluation.groupby(['Kultur', 'Entwicklungsstadium', 'id_element'])['methode'].transform('nunique')
+    common = evaluation[complete == evaluation['methode'].nunique()]
+    return common.groupby('methode')[
+        ['anteil_im_bereich', 'sensitivitaet', 'spezifitaet', 'balancierte_genauigkeit', 'ertrag_differenz']
+    ].mean().round(4)
+
+
+def result_statistics(evaluation: pd.DataFrame) -> pl.DataFrame:
+    """Scores as rows of name and value for `results.record_run`, the name prefixed by the method."""
+    d = pl.from_pandas(evaluation).rename(
+        {'Kultur': 'kultur', 'Entwicklungsstadium': 'stadium', 'id_element': 'element'})
+    metrics = EVALUATION_COLUMNS[4:]
+    return (
+        d.with_columns(pl.col(metrics).cast(pl.Float64))
+        .unpivot(metrics, index=['kultur', 'stadium', 'element', 'methode'], variable_name='name', value_name='value')
+        .select('kultur', 'stadium', 'element', name=pl.col('methode') + '/' + pl.col('name'), value='value'))
@@ -0,0 +1,112 @@
+"""
+Leite Merkmale der Düngung je Probe ab.
+
+The d_* columns flag which nutrients a field was fertilized with, dat_düng is
+the date of the fertilization. The feature table holds, once per dataset and
+keyed like the record store, for every fertilizer column whether the
+fertilization took place after the sampling and the days from the
+fertilization to the sampling. Commands join it, or compute the same columns
+per row, instead of comparing the dates themselves: a sample fertilized with a
+nutrient after the sampling does not show the fertilizer in its concentration,
+but in its yield, so its concentration of that nutrient is left out of the
+evaluations.
+"""
+
+from pathlib import Path
+from typing import Sequence
+
+import polars as pl
+
+KEY_COLUMNS = ('lab name', 'lab_nr', 'probenahme')
+# fertilizer columns and the plant nutrient they supply; d_org supplies none in particular
+FERTILIZER_NUTRIENTS = {
+    'd_n': 'p_n',
+    'd_p2o5': 'p_p',
+    'd_k2o': 'p_k',
+    'd_mgo': 'p_mg',
+    'd_cao': 'p_ca',
+    'd_s': 'p_s',
+    'd_b': 'p_b',
+    'd_mn': 'p_mn',
+    'd_cu': 'p_cu',
+    'd_zn': 'p_zn',
+    'd_fe': 'p_fe',
+}
+DATE_COLUMN = 'dat_düng'
+
+
+def fertilizer_columns(columns: Sequence[str]) -> list[str]:
+    return [c for c in columns if c.startswith('d_')]
+
+
+def fertilizer_column(nutrient: str) -> str | None:
+    """The fertilizer column of a plant nutrient, if there is one."""
+    return next((d for d, n in FERTILIZER_NUTRIENTS.items() if n == nutrient), None)
+
+
+def late_column(fertilizer: str) -> str:
+    return f'{fertilizer}_nach_probenahme'
+
+
+def days_column(fertilizer: str) -> str:
+    return f'{fertilizer}_tage'
+
+
+def feature_columns(columns: Sequence[str]) -> list[pl.Expr]:
+    """The expressions of the features for a dataset with the given columns, computed per row."""
+    fertilizers = fertilizer_columns(columns)
+    days = (pl.col('probenahme') - pl.col(DATE_COLUMN)).dt.total_days()
+    late = [(pl.col(d) & (pl.col(DATE_COLUMN) > pl.col('probenahme'))).alias(late_column(d)) for d in fertilizers]
+    return [
+        days.alias('tage_duengung'),
+        *late,
+        *(pl.when(pl.col(d)).then(days).alias(days_column(d)) for d in fertilizers),
+        (pl.any_horizontal(late) if fertilizers else pl.lit(None, dtype=pl.Boolean)).alias('duengung_nach_probenahme'),
+    ]
+
+
+def fertilization_features(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    The feature table of a dataset: the key columns, the days from dat_düng to
+    probenahme, and for every fertilizer column the flag of a fertilization
+    after the sampling and the days of fertilized samples. Unknown dates or
+    flags give null.
+    """
+    return lf.select(*KEY_COLUMNS, *feature_columns(lf.collect_schema().names())).unique(
+        KEY_COLUMNS, keep='first', maintain_order=True)
+
+
+def scan_features(source: str | Path) -> pl.LazyFrame:
+    return pl.scan_parquet(source)
+
+
+def join_fertilization(lf: pl.LazyFrame, features: str | Path | pl.LazyFrame | None = None) -> pl.LazyFrame:
+    """
+    Add the features to a dataset, computed from its rows unless a feature
+    table is given. Without a table there is no join, so filters on the result,
+    e.g. by crop, still prune the partitions of the scan.
+    """
+    columns = lf.collect_schema().names()
+    if features is None:
+        return lf.with_columns(c for c in feature_columns(columns) if c.meta.output_name() not in columns)
+    if not isinstance(features, pl.LazyFrame):
+        features = scan_features(features)
+    features = features.select(
+        *KEY_COLUMNS, *(c for c in features.collect_schema().names() if c not in columns))
+    return lf.join(features, on=list(KEY_COLUMNS), how='left', maintain_order='left')
+
+
+def late(nutrient: str) -> pl.Expr:
+    """True for samples fertilized with the nutrient after the sampling, after `join_fertilization`."""
+    fertilizer = fertilizer_column(nutrient)
+    if fertilizer is None:
+        return pl.lit(False)
+    return pl.col(late_column(fertilizer)).fill_null(False)
+
+
+def mask_late_fertilization(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Set the concentrations of nutrients fertilized after the sampling to null, after `join_fertilization`."""
+    columns = set(lf.collect_schema().names())
+    return lf.with_columns(
+        pl.when(late(n)).then(None).otherwise(pl.col(n)).alias(n)
+        for d, n in FERTILIZER_NUTRIENTS.items() if n in columns and late_column(d) in columns)
@@ -0,0 +1,136 @@
+"""
+Lese Lieferungen der Labore ein.
+
+A season arrives as dozens of workbooks and csv files with varying encodings,
+separators and decimal conventions. Every file is read into strings, its column
+names are mapped onto the export schema of data/README.md and it is typed on its
+own, before all files are combined into one deduplicated table. Every file is
+validated as read, before typing, so values which cannot be parsed are reported.
+"""
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import polars as pl
+
+import anaplant.apply_types as apply_types
+import anaplant.codec as codec
+import anaplant.validation as validation
+from anaplant.dataset import YIELD_COLUMNS, read_excel
+
+INGEST_SUFFIXES = ('.csv', '.txt', '.xlsx', '.xlsm', '.xls')
+
+# names used by labs for columns of the export schema, in folded form
+COLUMN_ALIASES = {
+    'labor': 'lab name',
+    'labname': 'lab name',
+    'labornr': 'lab_nr',
+    'labnummer': 'lab_nr',
+    'probennr': 'lab_nr',
+    'datumprobenahme': 'probenahme',
+    'ertrag': 'ertrag (dt/ha)',
+    'ertragdtha': 'ertrag (dt/ha)',
+    'oekokonv': 'öko/konv',
+    'ph': 'ph_wert',
+    'phwert': 'ph_wert',
+    'stadium': 'entwicklungsstadium',
+    'ec': 'entwicklungsstadium',
+    'saat': 'dat_saat',
+    'aussaat': 'dat_saat',
+    'ernte': 'dat_ernte',
+    'datduengung': 'dat_düng',
+}
+
+DECIMAL_COMMA = re.compile(r'^\s*-?\d{1,3}(\.\d{3})*,\d+\s*$')
+DECIMAL_POINT = re.compile(r'^\s*-?\d+\.\d+\s*$')
+
+
+def fold_column_name(name: str) -> str:
+    """Lower case, transliterate umlauts and drop everything except letters and digits."""
+    name = name.strip().lower()
+    for umlaut, replacement in (('ä', 'ae'), ('ö', 'oe'), ('ü', 'ue'), ('ß', 'ss')):
+        name = name.replace(umlaut, replacement)
+    return re.sub(r'[^0-9a-z]', '', name)
+
+
+SCHEMA_BY_FOLDED_NAME = {fold_column_name(c): c for c in YIELD_COLUMNS} | COLUMN_ALIASES
+
+
+def normalize_columns(d: pl.DataFrame) -> pl.DataFrame:
+    """
+    Rename columns to the export schema, add missing schema columns as nulls and
+    order them as in the export. Unknown columns are kept, lower cased, at the end.
+    """
+    renamed = {}
+    for column in d.columns:
+        renamed[column] = SCHEMA_BY_FOLDED_NAME.get(fold_column_name(column), column.strip().lower())
+    if len(set(renamed.values())) != len(renamed):
+        raise ValueError(f'Columns map onto the same schema column: {renamed}')
+    d = d.rename(renamed)
+    missing = [c for c in YIELD_COLUMNS if c not in d.columns]
+    d = d.with_columns(pl.lit(None, dtype=pl.String).alias(c) for c in missing)
+    extra = [c for c in d.columns if c not in YIELD_COLUMNS]
+    return d.select(*YIELD_COLUMNS, *extra)
+
+
+def detect_decimal_comma(d: pl.DataFrame) -> bool:
+    """
+    Check whether the numeric columns use a decimal comma, by counting values
+    written as 1.234,5 against values written as 1234.5. The convention decides
+    how ambiguous values such as 1.234 are parsed.
+    """
+    numeric = [c for c in apply_types.numeric_columns(d.columns) if c in d.columns]
+    values = d.select(pl.concat_list(pl.col(numeric)).explode().drop_nulls().alias('v'))['v']
+    comma = values.str.contains(DECIMAL_COMMA.pattern).sum()
+    point = values.str.contains(DECIMAL_POINT.pattern).sum()
+    return comma >= point
+
+
+def read_delivery(path: str | Path) -> pl.DataFrame:
+    """Read one csv file or the first sheet of a workbook with every column as string."""
+    path = Path(path)
+    if path.suffix in ('.csv', '.txt'):
+        text = codec.decode(path.read_bytes())
+        separator = codec.detect_separator(text.split('\n', 1)[0])
+        return pl.read_csv(text.encode('UTF-8'), separator=separator, infer_schema=False)
+    return read_excel(path)
+
+
+class Ingest(NamedTuple):
+    data: pl.DataFrame
+    # violations of the validation rules, with the file and the data row in it counted from 0
+    report: pl.DataFrame
+    # rows read, before removing duplicates
+    rows: int
+
+
+def ingest_file(path: str | Path) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Read one delivery, validate it and convert it to the typed export schema."""
+    d = normalize_columns(read_delivery(path))
+    decimal_comma = detect_decimal_comma(d)
+    report = validation.validate(d, decimal_comma).report.select(pl.lit(str(path)).alias('datei'), pl.all())
+    # invalid dates are reported and become null, as invalid numbers do
+    d = d.with_columns(
+        pl.col(c).str.strip_chars().str.to_date(strict=False).cast(pl.String) for c in apply_types.DATE_COLUMNS)
+    return apply_types.types(d, decimal_comma=decimal_comma), report
+
+
+def ingest_directory(source_path: str | Path, workers: int | None = None) -> Ingest:
+    """
+    Read every delivery of a directory in parallel and combine them into one table
+    without duplicate rows. polars and the calamine engine release the GIL, so
+    threads are sufficient.
+    """
+    paths = sorted(p for p in Path(source_path).rglob('*') if p.suffix.lower() in INGEST_SUFFIXES)
+    if not paths:
+        raise ValueError(f'No deliveries found in {source_path}.')
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames, reports = zip(*pool.map(ingest_file, paths))
+    combined = pl.concat(frames, how='diagonal_relaxed')
+    deduplicated = combined.unique(maintain_order=True)
+    print(
+        f'Read {len(combined)} rows from {len(paths)} files, '
+        f'dropped {len(combined) - len(deduplicated)} duplicates.')
+    return Ingest(deduplicated, pl.concat(reports), len(combined))
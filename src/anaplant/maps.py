@@ -0,0 +1,237 @@
+"""
+Interpoliere den Nährstoffstatus der Proben auf ein Raster.
+
+The raster is a regular grid in degrees whose cells are about `resolution`
+metres wide. Distances are measured after an equirectangular projection with
+a fixed reference latitude, in which the grid is regular as well; over Germany
+this shortens or stretches east-west distances by less than ten percent.
+
+The neighbours of the cells come from a k-d tree of the samples, so the work
+grows with cells × neighbours instead of cells × samples. The grid is
+processed in chunks of rows on a process pool; every worker builds the tree
+once, and a chunk only holds the distances to its neighbours. Cells without a
+sample within max_distance stay empty, so the map command limits the grid to
+the samples widened by max_distance.
+
+Interpolation is inverse distance weighting or simple kriging with an
+exponential covariance, the mean of the samples as known mean and the
+neighbours of every cell as local kriging system.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import matplotlib.pyplot as plt
+import numpy as np
+import polars as pl
+from matplotlib.colors import TwoSlopeNorm
+from scipy.spatial import cKDTree
+
+from anaplant import NUTRIENT_INFO
+from anaplant.validation import LAT_RANGE, LON_RANGE
+
+METHODS = ('idw', 'kriging')
+VALUES = ('abweichung', 'konzentration')
+RESOLUTION = 1000.0
+NEIGHBOURS = 12
+MAX_DISTANCE = 50_000.0
+IDW_POWER = 2.0
+KRIGING_RANGE = 30_000.0
+# nugget as share of the sill, also keeps the systems of repeated coordinates solvable
+KRIGING_NUGGET = 0.1
+# cells per task, the chunk arrays are cells × neighbours
+CHUNK_CELLS = 16_384
+EARTH_RADIUS = 6_371_000.0
+REFERENCE_LAT = 51.0
+
+
+class Grid(NamedTuple):
+    lat: np.ndarray
+    lon: np.ndarray
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.lat), len(self.lon)
+
+
+class Interpolation(NamedTuple):
+    method: str
+    neighbours: int
+    max_distance: float
+    power: float
+    kriging_range: float
+
+
+def project(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Equirectangular projection to metres with the reference latitude, as (n, 2) array."""
+    return EARTH_RADIUS * np.column_stack([np.radians(lon) * np.cos(np.radians(REFERENCE_LAT)), np.radians(lat)])
+
+
+def make_grid(resolution: float = RESOLUTION, lat_range=LAT_RANGE, lon_range=LON_RANGE) -> Grid:
+    """Cell centres of a grid with cells of resolution metres, north to south as in an image."""
+    step_lat = np.degrees(resolution / EARTH_RADIUS)
+    step_lon = step_lat / np.cos(np.radians(REFERENCE_LAT))
+    lat = np.arange(lat_range[1] - step_lat / 2, lat_range[0], -step_lat)
+    lon = np.arange(lon_range[0] + step_lon / 2, lon_range[1], step_lon)
+    return Grid(lat, lon)
+
+
+def sample_extent(lat: np.ndarray, lon: np.ndarray, margin: float = MAX_DISTANCE) -> tuple[tuple, tuple]:
+    """Latitude and longitude range of the samples widened by margin metres, within the validation ranges."""
+    margin_lat = np.degrees(margin / EARTH_RADIUS)
+    margin_lon = margin_lat / np.cos(np.radians(REFERENCE_LAT))
+    return (
+        (max(LAT_RANGE[0], lat.min() - margin_lat), min(LAT_RANGE[1], lat.max() + margin_lat)),
+        (max(LON_RANGE[0], lon.min() - margin_lon), min(LON_RANGE[1], lon.max() + margin_lon)))
+
+
+def idw(distance: np.ndarray, neighbour_values: np.ndarray, power: float) -> np.ndarray:
+    """Inverse distance weighting, a cell on a sample takes its value; missing neighbours have inf distance."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(np.isinf(distance), 0, 1 / distance ** power)
+        estimate = (weights * neighbour_values).sum(axis=1) / weights.sum(axis=1)
+    exact = distance[:, 0] == 0
+    estimate[exact] = neighbour_values[exact, 0]
+    return estimate
+
+
+def simple_kriging(
+        distance: np.ndarray,
+        index: np.ndarray,
+        points: np.ndarray,
+        values: np.ndarray,
+        kriging_range: float) -> np.ndarray:
+    """
+    Simple kriging of every cell from its neighbours, all local systems solved
+    at once. Missing neighbours get no covariance with the cell and a unit
+    diagonal, so their weight is zero. Samples of one value give that value.
+    """
+    mean, sill = values.mean(), values.var()
+    if sill == 0:
+        return np.full(len(distance), mean)
+    valid = ~np.isinf(distance)
+    safe = np.where(valid, index, 0)
+    neighbours = points[safe]
+    between = np.linalg.norm(neighbours[:, :, None, :] - neighbours[:, None, :, :], axis=-1)
+    covariance = sill * np.exp(-between / kriging_range)
+    covariance += np.eye(distance.shape[1]) * KRIGING_NUGGET * sill
+    both = valid[:, :, None] & valid[:, None, :]
+    covariance = np.where(both, covariance, np.eye(distance.shape[1]))
+    target = np.where(valid, sill * np.exp(-np.where(valid, distance, 0) / kriging_range), 0)
+    weights = np.linalg.solve(covariance, target[:, :, None])[:, :, 0]
+    residual = np.where(valid, values[safe] - mean, 0)
+    return mean + (weights * residual).sum(axis=1)
+
+
+_worker_state: dict = {}
+
+
+def _init_worker(points: np.ndarray, values: np.ndarray, grid: Grid, interpolation: Interpolation):
+    _worker_state.update(
+        tree=cKDTree(points), points=points, values=values, grid=grid, interpolation=interpolation)
+
+
+def _interpolate_rows(rows: tuple[int, int]) -> np.ndarray:
+    """Values of the grid rows [start, stop), computed in a worker set up by `_init_worker`."""
+    tree, points, values = _worker_state['tree'], _worker_state['points'], _worker_state['values']
+    grid, interpolation = _worker_state['grid'], _worker_state['interpolation']
+    lat, lon = np.meshgrid(grid.lat[rows[0]:rows[1]], grid.lon, indexing='ij')
+    cells = project(lat.ravel(), lon.ravel())
+    k = min(interpolation.neighbours, len(points))
+    distance, index = tree.query(cells, k=k, distance_upper_bound=interpolation.max_distance)
+    distance, index = distance.reshape(len(cells), k), index.reshape(len(cells), k)
+    result = np.full(len(cells), np.nan)
+    covered = ~np.isinf(distance[:, 0])
+    distance, index = distance[covered], index[covered]
+    if interpolation.method == 'kriging':
+        result[covered] = simple_kriging(distance, index, points, values, interpolation.kriging_range)
+    else:
+        neighbour_values = np.where(np.isinf(distance), 0, values[np.minimum(index, len(values) - 1)])
+        result[covered] = idw(distance, neighbour_values, interpolation.power)
+    return result.reshape(lat.shape).astype(np.float32)
+
+
+def interpolate(
+        lat: np.ndarray,
+        lon: np.ndarray,
+        values: np.ndarray,
+        grid: Grid,
+        interpolation: Interpolation,
+        chunk_cells: int = CHUNK_CELLS,
+        workers: int | None = None) -> np.ndarray:
+    """Raster of the interpolated values of shape grid.shape, nan for cells without samples nearby."""
+    if len(values) == 0:
+        raise ValueError('No samples to interpolate.')
+    points = project(lat, lon)
+    rows_per_chunk = max(1, chunk_cells // len(grid.lon))
+    chunks = [(start, min(start + rows_per_chunk, len(grid.lat))) for start in range(0, len(grid.lat), rows_per_chunk)]
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(points, values, grid, interpolation)) as pool:
+        return np.concatenate(list(pool.map(_interpolate_rows, chunks)))
+
+
+def sample_values(
+        data: pl.DataFrame,
+        nutrient: str,
+        value: str = 'abweichung',
+        literature: pl.DataFrame | None = None) -> pl.DataFrame:
+    """
+    Coordinates and value of the samples with coordinates in the grid. The
+    deviation from the literature range of the crop and stage is 0 inside the
+    range and the distance to the range in range widths outside, negative below.
+    """
+    samples = data.select(
+        'kultur', 'entwicklungsstadium', 'gps_lat', 'gps_lon', pl.col(nutrient).cast(pl.Float64).alias('wert'),
+    ).filter(
+        pl.col('wert').is_not_null()
+        & pl.col('gps_lat').is_between(*LAT_RANGE)
+        & pl.col('gps_lon').is_between(*LON_RANGE))
+    if value == 'konzentration':
+        return samples
+    if literature is None:
+        raise ValueError('The deviation from the target range needs the literature ranges.')
+    ranges = literature.filter(pl.col('id_element') == nutrient).select(
+        kultur='Kultur', entwicklungsstadium='Entwicklungsstadium', low='min_labor', high='max_labor')
+    width = pl.col('high') - pl.col('low')
+    return samples.join(ranges, on=['kultur', 'entwicklungsstadium']).with_columns(
+        wert=pl.when(pl.col('wert') < pl.col('low')).then((pl.col('wert') - pl.col('low')) / width)
+        .when(pl.col('wert') > pl.col('high')).then((pl.col('wert') - pl.col('high')) / width)
+        .otherwise(0.0)
+    ).filter(pl.col('wert').is_finite()).drop('low', 'high')
+
+
+def write_raster(path: str | Path, raster: np.ndarray, grid: Grid, **attributes):
+    """Compressed npz with the raster, the cell centres and the attributes of the map."""
+    np.savez_compressed(path, values=raster, lat=grid.lat, lon=grid.lon, **attributes)
+
+
+def plot_map(
+        path: str | Path,
+        raster: np.ndarray,
+        grid: Grid,
+        samples: pl.DataFrame,
+        nutrient: str,
+        value: str,
+        title: str):
+    element_name, _, unit = NUTRIENT_INFO.get(nutrient, (nutrient, nutrient, ''))
+    fig, ax = plt.subplots(figsize=(8, 9))
+    step_lat, step_lon = abs(grid.lat[1] - grid.lat[0]), grid.lon[1] - grid.lon[0]
+    extent = (grid.lon[0] - step_lon / 2, grid.lon[-1] + step_lon / 2,
+              grid.lat[-1] - step_lat / 2, grid.lat[0] + step_lat / 2)
+    if value == 'abweichung':
+        limit = max(float(np.nanmax(np.abs(raster), initial=0)), 1e-9)
+        image = ax.imshow(raster, extent=extent, cmap='RdBu_r', norm=TwoSlopeNorm(0, -limit, limit))
+        label = f'Abweichung vom Zielwertbereich für {element_name} in Bereichsbreiten'
+    else:
+        image = ax.imshow(raster, extent=extent, cmap='viridis')
+        label = f'{element_name} in {unit}'
+    ax.scatter(samples['gps_lon'], samples['gps_lat'], s=4, c='black', marker='.', label='Proben')
+    ax.set_aspect(1 / np.cos(np.radians(REFERENCE_LAT)))
+    ax.set(title=title, xlabel='Länge', ylabel='Breite')
+    ax.legend(loc='upper left')
+    fig.colorbar(image, ax=ax, label=label, shrink=0.7)
+    fig.savefig(path, dpi=150, bbox_inches='tight')
+    plt.close(fig)
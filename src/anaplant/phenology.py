@@ -0,0 +1,111 @@
+"""
+Berechne Temperatursummen und modellierte Entwicklungsstadien.
+
+For every sample the growing degree days between dat_saat and probenahme are
+looked up in per-station prefix sums of the daily degree days (see
+anaplant.climate), and mapped onto a BBCH stage with crop specific thermal-time
+thresholds. Unlike the reported entwicklungsstadium ('EC 64-65', 'EC 64', ...)
+the modelled stage is a number on one scale for all samples of a crop.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+import anaplant.climate as climate
+
+# Basistemperatur in °C and (temperature sum in °Cd, BBCH) pairs since sowing.
+# Approximate values from the literature for central European conditions,
+# meant as a starting point for a calibration with the reported stages.
+PHENOLOGY: dict[str, tuple[float, tuple[tuple[float, float], ...]]] = {
+    'Winterweizen': (0.0, ((0, 0), (150, 10), (450, 21), (1100, 30), (1400, 39), (1600, 55), (1750, 65), (2400, 89))),
+    'Winterdurum': (0.0, ((0, 0), (150, 10), (450, 21), (1100, 30), (1400, 39), (1600, 55), (1750, 65), (2400, 89))),
+    'Wintergerste': (0.0, ((0, 0), (140, 10), (400, 21), (1000, 30), (1300, 39), (1450, 55), (1550, 65), (2100, 89))),
+    'Winterroggen': (0.0, ((0, 0), (140, 10), (400, 21), (950, 30), (1250, 39), (1400, 55), (1500, 65), (2100, 89))),
+    'Wintergrünroggen': (0.0, ((0, 0), (140, 10), (400, 21), (950, 30), (1250, 39), (1400, 55), (1500, 65), (2100, 89))),
+    'Wintertriticale': (0.0, ((0, 0), (150, 10), (420, 21), (1050, 30), (1350, 39), (1500, 55), (1650, 65), (2300, 89))),
+    'Sommergerste': (0.0, ((0, 0), (120, 10), (350, 21), (550, 30), (800, 39), (950, 55), (1050, 65), (1500, 89))),
+    'Sommerweizen': (0.0, ((0, 0), (120, 10), (380, 21), (600, 30), (850, 39), (1000, 55), (1100, 65), (1650, 89))),
+    'Winterraps': (0.0, ((0, 0), (100, 10), (450, 16), (1000, 30), (1250, 50), (1400, 60), (1550, 65), (2300, 89))),
+    'Körnermais': (6.0, ((0, 0), (100, 10), (350, 16), (550, 32), (800, 55), (900, 65), (1600, 89))),
+    'Silomais': (6.0, ((0, 0), (100, 10), (350, 16), (550, 32), (800, 55), (900, 65), (1400, 85))),
+    'Zuckerrübe': (3.0, ((0, 0), (150, 10), (500, 19), (900, 39), (2500, 49))),
+    'Kartoffel': (2.0, ((0, 0), (300, 10), (500, 19), (750, 40), (900, 55), (1050, 65), (1900, 89))),
+    'Körnererbse': (0.0, ((0, 0), (120, 10), (400, 19), (600, 30), (800, 55), (950, 65), (1500, 89))),
+    'Erbse': (0.0, ((0, 0), (120, 10), (400, 19), (600, 30), (800, 55), (950, 65), (1500, 89))),
+}
+
+PHENOLOGY_COLUMNS = ('tage_nach_saat', 'temperatursumme', 'bbch_modell', 'bbch_klasse')
+
+
+def degree_day_column(base: float) -> str:
+    return f'gdd_{base:g}'
+
+
+def modelled_bbch(kultur: str, temperature_sum: np.ndarray) -> np.ndarray:
+    """Interpolate the BBCH stage from the temperature sum since sowing."""
+    _, thresholds = PHENOLOGY[kultur]
+    gdd, bbch = np.array(thresholds).T
+    return np.where(np.isnan(temperature_sum), np.nan, np.interp(temperature_sum, gdd, bbch))
+
+
+def station_phenology(paths: list[Path], samples: pl.DataFrame) -> pl.DataFrame:
+    """Temperature sums and modelled stages of the samples of one station."""
+    samples = samples.filter(pl.col('kultur').is_in(list(PHENOLOGY)))
+    if samples.is_empty() or samples['dat_saat'].is_null().all():
+        return pl.DataFrame(schema={'_row': pl.UInt32, 'temperatursumme': pl.Float64, 'bbch_modell': pl.Float64})
+    start, end = climate.sample_window(samples, ())
+    series = climate.station_series(paths, start, end)
+    bases = {PHENOLOGY[k][0] for k in samples['kultur'].unique()}
+    series = series.select(
+        'datum',
+        *((pl.col('temperatur') - base).clip(lower_bound=0).alias(degree_day_column(base))
+          for base in bases))
+    index = climate.build_station_index(series, start, end)
+
+    frames = []
+    for (kultur,), group in samples.partition_by('kultur', as_dict=True).items():
+        saat = (group['dat_saat'] - start).dt.total_days().fill_null(-1).to_numpy()
+        probenahme = (group['probenahme'] - start).dt.total_days().to_numpy()
+        _, daily_mean = climate.window_aggregates(
+            index, degree_day_column(PHENOLOGY[kultur][0]), saat, probenahme)
+        # days without a measurement are filled with the mean of the window
+        temperature_sum = np.where(saat >= 0, daily_mean * (probenahme - saat), np.nan)
+        frames.append(pl.DataFrame({
+            '_row': group['_row'],
+            'temperatursumme': temperature_sum,
+            'bbch_modell': modelled_bbch(kultur, temperature_sum),
+        }))
+    return pl.concat(frames).fill_nan(None)
+
+
+def phenology_features(samples: pl.DataFrame, archive_path: str | Path, workers: int | None = None) -> pl.DataFrame:
+    """
+    Compute days after sowing, temperature sum and modelled BBCH stage for every
+    sample. samples needs the columns _row, kultur, station_id, dat_saat and probenahme.
+    """
+    features = climate.map_stations(samples, archive_path, station_phenology, workers)
+    return (
+        samples.select('_row', tage_nach_saat=(pl.col('probenahme') - pl.col('dat_saat')).dt.total_days())
+        .join(features, on='_row', how='left')
+        .with_columns(bbch_klasse=bbch_class(pl.col('bbch_modell'))))
+
+
+def bbch_class(bbch: pl.Expr) -> pl.Expr:
+    """Principal growth stage such as 'BBCH 30-39', usable as grouping key instead of the reported stage."""
+    principal = (bbch // 10 * 10).cast(pl.Int32)
+    return pl.format('BBCH {}-{}', principal, principal + 9)
+
+
+def join_phenology(lf: pl.LazyFrame, archive_path: str | Path) -> pl.LazyFrame:
+    """Add the phenology features to a dataset; only the sample dates are materialized."""
+    lf = lf.with_row_index('_row')
+    samples = lf.select(
+        '_row',
+        'kultur',
+        pl.col('station_id').cast(pl.Int64, strict=False),
+        'dat_saat',
+        'probenahme').collect(engine='streaming')
+    features = phenology_features(samples, archive_path)
+    return lf.join(features.lazy(), on='_row', how='left', maintain_order='left').drop('_row')
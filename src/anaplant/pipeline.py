@@ -0,0 +1,228 @@
+"""
+Führe alle Auswertungen als Pipeline aus.
+
+Every stage is a command of anaplant.cli with declared input and output paths.
+A stage depends on the stages producing its inputs, and stages without
+pending dependencies run concurrently, each in its own process. The outputs
+of a stage are cached under a hash of the contents of its inputs, its options
+and the package code, so an unchanged stage is only checked, not run again.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import NamedTuple
+
+import anaplant
+import anaplant.stages as stages
+
+MANIFEST = 'manifest.json'
+
+
+class Stage(NamedTuple):
+    """One command of anaplant.cli with its inputs and outputs, keyed by option name."""
+    name: str
+    inputs: dict[str, str]
+    outputs: dict[str, str]
+    options: dict[str, str] = {}
+    # outputs which are directories, they are emptied before the stage runs
+    output_directories: tuple[str, ...] = ()
+    # files the command reads without an option, e.g. external/label.csv
+    implicit_inputs: tuple[str, ...] = ()
+
+    def arguments(self) -> list[str]:
+        return [
+            argument
+            for option, value in {**self.inputs, **self.outputs, **self.options}.items()
+            for argument in (f'--{option}', str(value))]
+
+
+def content_hash(path: str | Path) -> str:
+    """sha256 of a file, or of the relative names and contents of all files of a directory."""
+    path = Path(path)
+    digest = hashlib.sha256()
+    if path.is_dir():
+        for file in sorted(p for p in path.rglob('*') if p.is_file()):
+            digest.update(file.relative_to(path).as_posix().encode('UTF-8'))
+            digest.update(content_hash(file).encode('ascii'))
+    elif path.is_file():
+        with open(path, mode='rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        raise ValueError(f'{path} does not exist.')
+    return digest.hexdigest()
+
+
+def code_hash() -> str:
+    """Hash of the package sources, a change of the code invalidates every stage."""
+    digest = hashlib.sha256()
+    for file in sorted(Path(anaplant.__file__).parent.glob('*.py')):
+        digest.update(file.name.encode('UTF-8'))
+        digest.update(content_hash(file).encode('ascii'))
+    return digest.hexdigest()
+
+
+def cache_key(stage: Stage, code: str) -> str:
+    key = {
+        'stage': stage.name,
+        'options': stage.options,
+        'inputs': {option: content_hash(path) for option, path in stage.inputs.items()},
+        'implicit_inputs': {path: content_hash(path) for path in stage.implicit_inputs},
+        'code': code,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+def dependencies(stages: list[Stage]) -> dict[str, set[str]]:
+    """Stages whose outputs are inputs of every stage."""
+    producers = {
+        Path(path).resolve(): stage.name
+        for stage in stages for path in stage.outputs.values()}
+    result = {}
+    for stage in stages:
+        needed = {Path(p).resolve() for p in (*stage.inputs.values(), *stage.implicit_inputs)}
+        result[stage.name] = {producers[p] for p in needed if p in producers}
+        if stage.name in result[stage.name]:
+            raise ValueError(f'Stage {stage.name} reads its own output.')
+    return result
+
+
+def _copy(source: Path, dest: Path) -> None:
+    if source.is_dir():
+        shutil.copytree(source, dest)
+    else:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(source, dest)
+
+
+def _replace(source: Path, dest: Path) -> None:
+    """Replace dest by a copy of source."""
+    if dest.is_dir():
+        shutil.rmtree(dest)
+    elif dest.exists():
+        dest.unlink()
+    _copy(source, dest)
+
+
+def run_stage(stage: Stage, cache_path: Path, code: str) -> str:
+    """Run one stage unless its outputs are cached. Returns what was done."""
+    entry = cache_path / stage.name / cache_key(stage, code)
+    if (entry / MANIFEST).exists():
+        with open(entry / MANIFEST, encoding='UTF-8') as fh:
+            manifest = json.load(fh)
+        stale = [
+            option for option, path in stage.outputs.items()
+            if not Path(path).exists() or content_hash(path) != manifest[option]]
+        for option in stale:
+            _replace(entry / option, Path(stage.outputs[option]))
+        return 'restored' if stale else 'unchanged'
+
+    for option in stage.output_directories:
+        directory = Path(stage.outputs[option])
+        if directory.exists():
+            shutil.rmtree(directory)
+        directory.mkdir(parents=True)
+    print(f'Running {stage.name}.')
+    subprocess.run([sys.executable, '-m', 'anaplant.cli', stage.name, *stage.arguments()], check=True)
+
+    # an entry appears completely or not at all
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    temporary = Path(tempfile.mkdtemp(dir=entry.parent))
+    manifest = {}
+    for option, path in stage.outputs.items():
+        _copy(Path(path), temporary / option)
+        manifest[option] = content_hash(path)
+    with open(temporary / MANIFEST, mode='w', encoding='UTF-8') as fh:
+        json.dump(manifest, fh)
+    try:
+        os.replace(temporary, entry)
+    except OSError:
+        # another run stored the same entry
+        shutil.rmtree(temporary)
+    return 'ran'
+
+
+def run_pipeline(stages: list[Stage], cache_path: str | Path, workers: int | None = None) -> dict[str, str]:
+    """Run the stages in dependency order, independent stages concurrently."""
+    cache_path = Path(cache_path)
+    code = code_hash()
+    pending = dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    results: dict[str, str] = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            ready = [name for name, needs in pending.items() if needs <= results.keys()]
+            for name in ready:
+                del pending[name]
+                running[pool.submit(run_stage, by_name[name], cache_path, code)] = name
+            if not running:
+                raise ValueError(f'Stages {sorted(pending)} wait for each other.')
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # a failed stage stops the pipeline, running stages are finished first
+                results[name] = future.result()
+                print(f'{name}: {results[name]}')
+    return results
+
+
+def analysis_stages(
+        *,
+        yield_data: str,
+        nutrient_range_data: str,
+        out_path: str | Path,
+        weather_station_source: str | None = None,
+        localize_data: str | None = None) -> list[Stage]:
+    """The evaluations of the project; the station stages need the raw station list and the sample workbook."""
+    out_path = Path(out_path)
+    label = 'external/label.csv'
+    stage_table = stages.STAGE_TABLE
+    fertilization = str(out_path / 'duengung.parquet')
+    pipeline = [
+        Stage(
+            name='fertilization',
+            inputs={'yield-data': yield_data},
+            outputs={'dest-path': fertilization}),
+        Stage(
+            name='plot-curves',
+            inputs={
+                'yield-data': yield_data,
+                'nutrient-range-data': nutrient_range_data,
+                'fertilization-data': fertilization},
+            outputs={'plots-path': str(out_path / 'kurven')},
+            output_directories=('plots-path',),
+            implicit_inputs=(stage_table,)),
+        Stage(
+            name='plot-top-percentile',
+            inputs={'yield-data': yield_data, 'nutrient-range-data': nutrient_range_data},
+            outputs={'plots-path': str(out_path / 'top20'), 'table-path': str(out_path / 'zielwerte_top20.csv')},
+            output_directories=('plots-path',),
+            implicit_inputs=(label, stage_table)),
+        Stage(
+            name='plot-annual',
+            inputs={'yield-data': yield_data, 'nutrient-range-data': nutrient_range_data},
+            outputs={'plots-path': str(out_path / 'jahre')},
+            output_directories=('plots-path',),
+            implicit_inputs=(label, stage_table)),
+    ]
+    if weather_station_source and localize_data:
+        stations = str(out_path / 'stationen.csv')
+        pipeline += [
+            Stage(
+                name='resave-weather-station-list',
+                inputs={'source-path': weather_station_source},
+                outputs={'dest-path': stations}),
+            Stage(
+                name='localize-yields',
+                inputs={'yield-data': localize_data, 'weather-station-list': stations},
+                outputs={'dest-path': str(out_path / 'stationen_proben.csv')}),
+        ]
+    return pipeline
@@ -0,0 +1,223 @@
+"""
+Halte die Laborproben als Datensatz mit Hash-Index.
+
+A record store is a directory of append-only parquet segments plus a hash index
+on (lab name, lab_nr, probenahme), split into buckets by key hash:
+
+    <store>/segments/00000001.parquet
+    <store>/index/00a3.parquet          key_hash, row_hash, segment, row
+    <store>/index/meta.json
+
+An upsert hashes the batch, opens only the index buckets its keys fall into,
+writes the new and changed rows as a new segment and rewrites the touched
+buckets. Rows replaced by a later delivery stay in their old segment but are no
+longer referenced by the index, so readers skip them.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import polars as pl
+
+KEY_COLUMNS = ('lab name', 'lab_nr', 'probenahme')
+DEFAULT_BUCKETS = 1024
+INDEX_SCHEMA = pl.Schema({
+    'key_hash': pl.UInt64,
+    'row_hash': pl.UInt64,
+    'segment': pl.UInt32,
+    'row': pl.UInt32})
+
+
+class UpsertReport(NamedTuple):
+    inserted: int
+    replaced: int
+    unchanged: int
+    # rows whose key is incomplete or occurs with differing values within the batch
+    conflicts: pl.DataFrame
+
+
+def is_record_store(path: str | Path) -> bool:
+    return (Path(path) / 'index' / 'meta.json').is_file()
+
+
+def create_store(path: str | Path, buckets: int = DEFAULT_BUCKETS) -> None:
+    path = Path(path)
+    (path / 'segments').mkdir(parents=True, exist_ok=True)
+    (path / 'index').mkdir(parents=True, exist_ok=True)
+    _write_meta(path, buckets)
+
+
+def _write_meta(path: Path, buckets: int) -> None:
+    # polars hashes are only stable within one polars version
+    meta = {'buckets': buckets, 'hash_version': pl.__version__}
+    (path / 'index' / 'meta.json').write_text(json.dumps(meta))
+
+
+def _read_meta(path: Path) -> dict:
+    return json.loads((path / 'index' / 'meta.json').read_text())
+
+
+def _key_hash() -> pl.Expr:
+    return pl.struct(KEY_COLUMNS).hash(seed=0)
+
+
+def _row_hash(columns: list[str]) -> pl.Expr:
+    return pl.struct(columns).hash(seed=0)
+
+
+def _segments(path: Path) -> list[Path]:
+    return sorted((path / 'segments').glob('*.parquet'))
+
+
+def _bucket_path(path: Path, bucket: int) -> Path:
+    return path / 'index' / f'{bucket:04x}.parquet'
+
+
+def _write_atomic(d: pl.DataFrame, target: Path) -> None:
+    tmp = target.with_name(f'.{target.name}.{os.getpid()}.part')
+    d.write_parquet(tmp)
+    os.replace(tmp, target)
+
+
+def _write_buckets(path: Path, entries: pl.DataFrame, buckets: int) -> None:
+    parts = entries.with_columns(_bucket=pl.col('key_hash') % buckets).partition_by(
+        '_bucket', as_dict=True, include_key=False)
+    for (bucket,), part in parts.items():
+        _write_atomic(part, _bucket_path(path, bucket))
+
+
+def _read_buckets(path: Path, buckets: list[int]) -> pl.DataFrame:
+    files = [p for p in (_bucket_path(path, b) for b in buckets) if p.exists()]
+    if not files:
+        return pl.DataFrame(schema=INDEX_SCHEMA)
+    return pl.read_parquet(files)
+
+
+def _lock(path: Path) -> Path:
+    lock = path / 'index' / '.lock'
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        raise ValueError(f'{path} is locked by another upsert. Remove {lock} if no upsert is running.')
+    return lock
+
+
+def _align(batch: pl.DataFrame, schema: dict[str, pl.DataType]) -> pl.DataFrame:
+    """Bring a batch into the column order and types of the store."""
+    unknown = [c for c in batch.columns if c not in schema]
+    if unknown:
+        raise ValueError(f'Columns {unknown} are not part of the dataset.')
+    return batch.select(
+        pl.col(c).cast(dtype) if c in batch.columns else pl.lit(None, dtype=dtype).alias(c)
+        for c, dtype in schema.items())
+
+
+def _scan_segments(path: Path) -> pl.LazyFrame:
+    frames = [
+        pl.scan_parquet(segment)
+        .with_row_index('row')
+        .with_columns(segment=pl.lit(int(segment.stem), dtype=pl.UInt32))
+        for segment in _segments(path)]
+    if not frames:
+        raise ValueError(f'{path} contains no records.')
+    return pl.concat(frames, how='diagonal_relaxed')
+
+
+def scan_records(path: str | Path) -> pl.LazyFrame:
+    """Scan the current version of every record."""
+    path = Path(path)
+    index = pl.scan_parquet(path / 'index' / '*.parquet').select('segment', 'row')
+    return (
+        _scan_segments(path)
+        .join(index, on=['segment', 'row'], how='semi')
+        .drop('segment', 'row'))
+
+
+def rebuild_index(path: str | Path) -> None:
+    """Recompute all hashes of the live records, e.g. after a polars update."""
+    path = Path(path)
+    lock = _lock(path)
+    try:
+        _rebuild_index(path)
+    finally:
+        lock.unlink()
+
+
+def _rebuild_index(path: Path) -> None:
+    buckets = _read_meta(path)['buckets']
+    index = pl.read_parquet(path / 'index' / '*.parquet').select('segment', 'row')
+    live = _scan_segments(path).join(index.lazy(), on=['segment', 'row'], how='semi')
+    columns = [c for c in live.collect_schema().names() if c not in ('segment', 'row')]
+    entries = live.select(
+        key_hash=_key_hash(),
+        row_hash=_row_hash(columns),
+        segment=pl.col('segment'),
+        row=pl.col('row').cast(pl.UInt32)).collect()
+    # the lock file stays in place
+    for bucket in (path / 'index').glob('*.parquet'):
+        bucket.unlink()
+    _write_buckets(path, entries, buckets)
+    _write_meta(path, buckets)
+
+
+def upsert(path: str | Path, batch: pl.DataFrame) -> UpsertReport:
+    """
+    Insert new records and replace changed ones, identified by KEY_COLUMNS.
+    The work done is proportional to the batch: only the index buckets of its
+    keys are read and rewritten, and only its new or changed rows are written.
+    """
+    path = Path(path)
+    if not is_record_store(path):
+        create_store(path)
+    # everything read from the store is read under the lock, so a concurrent
+    # upsert cannot commit a segment between reading and writing
+    lock = _lock(path)
+    try:
+        if _read_meta(path)['hash_version'] != pl.__version__:
+            print(f'Rebuilding the index of {path} for polars {pl.__version__}.')
+            _rebuild_index(path)
+        buckets = _read_meta(path)['buckets']
+        segments = _segments(path)
+        if segments:
+            batch = _align(batch, pl.read_parquet_schema(segments[0]))
+        columns = batch.columns
+
+        batch = (
+            batch.with_columns(_key=_key_hash(), _row=_row_hash(columns))
+            .unique(subset=['_key', '_row'], keep='first', maintain_order=True))
+        has_key = pl.all_horizontal(pl.col(KEY_COLUMNS).is_not_null())
+        ambiguous = pl.col('_key').is_duplicated()
+        conflicts = batch.filter(~has_key | ambiguous).drop('_key', '_row')
+        batch = batch.filter(has_key & ~ambiguous)
+
+        touched = (batch['_key'] % buckets).unique().to_list()
+        index = _read_buckets(path, touched)
+        matched = batch.join(
+            index.select('key_hash', 'row_hash'),
+            left_on='_key', right_on='key_hash', how='left', maintain_order='left')
+        is_new = pl.col('row_hash').is_null()
+        is_changed = pl.col('row_hash') != pl.col('_row')
+        counts = matched.select(
+            inserted=is_new.sum(),
+            replaced=(~is_new & is_changed).sum(),
+            unchanged=(~is_new & ~is_changed).sum()).row(0, named=True)
+        to_write = matched.filter(is_new | is_changed).drop('row_hash')
+
+        if len(to_write):
+            segment = int(segments[-1].stem) + 1 if segments else 1
+            _write_atomic(
+                to_write.drop('_key', '_row'),
+                path / 'segments' / f'{segment:08d}.parquet')
+            entries = to_write.select(
+                key_hash=pl.col('_key'),
+                row_hash=pl.col('_row'),
+                segment=pl.lit(segment, dtype=pl.UInt32),
+                row=pl.int_range(pl.len(), dtype=pl.UInt32))
+            kept = index.filter(~pl.col('key_hash').is_in(entries['key_hash'].implode()))
+            _write_buckets(path, pl.concat([kept, entries]), buckets)
+    finally:
+        lock.unlink()
+
+    return UpsertReport(conflicts=conflicts, **counts)
@@ -0,0 +1,170 @@
+"""
+Ordne Proben Gebieten zu.
+
+Loads boundaries such as the Boden-Klima-Räume or districts from GeoJSON or
+shapefiles into one table of polygon edges with a bounding box per region. All
+samples are assigned in one batch: sorted coordinates select the candidate
+regions by bounding box, and the even-odd ray casting test runs on arrays of
+(candidate, edge) pairs instead of a loop over points and polygons.
+"""
+
+import json
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+
+# upper bound for the number of (candidate, edge) pairs tested at once
+MAX_PAIRS = 4_000_000
+
+
+class RegionIndex(NamedTuple):
+    """Edges of all regions, ordered by region, with offsets and bounding boxes."""
+    names: np.ndarray
+    # (minx, miny, maxx, maxy) per region
+    bounds: np.ndarray
+    # start of the edges of region i, the last entry is the number of edges
+    offsets: np.ndarray
+    # x0, y0, x1, y1 per edge
+    edges: np.ndarray
+
+
+def _ring_edges(ring) -> np.ndarray:
+    points = np.asarray(ring, dtype=float)[:, :2]
+    return np.hstack([points, np.roll(points, -1, axis=0)])
+
+
+def _polygons(geometry: dict) -> list:
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError(f'Unsupported geometry type {geometry["type"]}.')
+
+
+def read_geojson(path: str | Path, name_property: str) -> list[tuple[str, list]]:
+    """Regions of a GeoJSON FeatureCollection as (name, rings); holes are rings as well."""
+    with open(path, encoding='UTF-8') as fh:
+        features = json.load(fh)['features']
+    return [
+        (str(f['properties'][name_property]),
+         [ring for polygon in _polygons(f['geometry']) for ring in polygon])
+        for f in features if f['geometry'] is not None]
+
+
+def read_shapefile(path: str | Path, name_property: str) -> list[tuple[str, list]]:
+    """Regions of a shapefile, requires the optional pyshp package."""
+    try:
+        import shapefile
+    except ImportError as e:
+        raise ValueError('Reading shapefiles requires the pyshp package.') from e
+    regions = []
+    with shapefile.Reader(str(path)) as reader:
+        for record in reader.iterShapeRecords():
+            parts = list(record.shape.parts) + [len(record.shape.points)]
+            rings = [record.shape.points[a:b] for a, b in zip(parts[:-1], parts[1:])]
+            if rings:
+                regions.append((str(record.record[name_property]), rings))
+    return regions
+
+
+def load_regions(path: str | Path, name_property: str) -> RegionIndex:
+    """
+    Build the index from a .geojson/.json or .shp file. Coordinates must be WGS84
+    longitude and latitude, as gps_lon and gps_lat.
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.shp':
+        regions = read_shapefile(path, name_property)
+    else:
+        regions = read_geojson(path, name_property)
+    if not regions:
+        raise ValueError(f'No regions found in {path}.')
+    edges = [np.vstack([_ring_edges(r) for r in rings]) for _, rings in regions]
+    counts = np.array([len(e) for e in edges])
+    bounds = np.array([
+        (e[:, 0].min(), e[:, 1].min(), e[:, 0].max(), e[:, 1].max()) for e in edges])
+    return RegionIndex(
+        names=np.array([name for name, _ in regions], dtype=object),
+        bounds=bounds,
+        offsets=np.concatenate([[0], np.cumsum(counts)]),
+        edges=np.vstack(edges))
+
+
+def _candidates(index: RegionIndex, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(point, region) pairs whose bounding box contains the point."""
+    order = np.argsort(x, kind='stable')
+    sorted_x = x[order]
+    first = np.searchsorted(sorted_x, index.bounds[:, 0], side='left')
+    last = np.searchsorted(sorted_x, index.bounds[:, 2], side='right')
+    counts = last - first
+    region = np.repeat(np.arange(len(counts)), counts)
+    # position within the x range of every region
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    point = order[np.repeat(first, counts) + within]
+    in_box = (y[point] >= index.bounds[region, 1]) & (y[point] <= index.bounds[region, 3])
+    return point[in_box], region[in_box]
+
+
+def _contains(index: RegionIndex, x: np.ndarray, y: np.ndarray, region: np.ndarray) -> np.ndarray:
+    """Even-odd test of the points x, y against the regions, all edges at once."""
+    counts = index.offsets[region + 1] - index.offsets[region]
+    pair = np.repeat(np.arange(len(region)), counts)
+    edge = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) \
+        + np.repeat(index.offsets[region], counts)
+    x0, y0, x1, y1 = index.edges[edge].T
+    px, py = x[pair], y[pair]
+    straddles = (y0 > py) != (y1 > py)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        crosses = straddles & (px < (x1 - x0) * (py - y0) / (y1 - y0) + x0)
+    return np.bincount(pair, weights=crosses, minlength=len(region)) % 2 == 1
+
+
+def assign_regions(index: RegionIndex, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Name of the region containing every point, None outside of all regions or for
+    missing coordinates. Overlapping regions resolve to the first one in the file.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    result = np.full(len(lon), None, dtype=object)
+    valid = np.flatnonzero(~np.isnan(lon) & ~np.isnan(lat))
+    point, region = _candidates(index, lon[valid], lat[valid])
+    point = valid[point]
+
+    edge_counts = index.offsets[region + 1] - index.offsets[region]
+    chunk = np.searchsorted(np.cumsum(edge_counts), np.arange(MAX_PAIRS, edge_counts.sum(), MAX_PAIRS))
+    inside = np.concatenate([
+        _contains(index, lon[points], lat[points], regions)
+        for points, regions in zip(np.split(point, chunk), np.split(region, chunk))])
+    point, region = point[inside], region[inside]
+    order = np.lexsort((region, point))
+    first = np.unique(point[order], return_index=True)[1]
+    result[point[order][first]] = index.names[region[order][first]]
+    return result
+
+
+def join_regions(
+        lf: pl.LazyFrame,
+        boundaries: str | Path,
+        name_property: str,
+        region_column: str = 'region') -> pl.LazyFrame:
+    """Add the region of every sample by gps_lon and gps_lat; only the coordinates are materialized."""
+    index = load_regions(boundaries, name_property)
+    lf = lf.with_row_index('_row')
+    points = lf.select('_row', 'gps_lon', 'gps_lat').collect(engine='streaming')
+    regions = pl.DataFrame({
+        '_row': points['_row'],
+        region_column: pl.Series(
+            assign_regions(index, points['gps_lon'].to_numpy(), points['gps_lat'].to_numpy()),
+            dtype=pl.String),
+    })
+    return lf.join(regions.lazy(), on='_row', how='left', maintain_order='left').drop('_row')
+
+
+def compare_regions(d: pl.DataFrame, region_column: str, reference_column: str) -> pl.DataFrame:
+    """Samples whose assigned region differs from a reported one, e.g. bodenklimaraum."""
+    return d.filter(
+        pl.col(region_column).ne_missing(pl.col(reference_column).cast(pl.String))
+    ).select('lab name', 'lab_nr', 'gps_lat', 'gps_lon', reference_column, region_column)
@@ -0,0 +1,242 @@
+"""
+Speichere abgeleitete Zielwertbereiche und Kennzahlen.
+
+A results store is one SQLite file. Every analysis run is a row of runs with
+its method, e.g. 'kurve/quantile' for the boundary lines fit by quantile
+regression, parameters, the version of the dataset and a timestamp; the target
+ranges and statistics of the run reference it and are indexed by crop, stage
+and nutrient:
+
+    runs        run_id, method, parameters, dataset_version, created
+    ranges      run_id, kultur, stadium, element, variante, region, low, high, anzahl
+    statistics  run_id, kultur, stadium, element, variante, region, name, value
+
+Runs are only appended, so earlier results stay queryable, e.g. to see how a
+range changed between dataset versions.
+"""
+
+import hashlib
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Sequence
+
+import polars as pl
+
+import anaplant.dataset as dataset
+import anaplant.pipeline as pipeline
+import anaplant.records as records
+
+RANGE_SCHEMA = {
+    'kultur': pl.String,
+    'stadium': pl.String,
+    'element': pl.String,
+    'variante': pl.String,
+    'region': pl.String,
+    'low': pl.Float64,
+    'high': pl.Float64,
+    'anzahl': pl.Int64,
+}
+STATISTIC_SCHEMA = {
+    'kultur': pl.String,
+    'stadium': pl.String,
+    'element': pl.String,
+    'variante': pl.String,
+    'region': pl.String,
+    'name': pl.String,
+    'value': pl.Float64,
+}
+RUN_SCHEMA = {
+    'run_id': pl.Int64,
+    'method': pl.String,
+    'parameters': pl.String,
+    'dataset_version': pl.String,
+    'created': pl.String,
+}
+# columns of the runs in front of the ranges and statistics of a query
+RUN_COLUMNS = {
+    'method': pl.String,
+    'dataset_version': pl.String,
+    'created': pl.String,
+    'run_id': pl.Int64,
+}
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    method TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    dataset_version TEXT NOT NULL,
+    created TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ranges (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    kultur TEXT NOT NULL,
+    stadium TEXT NOT NULL,
+    element TEXT NOT NULL,
+    variante TEXT NOT NULL,
+    region TEXT,
+    low REAL,
+    high REAL,
+    anzahl INTEGER);
+CREATE TABLE IF NOT EXISTS statistics (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    kultur TEXT NOT NULL,
+    stadium TEXT NOT NULL,
+    element TEXT NOT NULL,
+    variante TEXT NOT NULL,
+    region TEXT,
+    name TEXT NOT NULL,
+    value REAL);
+CREATE INDEX IF NOT EXISTS ranges_group ON ranges (kultur, stadium, element);
+CREATE INDEX IF NOT EXISTS ranges_element ON ranges (element);
+CREATE INDEX IF NOT EXISTS ranges_run ON ranges (run_id);
+CREATE INDEX IF NOT EXISTS statistics_group ON statistics (kultur, stadium, element, name);
+CREATE INDEX IF NOT EXISTS statistics_run ON statistics (run_id);
+CREATE INDEX IF NOT EXISTS runs_method ON runs (method, created);
+"""
+
+
+def connect(path: str | Path) -> sqlite3.Connection:
+    """Open a results store, creating the tables if needed."""
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def dataset_version(source: str | Sequence[str]) -> str:
+    """Short content hash of the yield data, equal for equal data under other names."""
+    sources = (source,) if isinstance(source, (str, Path)) else tuple(source)
+    digest = hashlib.sha256()
+    for entry in sources:
+        if dataset.is_partitioned(entry) or records.is_record_store(entry):
+            hashes = [pipeline.content_hash(entry)]
+        else:
+            hashes = [pipeline.content_hash(p) for p in dataset.expand_sources(entry)]
+        for h in hashes:
+            digest.update(h.encode('ascii'))
+    return digest.hexdigest()[:16]
+
+
+def _rows(d: pl.DataFrame, schema: dict[str, pl.DataType]) -> list[tuple]:
+    """Rows in the column order of schema, missing optional columns are null."""
+    d = d.with_columns(pl.lit(None).alias(c) for c in ('variante', 'region') if c not in d.columns)
+    return d.select(pl.col(c).cast(t) for c, t in schema.items()).fill_nan(None).rows()
+
+
+def record_run(
+        path: str | Path,
+        *,
+        method: str,
+        parameters: dict[str, Any],
+        version: str,
+        ranges: pl.DataFrame | None = None,
+        statistics: pl.DataFrame | None = None) -> int:
+    """
+    Store the ranges and statistics of one run in a single transaction and
+    return its run_id. The frames have the columns of RANGE_SCHEMA and
+    STATISTIC_SCHEMA; variante defaults to 'gesamt' and region may be left out.
+    """
+    created = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    with closing(connect(path)) as connection, connection:
+        run_id = connection.execute(
+            'INSERT INTO runs (method, parameters, dataset_version, created) VALUES (?, ?, ?, ?)',
+            (method, json.dumps(parameters, sort_keys=True, default=str), version, created)).lastrowid
+        if ranges is not None:
+            connection.executemany(
+                'INSERT INTO ranges VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, *row) for row in _rows(_default_variant(ranges), RANGE_SCHEMA)])
+        if statistics is not None:
+            connection.executemany(
+                'INSERT INTO statistics VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, *row) for row in _rows(_default_variant(statistics), STATISTIC_SCHEMA)])
+    return run_id
+
+
+def _default_variant(d: pl.DataFrame) -> pl.DataFrame:
+    if 'variante' not in d.columns:
+        return d.with_columns(variante=pl.lit('gesamt'))
+    return d.with_columns(pl.col('variante').fill_null('gesamt'))
+
+
+def _filters(
+        kultur: str | None,
+        stadium: str | None,
+        element: str | None,
+        method: str | None) -> tuple[str, list]:
+    conditions, values = [], []
+    for column, value in (('r.kultur', kultur), ('r.stadium', stadium), ('r.element', element)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            values.append(value)
+    if method is not None:
+        # 'kurve' also selects the fit methods 'kurve/quantile', 'kurve/least-squares', ...
+        conditions.append('(u.method = ? OR substr(u.method, 1, ?) = ?)')
+        values.extend([method, len(method) + 1, f'{method}/'])
+    return ' AND '.join(conditions) or '1', values
+
+
+def _query(path: str | Path, sql: str, values: list, schema: dict[str, pl.DataType]) -> pl.DataFrame:
+    if not Path(path).is_file():
+        raise ValueError(f'{path} is no results store.')
+    with closing(connect(path)) as connection:
+        rows = connection.execute(sql, values).fetchall()
+    return pl.DataFrame(rows, schema=schema, orient='row')
+
+
+def latest_ranges(
+        path: str | Path,
+        kultur: str | None = None,
+        stadium: str | None = None,
+        element: str | None = None,
+        method: str | None = None) -> pl.DataFrame:
+    """The range of the latest run of every method for every group, e.g. all methods of one crop."""
+    where, values = _filters(kultur, stadium, element, method)
+    sql = f"""
+        SELECT method, dataset_version, created, run_id, kultur, stadium, element, variante, region, low, high, anzahl
+        FROM (
+            SELECT u.method, u.dataset_version, u.created, r.*,
+                ROW_NUMBER() OVER (
+                    PARTITION BY u.method, r.kultur, r.stadium, r.element, r.variante, r.region
+                    ORDER BY r.run_id DESC) AS newest
+            FROM ranges r JOIN runs u USING (run_id)
+            WHERE {where})
+        WHERE newest = 1
+        ORDER BY kultur, element, stadium, method, variante, region"""
+    return _query(path, sql, values, {**RUN_COLUMNS, **RANGE_SCHEMA})
+
+
+def range_history(
+        path: str | Path,
+        kultur: str | None = None,
+        stadium: str | None = None,
+        element: str | None = None,
+        method: str | None = None) -> pl.DataFrame:
+    """Every stored range of the groups in the order of the runs, to follow a range across dataset versions."""
+    where, values = _filters(kultur, stadium, element, method)
+    sql = f"""
+        SELECT u.method, u.dataset_version, u.created, r.*
+        FROM ranges r JOIN runs u USING (run_id)
+        WHERE {where}
+        ORDER BY r.kultur, r.element, r.stadium, u.method, r.variante, r.region, r.run_id"""
+    return _query(path, sql, values, {**RUN_COLUMNS, **RANGE_SCHEMA})
+
+
+def statistics(
+        path: str | Path,
+        kultur: str | None = None,
+        stadium: str | None = None,
+        element: str | None = None,
+        method: str | None = None) -> pl.DataFrame:
+    """Every stored statistic of the groups in the order of the runs."""
+    where, values = _filters(kultur, stadium, element, method)
+    sql = f"""
+        SELECT u.method, u.dataset_version, u.created, r.*
+        FROM statistics r JOIN runs u USING (run_id)
+        WHERE {where}
+        ORDER BY r.kultur, r.element, r.stadium, u.method, r.name, r.run_id"""
+    return _query(path, sql, values, {**RUN_COLUMNS, **STATISTIC_SCHEMA})
+
+
+def runs(path: str | Path) -> pl.DataFrame:
+    return _query(path, 'SELECT * FROM runs ORDER BY run_id', [], RUN_SCHEMA)
@@ -0,0 +1,101 @@
+"""
+Fasse Proben eines Standorts zusammen.
+
+Trial sites contribute many samples with equal or almost equal coordinates,
+e.g. one per variety. Samples closer than a radius are linked and every
+connected group is one site. Candidate pairs come from a hash grid with cells
+of the size of the radius, so only samples in neighbouring cells are compared
+and the work grows linearly with the number of samples.
+"""
+
+import numpy as np
+import polars as pl
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import anaplant.apply_types as apply_types
+
+SITE_RADIUS = 50.0
+EARTH_RADIUS = 6_371_000.0
+# the own cell and half of the neighbouring cells, the other half is covered by symmetry
+NEIGHBOUR_CELLS = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+
+def project(lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Equirectangular projection to metres, accurate at the distances of a site."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return EARTH_RADIUS * lon * np.cos(lat), EARTH_RADIUS * lat
+
+
+def cluster_points(lat: np.ndarray, lon: np.ndarray, radius: float = SITE_RADIUS) -> np.ndarray:
+    """
+    Site number of every point, numbered in order of appearance. Points without
+    coordinates are sites of their own.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    known = ~(np.isnan(lat) | np.isnan(lon))
+    # repeated coordinates are one point of the graph
+    coordinates, point = np.unique(np.column_stack([lat[known], lon[known]]), axis=0, return_inverse=True)
+    point = point.ravel()
+    x, y = project(coordinates[:, 0], coordinates[:, 1])
+    cells = pl.DataFrame({
+        'i': np.arange(len(x)),
+        'cx': np.floor(x / radius).astype(np.int64),
+        'cy': np.floor(y / radius).astype(np.int64),
+    })
+    pairs = []
+    for dx, dy in NEIGHBOUR_CELLS:
+        candidates = cells.join(
+            cells.select(
+                j='i',
+                cx=pl.col('cx') - dx,
+                cy=pl.col('cy') - dy),
+            on=['cx', 'cy'])
+        if (dx, dy) == (0, 0):
+            candidates = candidates.filter(pl.col('i') < pl.col('j'))
+        i, j = candidates['i'].to_numpy(), candidates['j'].to_numpy()
+        near = np.hypot(x[i] - x[j], y[i] - y[j]) <= radius
+        pairs.append((i[near], j[near]))
+    i = np.concatenate([p[0] for p in pairs])
+    j = np.concatenate([p[1] for p in pairs])
+    graph = coo_matrix((np.ones(len(i)), (i, j)), shape=(len(x), len(x)))
+    _, component = connected_components(graph, directed=False)
+
+    sites = np.empty(len(lat), dtype=np.int64)
+    sites[known] = component[point]
+    sites[~known] = component.max(initial=-1) + 1 + np.arange((~known).sum())
+    # number the sites in order of their first sample
+    _, first, inverse = np.unique(sites, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+
+def join_sites(lf: pl.LazyFrame, radius: float = SITE_RADIUS) -> pl.LazyFrame:
+    """Add site_id by gps_lat and gps_lon; only the coordinates are materialized."""
+    lf = lf.with_row_index('_row')
+    points = lf.select('_row', 'gps_lat', 'gps_lon').collect(engine='streaming')
+    sites = pl.DataFrame({
+        '_row': points['_row'],
+        'site_id': cluster_points(points['gps_lat'].to_numpy(), points['gps_lon'].to_numpy(), radius),
+    })
+    return lf.join(sites.lazy(), on='_row', how='left', maintain_order='left').drop('_row')
+
+
+def aggregate_sites(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    One row per site, crop, stage and season: numbers are averaged, other
+    columns take the value of the first sample. proben_standort counts the
+    samples of a row. Expects the output of `join_sites`.
+    """
+    columns = lf.collect_schema().names()
+    keys = ['site_id', 'kultur', 'entwicklungsstadium', 'saison']
+    numeric = [c for c in apply_types.numeric_columns(columns) if c in columns]
+    other = [c for c in columns if c not in keys and c not in numeric]
+    return (
+        lf.with_columns(saison=pl.col('probenahme').dt.year())
+        .group_by(keys, maintain_order=True)
+        .agg(
+            pl.col(numeric).mean(),
+            pl.col(other).first(),
+            proben_standort=pl.len())
+        .select(*columns, 'proben_standort'))
@@ -0,0 +1,113 @@
+"""
+Vereinheitliche die Bezeichnungen der Entwicklungsstadien.
+
+The stage table maps the stage names of the lab exports onto the names of the
+literature ranges, e.g. 'EC 64-65' onto 'EC 64'. A row without Kultur applies
+to all crops, a row with Kultur takes precedence for that crop. The table is
+applied with a join when the data is loaded, so every command groups by the
+same stages.
+
+Stages of a crop whose literature ranges are equal for all nutrients are
+merged into one stage, e.g. 'EC 30-31 + EC 31', unless a command runs with
+--no-merge-equal-stages; the merges are appended to the table, so data and
+literature are mapped with the same join.
+"""
+
+from pathlib import Path
+
+import polars as pl
+
+STAGE_TABLE = 'external/stadien.csv'
+STAGE_SCHEMA = {'Kultur': pl.String, 'Entwicklungsstadium': pl.String, 'Stadium': pl.String}
+LITERATURE_KEYS = ['Kultur', 'Entwicklungsstadium', 'id_element']
+MERGED_STAGE_SEPARATOR = ' + '
+
+
+def read_stage_table(path: str | Path = STAGE_TABLE) -> pl.DataFrame:
+    table = pl.read_csv(path, schema_overrides=STAGE_SCHEMA)
+    missing = set(STAGE_SCHEMA) - set(table.columns)
+    if missing:
+        raise ValueError(f'{path} misses the columns {sorted(missing)}.')
+    table = table.select(STAGE_SCHEMA.keys())
+    duplicated = table.filter(pl.struct('Kultur', 'Entwicklungsstadium').is_duplicated())
+    if not duplicated.is_empty():
+        raise ValueError(f'{path} maps stages more than once: {duplicated.rows()}.')
+    return table
+
+
+def harmonize(
+        lf: pl.LazyFrame,
+        table: pl.DataFrame,
+        crop_column: str = 'kultur',
+        stage_column: str = 'entwicklungsstadium') -> pl.LazyFrame:
+    """Replace the stages found in table, first by the rows of the crop, then by the rows for all crops."""
+    specific = table.filter(pl.col('Kultur').is_not_null()).rename({
+        'Kultur': crop_column, 'Entwicklungsstadium': stage_column, 'Stadium': '_stadium_kultur'})
+    generic = table.filter(pl.col('Kultur').is_null()).drop('Kultur').rename({
+        'Entwicklungsstadium': stage_column, 'Stadium': '_stadium'})
+    return (
+        lf.join(specific.lazy(), on=[crop_column, stage_column], how='left', maintain_order='left')
+        .join(generic.lazy(), on=stage_column, how='left', maintain_order='left')
+        .with_columns(pl.coalesce('_stadium_kultur', '_stadium', stage_column).alias(stage_column))
+        .drop('_stadium_kultur', '_stadium'))
+
+
+def equal_range_stages(literature: pl.DataFrame) -> pl.DataFrame:
+    """Stage table merging the stages of a crop with equal ranges for all nutrients, in the order of literature."""
+    profiles = (
+        literature.sort('id_element', maintain_order=True)
+        .group_by('Kultur', 'Entwicklungsstadium', maintain_order=True)
+        .agg(_profil=pl.concat_str('id_element', 'min_labor', 'max_labor', separator=':', ignore_nulls=True)
+             .str.join(';')))
+    return (
+        profiles.group_by('Kultur', '_profil', maintain_order=True)
+        .agg('Entwicklungsstadium')
+        .filter(pl.col('Entwicklungsstadium').list.len() > 1)
+        .with_columns(Stadium=pl.col('Entwicklungsstadium').list.join(MERGED_STAGE_SEPARATOR))
+        .explode('Entwicklungsstadium')
+        .select(STAGE_SCHEMA.keys()))
+
+
+def stage_table(literature: pl.DataFrame | None = None, path: str | Path = STAGE_TABLE) -> pl.DataFrame:
+    """
+    The stage table, with the merges of `equal_range_stages` if the literature
+    ranges are given. Names which the table maps onto a merged stage are mapped
+    onto the merged stage directly, so one join applies both.
+    """
+    table = read_stage_table(path)
+    if literature is None:
+        return table
+    merged = equal_range_stages(
+        harmonize(literature.lazy(), table, 'Kultur', 'Entwicklungsstadium').collect())
+    per_crop = pl.concat([
+        table.filter(pl.col('Kultur').is_not_null()),
+        table.filter(pl.col('Kultur').is_null()).drop('Kultur')
+        .join(merged.select('Kultur').unique(maintain_order=True), how='cross')
+        .select(STAGE_SCHEMA.keys()),
+    ])
+    composed = per_crop.join(
+        merged.rename({'Entwicklungsstadium': 'Stadium', 'Stadium': '_zusammengefasst'}),
+        on=['Kultur', 'Stadium']
+    ).select('Kultur', 'Entwicklungsstadium', Stadium='_zusammengefasst')
+    return pl.concat([table, merged, composed]).unique(
+        ['Kultur', 'Entwicklungsstadium'], keep='last', maintain_order=True)
+
+
+def read_literature(path: str | Path, table: pl.DataFrame | None = None, split_mais: bool = True) -> pl.DataFrame:
+    """
+    Literature ranges with harmonized stages, one row per crop, stage and
+    nutrient. The ranges for Mais are also given for Körnermais and Silomais
+    unless split_mais is false.
+    """
+    literature = pl.read_csv(path)
+    if split_mais:
+        mais = literature.filter(pl.col('Kultur') == 'Mais')
+        literature = pl.concat([
+            literature,
+            mais.with_columns(pl.col('Kultur').replace('Mais', 'Körnermais')),
+            mais.with_columns(pl.col('Kultur').replace('Mais', 'Silomais'))])
+    if table is None:
+        return literature
+    return (
+        harmonize(literature.lazy(), table, 'Kultur', 'Entwicklungsstadium').collect()
+        .unique(LITERATURE_KEYS, keep='first', maintain_order=True))
@@ -2,13 +2,34 @@
 
 from pathlib import Path
 from textwrap import fill
+from typing import Sequence
 
 import matplotlib.pyplot as plt
 import pandas as pd
+import polars as pl
 from matplotlib.transforms import Affine2D
+import anaplant.codec as codec
 from anaplant import NUTRIENT_INFO, read_file
+from anaplant.dataset import add_norm_ert
 import numpy as np
 
+TOP20_COLUMNS = [
+    "Kultur",
+    "Entwicklungsstadium",
+    "id_element",
+    "Variable",
+    "Anzahl_top",
+    "min_top",
+    "max_top",
+    "mean_top",
+    "std_top",
+    "Anzahl",
+    "min",
+    "max",
+    "mean",
+    "std",
+]
+
 
 def aufbereiten(data):
     """Normalisiere den Ertrag und benenne Kulturen um."""
@@ -38,26 +59,91 @@ def get_top20(data: pd.DataFrame, label: pd.DataFrame):
                 rows.append(
                     calc_zielwert(data_stadium, kultur, stadium, col, row["name"])
                 )
-    columns = [
-        "Kultur",
-        "Entwicklungsstadium",
-        "id_element",
-        "Variable",
-        "Anzahl_top",
-        "min_top",
-        "max_top",
-        "mean_top",
-        "std_top",
-        "Anzahl",
-        "min",
-        "max",
-        "mean",
-        "std",
-    ]
-    zielwerte = pd.DataFrame(rows, columns=columns)
+    zielwerte = pd.DataFrame(rows, columns=TOP20_COLUMNS)
     return zielwerte[zielwerte["Anzahl"] != 0]
 
 
+def aufbereiten_lazy(data: pl.LazyFrame) -> pl.LazyFrame:
+    """Streaming variant of `aufbereiten`."""
+    return add_norm_ert(data).with_columns(
+        pl.col("kultur").replace({"Körnererbse": "Erbse"}))
+
+
+def _top_stats(value: pl.Expr, norm_ert: pl.Expr, k: pl.Expr) -> list[pl.Expr]:
+    """Aggregations of one group, equal to `calc_zielwert` including its tie breaking."""
+    # pandas' nlargest skips missing yields and keeps the first row among ties
+    has_ert = norm_ert.is_not_null()
+    top = value.filter(has_ert).top_k_by(
+        [norm_ert.filter(has_ert), pl.col("_row").filter(has_ert)],
+        k=k,
+        reverse=[False, True])
+    return [
+        top.count().alias("Anzahl_top"),
+        top.min().alias("min_top"),
+        top.max().alias("max_top"),
+        top.mean().round(4).alias("mean_top"),
+        top.std().round(4).alias("std_top"),
+        value.count().alias("Anzahl"),
+        value.min().alias("min"),
+        value.max().alias("max"),
+        value.mean().round(4).alias("mean"),
+        value.std().round(4).alias("std"),
+    ]
+
+
+def get_top20_lazy(
+    data: pl.LazyFrame,
+    label: pd.DataFrame,
+    top_fraction: float = 0.2,
+    stage_column: str = "entwicklungsstadium",
+    group_columns: Sequence[str] = (),
+) -> pl.LazyFrame:
+    """
+    Ermittle Zielwerte anhand der Top 20% als polars query.
+    Expects the output of `aufbereiten_lazy` and returns the same table as `get_top20`.
+    Every group keeps only its own nutrient column, so the query can run on the streaming engine.
+    The stages can be taken from another column, e.g. the modelled "bbch_klasse",
+    and group_columns such as "region" split every crop into further groups.
+    """
+    names = pl.LazyFrame(
+        {"id_element": list(label.index), "Variable": list(label["name"])})
+    long = (
+        data.with_row_index("_row")
+        .select(
+            "_row",
+            *group_columns,
+            "kultur",
+            pl.col(stage_column).alias("entwicklungsstadium"),
+            "norm_ert",
+            *label.index)
+        .unpivot(
+            index=["_row", *group_columns, "kultur", "entwicklungsstadium", "norm_ert"],
+            on=list(label.index),
+            variable_name="id_element",
+            value_name="_value")
+        .filter(pl.col("kultur").is_not_null()))
+    value, norm_ert = pl.col("_value"), pl.col("norm_ert")
+    k = (pl.len() * top_fraction).round().cast(pl.UInt32)
+
+    gesamt = (
+        long.filter(value.is_not_null() & norm_ert.is_not_null())
+        .group_by(*group_columns, "kultur", "id_element")
+        .agg(_top_stats(value, norm_ert, k))
+        .with_columns(entwicklungsstadium=pl.lit("gesamt")))
+    stadien = (
+        long.filter(pl.col("entwicklungsstadium").is_not_null())
+        .group_by(*group_columns, "kultur", "entwicklungsstadium", "id_element")
+        .agg(_top_stats(value, norm_ert, k)))
+
+    return (
+        pl.concat([gesamt, stadien], how="diagonal")
+        .filter(pl.col("Anzahl") != 0)
+        .join(names, on="id_element")
+        .rename({"kultur": "Kultur", "entwicklungsstadium": "Entwicklungsstadium"})
+        .select(*group_columns, *TOP20_COLUMNS)
+        .sort(*group_columns, "Kultur", "id_element", "Entwicklungsstadium", nulls_last=True))
+
+
 def calc_zielwert(
     data_stadium: pd.DataFrame, kultur: str, stadium: str, col: str, name: str
 ):
@@ -177,7 +263,26 @@ def plot_stadien(
 
 def write_file(data: pd.DataFrame, file_name: str):
     """Write csv."""
-    data.to_csv(file_name, sep=";", decimal=",", encoding="windows-1252", index=False)
+    codec.write_csv(pl.from_pandas(data), file_name)
+
+
+def result_tables(data: pd.DataFrame, region_column: str | None = None) -> dict[str, pl.DataFrame]:
+    """Ranges (mean ± std of the top 20%) and statistics of the Zielwerte for `results.record_run`."""
+    d = pl.from_pandas(data).rename({
+        "Kultur": "kultur", "Entwicklungsstadium": "stadium", "id_element": "element",
+        **({region_column: "region"} if region_column else {})})
+    keys = ["kultur", "stadium", "element", *(["region"] if region_column else [])]
+    # the columns after "Variable"
+    statistics = TOP20_COLUMNS[4:]
+    return {
+        "ranges": d.select(
+            *keys,
+            low=pl.col("mean_top") - pl.col("std_top"),
+            high=pl.col("mean_top") + pl.col("std_top"),
+            anzahl=pl.col("Anzahl_top")),
+        "statistics": d.with_columns(pl.col(statistics).cast(pl.Float64))
+        .unpivot(statistics, index=keys, variable_name="name", value_name="value"),
+    }
 
 
 if __name__ == "__main__":
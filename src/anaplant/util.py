@@ -1,3 +1,5 @@
+from anaplant.codec import parse_decimal_str
+
 def str_to_float(data: str, decimal_comma: bool = False):
     """
     Convert a string to a float, optionally treating a comma as a decimal 
@@ -9,12 +11,4 @@ def str_to_float(data: str, decimal_comma: bool = False):
         return float(data)
     
 def decimal_comma_str_to_float(data: str):
-    out_str = ''
-    for char in data:
-        if char == ',':
-            out_str += '.'
-        elif char == '.':
-            out_str += ','
-        else:
-            out_str += char
-    return float(out_str)
\ No newline at end of file
+    return parse_decimal_str(data)
@@ -0,0 +1,213 @@
+"""
+Prüfe Lieferungen auf unplausible Werte.
+
+Every rule is a boolean polars expression which is true for the rows violating
+it, so all rules of a table are evaluated in one select, on the streaming
+engine for large tables. Rules work on typed tables and on deliveries read as
+strings; for the latter numbers and dates are parsed inside the rule, so a value
+which `apply_types.types` would silently turn into null is reported.
+
+The report has one row per violation with the row number, the rule, the column
+and the offending value; the summary counts the violations of every rule.
+"""
+
+from typing import Iterable, NamedTuple
+
+import polars as pl
+
+import anaplant.apply_types as apply_types
+from anaplant.codec import parse_decimal
+
+KEY_COLUMNS = ('lab name', 'lab_nr', 'probenahme')
+# plausible concentrations in the units of NUTRIENT_INFO, values outside are
+# mostly given in another unit, e.g. ppm in % TS or g/kg in % TS
+PLAUSIBLE_RANGES = {
+    'p_n': (0.05, 10.0),
+    'p_c': (20.0, 60.0),
+    'p_p': (0.02, 2.0),
+    'p_k': (0.1, 12.0),
+    'p_ca': (0.02, 8.0),
+    'p_mg': (0.0, 2.0),
+    'p_na': (0.0, 4.0),
+    'p_s': (0.02, 3.0),
+    'p_b': (0.5, 300.0),
+    'p_mn': (2.0, 2000.0),
+    'p_cu': (0.5, 500.0),
+    'p_zn': (2.0, 500.0),
+    'p_fe': (5.0, 5000.0),
+    'p_mo': (0.0, 50.0),
+    'p_al': (0.0, 10000.0),
+    'p_co': (0.0, 5.0),
+    'p_se': (0.0, 5.0),
+    'ph_wert': (3.0, 10.0),
+    'ertrag (dt/ha)': (0.0, 1500.0),
+}
+# bounding box of Germany
+LAT_RANGE = (47.2, 55.1)
+LON_RANGE = (5.8, 15.1)
+# rule, date expected earlier, date expected later, column shown in the report
+DATE_ORDER = (
+    ('probenahme_vor_saat', 'dat_saat', 'probenahme', 'probenahme'),
+    ('ernte_vor_saat', 'dat_saat', 'dat_ernte', 'dat_ernte'),
+    ('probenahme_nach_ernte', 'probenahme', 'dat_ernte', 'probenahme'),
+)
+REPORT_SCHEMA = {
+    'zeile': pl.UInt32,
+    'regel': pl.String,
+    'spalte': pl.String,
+    'wert': pl.String,
+    **{c: pl.String for c in KEY_COLUMNS},
+}
+
+
+class Rule(NamedTuple):
+    name: str
+    # column of the value shown in the report
+    column: str
+    violated: pl.Expr
+
+
+class Validation(NamedTuple):
+    report: pl.DataFrame
+    summary: pl.DataFrame
+    rows: int
+
+
+def _number(column: str, schema: pl.Schema) -> pl.Expr:
+    """The value as number, string columns are parsed once by `_parse`."""
+    if schema[column] == pl.String:
+        return pl.col(f'_zahl_{column}')
+    return pl.col(column).cast(pl.Float64)
+
+
+def _date(column: str, schema: pl.Schema) -> pl.Expr:
+    if schema[column] == pl.String:
+        return pl.col(f'_datum_{column}')
+    return pl.col(column).cast(pl.Date)
+
+
+def _parse(lf: pl.LazyFrame, decimal_comma: bool | None) -> pl.LazyFrame:
+    """Add the parsed values of the numeric and date columns held as strings."""
+    schema = lf.collect_schema()
+    columns = schema.names()
+    return lf.with_columns(
+        *(parse_decimal(pl.col(c), decimal_comma).alias(f'_zahl_{c}')
+          for c in apply_types.numeric_columns(columns) if schema.get(c) == pl.String),
+        *(pl.col(c).str.strip_chars().str.to_date(strict=False).alias(f'_datum_{c}')
+          for c in apply_types.DATE_COLUMNS if schema.get(c) == pl.String))
+
+
+def _given(column: str) -> pl.Expr:
+    """The value is present, for strings not empty."""
+    return pl.col(column).cast(pl.String).str.strip_chars().str.len_chars() > 0
+
+
+def default_rules(schema: pl.Schema) -> list[Rule]:
+    """The rules applicable to the columns of schema, the schema of the data before `_parse`."""
+    columns = schema.names()
+    numeric = [c for c in apply_types.numeric_columns(columns) if c in schema]
+    dates = [c for c in apply_types.DATE_COLUMNS if c in schema]
+    rules = []
+
+    rules.append(Rule(
+        'schluessel_fehlt', 'lab_nr',
+        pl.any_horizontal(~_given(c).fill_null(False) for c in KEY_COLUMNS if c in schema)))
+    for c in numeric:
+        if schema[c] == pl.String:
+            rules.append(Rule('zahl_ungueltig', c, _given(c) & _number(c, schema).is_null()))
+    for c in dates:
+        if schema[c] == pl.String:
+            rules.append(Rule('datum_ungueltig', c, _given(c) & _date(c, schema).is_null()))
+
+    for c in numeric:
+        if c.startswith(('p_', 'b_')):
+            rules.append(Rule('negativ', c, _number(c, schema) < 0))
+    for c, (low, high) in PLAUSIBLE_RANGES.items():
+        if c in schema:
+            rules.append(Rule(
+                'einheit_unplausibel' if c.startswith('p_') else 'wert_unplausibel', c,
+                ~_number(c, schema).is_between(low, high)))
+
+    if 'gps_lat' in schema and 'gps_lon' in schema:
+        lat, lon = _number('gps_lat', schema), _number('gps_lon', schema)
+        rules.append(Rule(
+            'gps_ausserhalb', 'gps_lat',
+            ~(lat.is_between(*LAT_RANGE) & lon.is_between(*LON_RANGE))))
+
+    for name, earlier, later, shown in DATE_ORDER:
+        if earlier in schema and later in schema:
+            rules.append(Rule(name, shown, _date(later, schema) < _date(earlier, schema)))
+    return rules
+
+
+def validate(
+        data: pl.DataFrame | pl.LazyFrame,
+        decimal_comma: bool | None = None,
+        rules: list[Rule] | None = None) -> Validation:
+    """Evaluate all rules in one pass over data. Unknown values violate no rule."""
+    lf = data.lazy().with_row_index('zeile')
+    schema = lf.collect_schema()
+    if rules is None:
+        rules = default_rules(schema)
+    lf = _parse(lf, decimal_comma)
+    shown = sorted({r.column for r in rules})
+    keys = [c for c in KEY_COLUMNS if c in schema]
+    masks = lf.select(
+        'zeile',
+        *(r.violated.fill_null(False).alias(f'_rule_{i}') for i, r in enumerate(rules)),
+        *(pl.col(c).cast(pl.String).alias(f'_wert_{c}') for c in shown),
+        *(pl.col(c).cast(pl.String) for c in keys),
+    ).collect(engine='streaming')
+
+    counts = masks.select(pl.col(f'_rule_{i}').sum() for i in range(len(rules))).row(0)
+    report = pl.concat([
+        masks.filter(pl.col(f'_rule_{i}')).select(
+            'zeile',
+            regel=pl.lit(rule.name),
+            spalte=pl.lit(rule.column),
+            wert=pl.col(f'_wert_{rule.column}'),
+            *keys)
+        for i, (rule, count) in enumerate(zip(rules, counts)) if count
+    ], how='diagonal') if any(counts) else pl.DataFrame(schema=REPORT_SCHEMA)
+    report = report.with_columns(
+        pl.lit(None, dtype=pl.String).alias(c) for c in KEY_COLUMNS if c not in report.columns
+    ).select(REPORT_SCHEMA.keys()).sort('zeile', maintain_order=True)
+    summary = pl.DataFrame(
+        {
+            'regel': [r.name for r in rules],
+            'spalte': [r.column for r in rules],
+            'verstoesse': list(counts),
+        },
+        schema={'regel': pl.String, 'spalte': pl.String, 'verstoesse': pl.UInt32},
+    ).with_columns(anteil=(pl.col('verstoesse') / max(len(masks), 1)).round(4))
+    return Validation(report, summary, len(masks))
+
+
+def validate_sources(sources: Iterable[tuple[str, pl.LazyFrame, bool | None]]) -> Validation:
+    """
+    Validate every source with its decimal convention, as given by
+    `dataset.scan_untyped_sources`. The report names the source of every
+    violation in datei, the summary counts the violations of all sources.
+    """
+    names, validations = [], []
+    for name, lf, decimal_comma in sources:
+        names.append(name)
+        validations.append(validate(lf, decimal_comma))
+    rows = sum(v.rows for v in validations)
+    report = pl.concat([
+        v.report.select(pl.lit(name).alias('datei'), pl.all()) for name, v in zip(names, validations)])
+    summary = (
+        pl.concat([v.summary for v in validations])
+        .group_by('regel', 'spalte', maintain_order=True)
+        .agg(pl.col('verstoesse').sum())
+        .with_columns(anteil=(pl.col('verstoesse') / max(rows, 1)).round(4)))
+    return Validation(report, summary, rows)
+
+
+def summarize(report: pl.DataFrame, rows: int) -> pl.DataFrame:
+    """Counts of the violations in a report, e.g. of several files."""
+    return (
+        report.group_by('regel', 'spalte', maintain_order=True)
+        .agg(verstoesse=pl.len())
+        .with_columns(anteil=(pl.col('verstoesse') / max(rows, 1)).round(4))
+        .sort('verstoesse', descending=True, maintain_order=True))
@@ -1,14 +1,28 @@
 """Ermittle Zielwerte anhand der top 20%."""
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from matplotlib import ticker
 import matplotlib.pyplot as plt
 import pandas as pd
 from matplotlib.transforms import Affine2D
+import numpy as np
 import polars as pl
+import anaplant.codec as codec
 from anaplant import NUTRIENT_INFO, NutrientInfo, read_file
+from anaplant.dataset import add_norm_ert
 import structlog
+
+# Saison des ersten Projektjahres, "jahr" 1 entspricht 2022
+FIRST_SEASON = 2022
+YEARS = (1, 2, 3)
+PERMUTATIONS = 9999
+SIGNIFICANCE_LEVEL = 0.05
+# columns of the samples the year effects are grouped and tested by, besides the nutrients
+GROUP_COLUMNS = ("kultur", "entwicklungsstadium", "norm_ert", "jahr")
+# upper bound of permuted values held in memory at once per group
+MAX_PERMUTED_VALUES = 5_000_000
 def main():
     """Hauptfunktion."""
     # Daten einlesen
@@ -71,23 +85,201 @@ def get_top20(
                         col=col, 
                         name=row["name"])
                 )
-    columns = [
-        "Kultur",
-        "Entwicklungsstadium",
-        "id_element",
-        "Variable",
-        "Anzahl",
-        "mean_1",
-        "std_1",
-        "mean_2",
-        "std_2",
-        "mean_3",
-        "std_3",
-    ]
-    zielwerte = pd.DataFrame(rows, columns=columns)
+    zielwerte = pd.DataFrame(rows, columns=ANNUAL_COLUMNS)
     return zielwerte[zielwerte["Anzahl"] != 0]
 
 
+ANNUAL_COLUMNS = [
+    "Kultur",
+    "Entwicklungsstadium",
+    "id_element",
+    "Variable",
+    "Anzahl",
+    *(f"{stat}_{jahr}" for jahr in YEARS for stat in ("mean", "std")),
+]
+
+
+def aufbereiten_lazy(data: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Streaming variant of `aufbereiten`.
+    Derives "jahr" from the sampling date if the export has no such column.
+    """
+    if "jahr" not in data.collect_schema().names():
+        data = data.with_columns(
+            jahr=pl.col("probenahme").dt.year() - FIRST_SEASON + 1)
+    return add_norm_ert(data).with_columns(
+        pl.col("kultur").replace(
+            {"Körnermais": "Mais", "Silomais": "Mais", "Körnererbse": "Erbse"}))
+
+
+def get_top20_lazy(data: pl.LazyFrame, label: pd.DataFrame) -> pl.LazyFrame:
+    """
+    Mittelwert und Standardabweichung je Jahr als polars query.
+    Expects the output of `aufbereiten_lazy` and returns the same table as `get_top20`.
+    """
+    names = pl.LazyFrame(
+        {"id_element": list(label.index), "Variable": list(label["name"])})
+    long = (
+        data.select(*year_effect_columns(label))
+        .unpivot(
+            index=list(GROUP_COLUMNS),
+            on=list(label.index),
+            variable_name="id_element",
+            value_name="_value")
+        .filter(pl.col("kultur").is_not_null()))
+    value = pl.col("_value")
+    stats = [value.count().alias("Anzahl")]
+    for jahr in YEARS:
+        data_jahr = value.filter(pl.col("jahr") == jahr)
+        stats.extend([
+            data_jahr.mean().round(4).alias(f"mean_{jahr}"),
+            data_jahr.std().round(4).alias(f"std_{jahr}"),
+        ])
+
+    gesamt = (
+        long.filter(
+            value.is_not_null()
+            & pl.col("norm_ert").is_not_null()
+            & pl.col("jahr").is_not_null())
+        .group_by("kultur", "id_element")
+        .agg(stats)
+        .with_columns(entwicklungsstadium=pl.lit("gesamt")))
+    stadien = (
+        long.filter(pl.col("entwicklungsstadium").is_not_null())
+        .group_by("kultur", "entwicklungsstadium", "id_element")
+        .agg(stats))
+
+    return (
+        pl.concat([gesamt, stadien], how="diagonal")
+        .filter(pl.col("Anzahl") != 0)
+        .join(names, on="id_element")
+        .rename({"kultur": "Kultur", "entwicklungsstadium": "Entwicklungsstadium"})
+        .select(ANNUAL_COLUMNS)
+        .sort("Kultur", "id_element", "Entwicklungsstadium"))
+
+
+SIGNIFICANCE_COLUMNS = [
+    "Kultur",
+    "Entwicklungsstadium",
+    "id_element",
+    "Variable",
+    "Anzahl",
+    *(f"Anzahl_{jahr}" for jahr in YEARS),
+    "eta2",
+    "p_wert",
+    "p_wert_bh",
+    "signifikant",
+]
+
+
+def between_years(values: np.ndarray, onehot: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Sum of squares between the years of every row of values, up to a constant."""
+    sums = values @ onehot
+    return (sums ** 2 / counts).sum(axis=-1)
+
+
+def permutation_test(
+        values: np.ndarray,
+        jahr: np.ndarray,
+        permutations: int = PERMUTATIONS,
+        rng: np.random.Generator | None = None) -> tuple[float, float]:
+    """
+    Teste, ob sich die Jahre unterscheiden.
+    Returns eta² and the permutation p-value of the sum of squares between years,
+    which orders permutations like the F statistic of a one-way anova. The
+    permutations are rows of index matrices, each one a single matrix product
+    with the one-hot matrix of the years.
+    """
+    rng = rng or np.random.default_rng()
+    years, codes = np.unique(jahr, return_inverse=True)
+    onehot = np.eye(len(years))[codes]
+    counts = onehot.sum(axis=0)
+    values = values - values.mean()
+    observed = between_years(values, onehot, counts)
+    total = np.sum(values ** 2)
+    eta2 = observed / total if total > 0 else np.nan
+
+    exceeding = 0
+    block = max(1, MAX_PERMUTED_VALUES // len(values))
+    for start in range(0, permutations, block):
+        rows = min(block, permutations - start)
+        index = rng.permuted(np.tile(np.arange(len(values)), (rows, 1)), axis=1)
+        # tolerance for rounding of permutations equal to the observed grouping
+        exceeding += np.sum(between_years(values[index], onehot, counts) >= observed * (1 - 1e-12))
+    return eta2, (exceeding + 1) / (permutations + 1)
+
+
+def benjamini_hochberg(p: np.ndarray) -> np.ndarray:
+    """p-values adjusted for the false discovery rate over all groups."""
+    order = np.argsort(p)
+    ranked = p[order] * len(p) / np.arange(1, len(p) + 1)
+    adjusted = np.minimum.accumulate(ranked[::-1])[::-1]
+    result = np.empty_like(p)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+
+def year_effect_columns(label: pd.DataFrame) -> list[str]:
+    """The columns `year_effects` reads, to collect only these."""
+    return [*GROUP_COLUMNS, *label.index]
+
+
+def _year_groups(data: pl.DataFrame, label: pd.DataFrame) -> list[tuple[tuple, pl.DataFrame]]:
+    """Values and years of every crop, stage (and "gesamt") and nutrient with at least two years."""
+    long = (
+        data.select(*year_effect_columns(label))
+        .unpivot(
+            index=list(GROUP_COLUMNS),
+            on=list(label.index),
+            variable_name="id_element",
+            value_name="_value")
+        .filter(
+            pl.col("kultur").is_not_null()
+            & pl.col("_value").is_not_null()
+            & pl.col("jahr").is_in(YEARS)))
+    gesamt = long.filter(pl.col("norm_ert").is_not_null()).with_columns(
+        entwicklungsstadium=pl.lit("gesamt"))
+    stadien = long.filter(pl.col("entwicklungsstadium").is_not_null())
+    groups = pl.concat([gesamt, stadien]).partition_by(
+        "kultur", "entwicklungsstadium", "id_element", as_dict=True, maintain_order=True)
+    return [
+        (key, group) for key, group in groups.items()
+        if (group["jahr"].value_counts()["count"] >= 2).sum() >= 2]
+
+
+def year_effects(
+        data: pl.DataFrame,
+        label: pd.DataFrame,
+        permutations: int = PERMUTATIONS,
+        workers: int | None = None,
+        seed: int = 0) -> pd.DataFrame:
+    """
+    Teste Jahreseffekte je Kultur, Entwicklungsstadium und Element.
+    Expects the output of `aufbereiten_lazy`. Groups run in parallel, numpy
+    releases the GIL for the matrix products. Every group has its own random
+    stream, so the result does not depend on the number of workers.
+    """
+    groups = _year_groups(data, label)
+    streams = np.random.SeedSequence(seed).spawn(len(groups))
+
+    def test(item):
+        (_, group), stream = item
+        return permutation_test(
+            group["_value"].to_numpy(), group["jahr"].to_numpy(), permutations, np.random.default_rng(stream))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(test, zip(groups, streams)))
+
+    rows = []
+    for ((kultur, stadium, element), group), (eta2, p) in zip(groups, results):
+        counts = [int((group["jahr"] == jahr).sum()) for jahr in YEARS]
+        rows.append([kultur, stadium, element, label.loc[element, "name"], len(group), *counts, round(eta2, 4), p])
+    effects = pd.DataFrame(rows, columns=SIGNIFICANCE_COLUMNS[:-2])
+    effects["p_wert_bh"] = benjamini_hochberg(effects["p_wert"].to_numpy())
+    effects["signifikant"] = effects["p_wert_bh"] < SIGNIFICANCE_LEVEL
+    return effects.sort_values(["Kultur", "id_element", "Entwicklungsstadium"], ignore_index=True)
+
+
 def calc_zielwert(
         *,
         data_stadium: pd.DataFrame, 
@@ -143,7 +335,6 @@ def plot_all_stadien(data: pd.DataFrame, path: str):
                 log.exception(e)
 
 from textwrap import fill
-import numpy as np
 def plot_stadien(data_kultur: pd.DataFrame, kultur: str, element: str, path: str):
     stadien = data_kultur["Entwicklungsstadium"].unique()
     data_kultur = data_kultur[data_kultur["id_element"] == element]
@@ -221,7 +412,7 @@ def plot_stadien(data_kultur: pd.DataFrame, kultur: str, element: str, path: str
 
 def write_file(data: pd.DataFrame, file_name: str):
     """Write csv."""
-    data.to_csv(file_name, sep=";", decimal=",", encoding="windows-1252", index=False)
+    codec.write_csv(pl.from_pandas(data), file_name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the package is used from src without installing it, as the commands are
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
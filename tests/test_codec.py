@@ -0,0 +1,68 @@
+import polars as pl
+import pytest
+
+import anaplant.codec as codec
+from anaplant.util import decimal_comma_str_to_float
+
+
+def parse(values, decimal_comma):
+    return pl.select(codec.parse_decimal(pl.lit(pl.Series(values, dtype=pl.String)), decimal_comma)).to_series().to_list()
+
+
+@pytest.mark.parametrize('decimal_comma', [True, False, None])
+def test_unambiguous_values(decimal_comma):
+    values = ['1.234,5', '1234,5', '1,234.5', '0.42', '12', '-0,5', ' 1,5 ', '1.234.567', '1,234,567']
+    assert parse(values, decimal_comma) == [1234.5, 1234.5, 1234.5, 0.42, 12.0, -0.5, 1.5, 1234567.0, 1234567.0]
+
+
+def test_three_digit_groups_follow_the_convention():
+    assert parse(['1.234', '1,234'], True) == [1234.0, 1.234]
+    assert parse(['1.234', '1,234'], False) == [1.234, 1234.0]
+    assert parse(['1.234', '1,234'], None) == [1.234, 1.234]
+
+
+def test_points_not_grouping_three_digits_stay_decimal_points():
+    assert parse(['0.42', '4.1256', '52.069558'], True) == [0.42, 4.1256, 52.069558]
+
+
+@pytest.mark.parametrize('decimal_comma', [True, False, None])
+def test_no_numbers_become_null(decimal_comma):
+    assert parse(['0,3x', '', 'n.b.', None], decimal_comma) == [None, None, None, None]
+
+
+def test_parse_decimal_str_follows_parse_decimal():
+    values = ['1.234,5', '1234,5', '0.42', '1.234', '12', '-0,5']
+    assert [codec.parse_decimal_str(v) for v in values] == parse(values, True)
+    assert decimal_comma_str_to_float('0.42') == 0.42
+
+
+def test_format_decimal_round_trip():
+    values = pl.Series([1234.5, 0.42, -0.5, 12.0, None])
+    formatted = pl.select(codec.format_decimal(pl.lit(values))).to_series()
+    assert formatted.to_list() == ['1234,5', '0,42', '-0,5', '12,0', None]
+    assert parse(formatted.to_list(), True) == values.to_list()
+
+
+def test_format_decimal_rounds():
+    assert pl.select(codec.format_decimal(pl.lit(2 / 3), 2)).item() == '0,67'
+
+
+def test_write_csv_and_read_csv_round_trip(tmp_path):
+    d = pl.DataFrame({'Kultur': ['Winterweizen', 'Zuckerrübe'], 'min_labor': [0.42, 1234.5], 'anzahl': [3, 4]})
+    path = tmp_path / 'werte.csv'
+    codec.write_csv(d, str(path))
+    raw = path.read_bytes()
+    assert raw.decode('windows-1252').splitlines() == [
+        'Kultur;min_labor;anzahl', 'Winterweizen;0,42;3', 'Zuckerrübe;1234,5;4']
+    read = codec.read_csv(str(path))
+    assert read['Kultur'].to_list() == ['Winterweizen', 'Zuckerrübe']
+    assert read['min_labor'].to_list() == [0.42, 1234.5]
+    assert read['anzahl'].to_list() == [3.0, 4.0]
+
+
+def test_detection():
+    assert codec.detect_encoding('Zuckerrübe'.encode('utf-8')) == 'utf-8-sig'
+    assert codec.detect_encoding('Zuckerrübe'.encode('windows-1252')) == 'windows-1252'
+    assert codec.decode('Öl'.encode('windows-1252')) == 'Öl'
+    assert codec.detect_separator('a;b;c,d') == ';'
+    assert codec.detect_separator('a\tb\tc') == '\t'
@@ -0,0 +1,73 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import anaplant.pipeline as pipeline
+from anaplant.pipeline import Stage
+
+DATA = Path(__file__).resolve().parents[1] / 'data' / 'ANAPLANT_Daten.csv'
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return str(path)
+
+
+def test_content_hash_of_directories(tmp_path):
+    write(tmp_path / 'a' / 'x.csv', '1')
+    write(tmp_path / 'b' / 'x.csv', '1')
+    assert pipeline.content_hash(tmp_path / 'a') == pipeline.content_hash(tmp_path / 'b')
+    os.rename(tmp_path / 'b' / 'x.csv', tmp_path / 'b' / 'y.csv')
+    assert pipeline.content_hash(tmp_path / 'a') != pipeline.content_hash(tmp_path / 'b')
+    with pytest.raises(ValueError):
+        pipeline.content_hash(tmp_path / 'c')
+
+
+def test_cache_key_follows_contents_options_and_code(tmp_path):
+    data = write(tmp_path / 'daten.csv', 'a')
+    label = write(tmp_path / 'label.csv', 'b')
+    stage = Stage('plot-annual', inputs={'yield-data': data}, outputs={'plots-path': 'out'}, implicit_inputs=(label,))
+    key = pipeline.cache_key(stage, 'code')
+
+    moved = write(tmp_path / 'kopie.csv', 'a')
+    assert pipeline.cache_key(stage._replace(inputs={'yield-data': moved}), 'code') == key
+    assert pipeline.cache_key(stage._replace(outputs={'plots-path': 'elsewhere'}), 'code') == key
+    assert pipeline.cache_key(stage._replace(options={'permutations': '99'}), 'code') != key
+    assert pipeline.cache_key(stage, 'other code') != key
+    write(tmp_path / 'label.csv', 'c')
+    assert pipeline.cache_key(stage, 'code') != key
+    write(tmp_path / 'daten.csv', 'd')
+    write(tmp_path / 'label.csv', 'b')
+    assert pipeline.cache_key(stage, 'code') != key
+
+
+def test_dependencies(tmp_path):
+    features = str(tmp_path / 'duengung.parquet')
+    stages = [
+        Stage('plot-curves', inputs={'yield-data': 'daten.csv', 'fertilization-data': features}, outputs={}),
+        Stage('fertilization', inputs={'yield-data': 'daten.csv'}, outputs={'dest-path': features}),
+    ]
+    assert pipeline.dependencies(stages) == {'plot-curves': {'fertilization'}, 'fertilization': set()}
+    with pytest.raises(ValueError):
+        pipeline.dependencies([Stage('x', inputs={'a': features}, outputs={'b': features})])
+
+
+def test_run_stage_runs_once_and_restores_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PYTHONPATH', str(Path(pipeline.__file__).parents[1]))
+    with open(DATA, encoding='ISO8859-1') as fh:
+        sample = ''.join(fh.readline() for _ in range(20))
+    data = tmp_path / 'daten.csv'
+    data.write_text(sample, encoding='ISO8859-1')
+    output = tmp_path / 'duengung.parquet'
+    stage = Stage('fertilization', inputs={'yield-data': str(data)}, outputs={'dest-path': str(output)})
+    cache = tmp_path / 'cache'
+
+    assert pipeline.run_stage(stage, cache, 'code') == 'ran'
+    produced = pipeline.content_hash(output)
+    assert pipeline.run_stage(stage, cache, 'code') == 'unchanged'
+    output.unlink()
+    assert pipeline.run_stage(stage, cache, 'code') == 'restored'
+    assert pipeline.content_hash(output) == produced
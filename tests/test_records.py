@@ -0,0 +1,83 @@
+import datetime
+import json
+
+import polars as pl
+import pytest
+
+import anaplant.records as records
+
+
+def batch(numbers, p_k=1.0, lab='IAU'):
+    return pl.DataFrame({
+        'lab name': [lab] * len(numbers),
+        'lab_nr': [str(n) for n in numbers],
+        'probenahme': [datetime.date(2022, 6, 20)] * len(numbers),
+        'kultur': ['Winterweizen'] * len(numbers),
+        'p_k': [p_k] * len(numbers),
+    })
+
+
+def current(path):
+    return records.scan_records(path).sort('lab_nr').collect()
+
+
+def counts(report):
+    return report.inserted, report.replaced, report.unchanged, len(report.conflicts)
+
+
+def test_insert_replace_and_unchanged(tmp_path):
+    store = tmp_path / 'store'
+    assert counts(records.upsert(store, batch([1, 2, 3]))) == (3, 0, 0, 0)
+    assert records.is_record_store(store)
+    assert counts(records.upsert(store, batch([1, 2, 3]))) == (0, 0, 3, 0)
+    changed = pl.concat([batch([1], p_k=2.0), batch([2, 4])])
+    assert counts(records.upsert(store, changed)) == (1, 1, 1, 0)
+
+    d = current(store)
+    assert d['lab_nr'].to_list() == ['1', '2', '3', '4']
+    assert d['p_k'].to_list() == [2.0, 1.0, 1.0, 1.0]
+    # unchanged rows are not written again
+    assert len(list((store / 'segments').glob('*.parquet'))) == 2
+
+
+def test_conflicts_are_not_written(tmp_path):
+    store = tmp_path / 'store'
+    incomplete = batch([1, 2]).with_columns(pl.col('lab_nr').replace('1', None))
+    ambiguous = pl.concat([batch([3], p_k=1.0), batch([3], p_k=2.0)])
+    report = records.upsert(store, pl.concat([incomplete, ambiguous, batch([3], p_k=1.0)]))
+    assert counts(report) == (1, 0, 0, 3)
+    assert report.conflicts['lab_nr'].to_list() == [None, '3', '3']
+    assert current(store)['lab_nr'].to_list() == ['2']
+
+
+def test_batches_are_aligned_to_the_store(tmp_path):
+    store = tmp_path / 'store'
+    records.upsert(store, batch([1]))
+    records.upsert(store, batch([2]).select('lab_nr', 'lab name', 'probenahme', 'kultur'))
+    d = current(store)
+    assert d.columns == batch([1]).columns
+    assert d['p_k'].to_list() == [1.0, None]
+    with pytest.raises(ValueError):
+        records.upsert(store, batch([3]).with_columns(p_x=pl.lit(1.0)))
+
+
+def test_locked_store(tmp_path):
+    store = tmp_path / 'store'
+    records.upsert(store, batch([1]))
+    (store / 'index' / '.lock').touch()
+    with pytest.raises(ValueError, match='locked'):
+        records.upsert(store, batch([2]))
+    assert current(store)['lab_nr'].to_list() == ['1']
+
+
+def test_index_is_rebuilt_for_another_polars_version(tmp_path):
+    store = tmp_path / 'store'
+    records.upsert(store, batch([1, 2]))
+    records.upsert(store, batch([1], p_k=2.0))
+    meta = store / 'index' / 'meta.json'
+    meta.write_text(json.dumps({**json.loads(meta.read_text()), 'hash_version': '0.0.0'}))
+
+    assert counts(records.upsert(store, batch([2, 3]))) == (1, 0, 1, 0)
+    assert json.loads(meta.read_text())['hash_version'] == pl.__version__
+    assert current(store)['p_k'].to_list() == [2.0, 1.0, 1.0]
+    assert not (store / 'index' / '.lock').exists()
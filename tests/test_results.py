@@ -0,0 +1,77 @@
+import polars as pl
+import pytest
+
+import anaplant.results as results
+
+
+def ranges(low, high, stadium='EC 31'):
+    return pl.DataFrame({
+        'kultur': ['Winterweizen', 'Winterweizen'],
+        'stadium': [stadium, stadium],
+        'element': ['p_k', 'p_p'],
+        'low': [low, low / 10],
+        'high': [high, high / 10],
+        'anzahl': [100, 90],
+    })
+
+
+def record(path, method, version, d, statistics=None):
+    return results.record_run(
+        path, method=method, parameters={'min_samples': 10}, version=version, ranges=d, statistics=statistics)
+
+
+def test_latest_range_of_every_method(tmp_path):
+    db = tmp_path / 'ergebnisse.sqlite'
+    record(db, 'kurve/quantile', 'a', ranges(2.0, 3.0))
+    record(db, 'kurve/least-squares', 'a', ranges(2.5, 3.5))
+    newest = record(db, 'kurve/quantile', 'b', ranges(2.2, 3.2))
+
+    latest = results.latest_ranges(db, element='p_k')
+    assert latest.select('method', 'run_id', 'low').rows() == [
+        ('kurve/least-squares', 2, 2.5), ('kurve/quantile', newest, 2.2)]
+    assert latest['variante'].to_list() == ['gesamt', 'gesamt']
+    assert latest['region'].to_list() == [None, None]
+
+
+def test_method_filter_selects_the_fit_methods(tmp_path):
+    db = tmp_path / 'ergebnisse.sqlite'
+    record(db, 'kurve/quantile', 'a', ranges(2.0, 3.0))
+    record(db, 'kurve/binned', 'a', ranges(2.5, 3.5))
+    record(db, 'top20', 'a', ranges(1.0, 4.0))
+    record(db, 'kurvenschar', 'a', ranges(1.0, 4.0))
+
+    def methods(method):
+        return sorted(set(results.latest_ranges(db, method=method)['method']))
+
+    assert methods('kurve') == ['kurve/binned', 'kurve/quantile']
+    assert methods('kurve/binned') == ['kurve/binned']
+    assert methods('top20') == ['top20']
+
+
+def test_history_and_statistics(tmp_path):
+    db = tmp_path / 'ergebnisse.sqlite'
+    statistics = pl.DataFrame({
+        'kultur': ['Winterweizen'], 'stadium': ['EC 31'], 'element': ['p_k'],
+        'variante': ['ohne_duengung'], 'name': ['loss'], 'value': [float('nan')]})
+    record(db, 'kurve/quantile', 'a', ranges(2.0, 3.0), statistics)
+    record(db, 'kurve/quantile', 'b', ranges(2.2, 3.2, stadium='EC 32'))
+
+    history = results.range_history(db, kultur='Winterweizen', element='p_k')
+    assert history.select('dataset_version', 'stadium', 'low').rows() == [('a', 'EC 31', 2.0), ('b', 'EC 32', 2.2)]
+    stored = results.statistics(db)
+    assert stored.select('variante', 'name', 'value').rows() == [('ohne_duengung', 'loss', None)]
+    assert results.runs(db)['parameters'].to_list() == ['{"min_samples": 10}'] * 2
+
+
+def test_dataset_version_depends_on_the_content(tmp_path):
+    first, second = tmp_path / 'a.csv', tmp_path / 'b.csv'
+    first.write_text('lab_nr;p_k\n1;1,5\n')
+    second.write_text('lab_nr;p_k\n1;1,5\n')
+    assert results.dataset_version(str(first)) == results.dataset_version(str(second))
+    second.write_text('lab_nr;p_k\n1;1,6\n')
+    assert results.dataset_version(str(first)) != results.dataset_version(str(second))
+
+
+def test_missing_store(tmp_path):
+    with pytest.raises(ValueError):
+        results.latest_ranges(tmp_path / 'fehlt.sqlite')
@@ -0,0 +1,79 @@
+import polars as pl
+import pytest
+
+import anaplant.stages as stages
+
+TABLE = """Kultur,Entwicklungsstadium,Stadium
+,EC 64-65,EC 64
+Sommergerste,31,EC 31
+"""
+LITERATURE = """Kultur,Entwicklungsstadium,id_element,Element,Einheit,min_labor,max_labor
+Sommergerste,EC 30-31,p_k,Kalium,% TS,3.0,4.5
+Sommergerste,EC 30-31,p_p,Phosphor,% TS,0.3,0.5
+Sommergerste,EC 31,p_k,Kalium,% TS,3.0,4.5
+Sommergerste,EC 31,p_p,Phosphor,% TS,0.3,0.5
+Sommergerste,EC 37-38,p_k,Kalium,% TS,2.5,4.0
+Sommergerste,EC 37-38,p_p,Phosphor,% TS,0.3,0.5
+Winterraps,EC 64,p_k,Kalium,% TS,2.0,3.0
+Mais,EC 32,p_k,Kalium,% TS,2.5,3.5
+"""
+
+
+def write(tmp_path):
+    (tmp_path / 'stadien.csv').write_text(TABLE)
+    (tmp_path / 'zielwerte.csv').write_text(LITERATURE)
+    return tmp_path / 'stadien.csv', tmp_path / 'zielwerte.csv'
+
+
+def harmonized(table, kultur, stadium):
+    lf = pl.LazyFrame({'kultur': kultur, 'entwicklungsstadium': stadium})
+    return stages.harmonize(lf, table).collect()['entwicklungsstadium'].to_list()
+
+
+def test_harmonize_prefers_the_rows_of_the_crop(tmp_path):
+    table = stages.read_stage_table(write(tmp_path)[0])
+    assert harmonized(
+        table,
+        ['Winterraps', 'Sommergerste', 'Winterweizen', 'Sommergerste'],
+        ['EC 64-65', '31', '31', None],
+    ) == ['EC 64', 'EC 31', '31', None]
+
+
+def test_stages_with_equal_ranges_are_merged(tmp_path):
+    table_path, literature_path = write(tmp_path)
+    table = stages.stage_table(stages.read_literature(literature_path), table_path)
+    merged = 'EC 30-31 + EC 31'
+    # data stages mapped by the table onto a merged stage end up in the merged stage directly
+    assert harmonized(
+        table,
+        ['Sommergerste'] * 4 + ['Winterraps'],
+        ['EC 30-31', 'EC 31', '31', 'EC 37-38', 'EC 64-65'],
+    ) == [merged, merged, merged, 'EC 37-38', 'EC 64']
+
+    literature = stages.read_literature(literature_path, table)
+    sommergerste = literature.filter(pl.col('Kultur') == 'Sommergerste')
+    assert sommergerste.select('Entwicklungsstadium', 'id_element').rows() == [
+        (merged, 'p_k'), (merged, 'p_p'), ('EC 37-38', 'p_k'), ('EC 37-38', 'p_p')]
+
+
+def test_no_merges_without_literature(tmp_path):
+    table_path, _ = write(tmp_path)
+    table = stages.stage_table(None, table_path)
+    assert harmonized(table, ['Sommergerste'], ['EC 30-31']) == ['EC 30-31']
+
+
+def test_mais_ranges_apply_to_koernermais_and_silomais(tmp_path):
+    _, literature_path = write(tmp_path)
+
+    def crops(literature):
+        return sorted(set(literature.filter(pl.col('Entwicklungsstadium') == 'EC 32')['Kultur']))
+
+    assert crops(stages.read_literature(literature_path)) == ['Körnermais', 'Mais', 'Silomais']
+    assert crops(stages.read_literature(literature_path, split_mais=False)) == ['Mais']
+
+
+def test_duplicated_table_rows(tmp_path):
+    path = tmp_path / 'stadien.csv'
+    path.write_text(TABLE + 'Sommergerste,31,EC 32\n')
+    with pytest.raises(ValueError, match='more than once'):
+        stages.read_stage_table(path)
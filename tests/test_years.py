@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+import anaplant.years as years
+
+
+def test_benjamini_hochberg_matches_scipy():
+    p = np.array([0.01, 0.04, 0.03, 0.005, 0.5, 0.2])
+    np.testing.assert_allclose(years.benjamini_hochberg(p), stats.false_discovery_control(p))
+
+
+def test_benjamini_hochberg_keeps_order_and_caps_at_one():
+    p = np.array([0.9, 0.01, 0.8])
+    adjusted = years.benjamini_hochberg(p)
+    assert adjusted[1] == pytest.approx(0.03)
+    assert adjusted[0] == adjusted[2] == pytest.approx(0.9)
+    assert np.all(adjusted <= 1)
+
+
+def test_permutation_test_detects_separated_years():
+    jahr = np.repeat([2020, 2021, 2022], 10)
+    values = np.repeat([1.0, 5.0, 9.0], 10) + np.random.default_rng(0).normal(0, 0.1, 30)
+    eta2, p = years.permutation_test(values, jahr, permutations=999, rng=np.random.default_rng(1))
+    assert eta2 > 0.99
+    assert p == pytest.approx(1 / 1000)
+
+
+def test_permutation_test_without_year_effect():
+    jahr = np.tile([2020, 2021], 10)
+    values = np.repeat(np.arange(10.0), 2)
+    eta2, p = years.permutation_test(values, jahr, permutations=999, rng=np.random.default_rng(1))
+    assert eta2 == pytest.approx(0)
+    assert p == 1
+
+
+def test_permutation_test_constant_values():
+    eta2, p = years.permutation_test(np.ones(6), np.array([1, 1, 2, 2, 3, 3]), permutations=99)
+    assert np.isnan(eta2)
+    assert 0 < p <= 1